@@ -380,6 +380,7 @@ set_consumer_count commentstree_q 1
 set_consumer_count newcomments_q 1
 set_consumer_count vote_link_q 1
 set_consumer_count vote_comment_q 1
+set_consumer_count hardcache_sweeper 1
 
 initctl emit reddit-start
 
@@ -391,7 +392,6 @@ if [ ! -f /etc/cron.d/reddit ]; then
 0    3 * * * root /sbin/start --quiet reddit-job-update_sr_names
 30  16 * * * root /sbin/start --quiet reddit-job-update_reddits
 0    * * * * root /sbin/start --quiet reddit-job-update_promos
-*/5  * * * * root /sbin/start --quiet reddit-job-clean_up_hardcache
 *    * * * * root /sbin/start --quiet reddit-job-email
 */2  * * * * root /sbin/start --quiet reddit-job-broken_things
 */2  * * * * root /sbin/start --quiet reddit-job-rising
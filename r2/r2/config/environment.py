@@ -70,6 +70,7 @@ def load_environment(global_conf={}, app_conf={}, setup_globals=True):
 
     config['pylons.h'] = r2.lib.helpers
     config['routes.map'] = routing.make_map()
+    g.startup_timer.intermediate("routes")
 
     #override the default response options
     config['pylons.response_options']['headers'] = {}
@@ -107,6 +108,36 @@ def load_environment(global_conf={}, app_conf={}, setup_globals=True):
         ],
         modulename_callable=mako_module_path,
     )
+    g.startup_timer.intermediate("templates")
 
     if setup_globals:
         g.setup_complete()
+
+
+def compile_templates():
+    """Compile every template into the cache_dir template module cache.
+
+    This is meant to be run at build time (`make templates INI=...`) so that
+    app servers and consumers import the already compiled modules rather than
+    each compiling the templates they use on first render.
+
+    """
+    g = config['pylons.g']
+    if not g.mako_lookup.template_args.get('module_directory'):
+        raise ValueError("no cache_dir configured, can't compile templates")
+
+    # plugin template directories come first in the search path, so looking
+    # the templates up by uri compiles whichever file would win at runtime.
+    uris = set()
+    for directory in config['pylons.paths']['templates']:
+        for root, dirs, files in os.walk(directory):
+            for filename in files:
+                if (filename.startswith('.') or
+                        filename.endswith(('.py', '.pyc'))):
+                    continue
+                path = os.path.relpath(os.path.join(root, filename), directory)
+                uris.add('/' + path)
+
+    for uri in sorted(uris):
+        g.mako_lookup.get_template(uri)
+    print "compiled %d templates" % len(uris)
@@ -369,6 +369,18 @@ class CleanupMiddleware(object):
         return self.app(environ, custom_start_response)
 
 
+def routed_controllers(mapper):
+    """Return the names of all the controllers the routes can dispatch to."""
+    names = set()
+    for route in mapper.matchlist:
+        if route.defaults.get('controller'):
+            names.add(route.defaults['controller'])
+        requirement = route.reqs.get('controller')
+        if requirement and re.match(r"^[\w|]+$", requirement):
+            names.update(requirement.split('|'))
+    return names
+
+
 class RedditApp(PylonsApp):
     def __init__(self, *args, **kwargs):
         super(RedditApp, self).__init__(*args, **kwargs)
@@ -387,10 +399,33 @@ class RedditApp(PylonsApp):
             if self._controllers:
                 return
 
+            g = config['pylons.g']
+            timer = g.stats.get_timer("app_startup")
+            timer.start()
+
             controllers = importlib.import_module(self.package_name +
                                                   '.controllers')
-            controllers.load_controllers()
+            # scripts never route real requests, so they don't need to pay
+            # for importing the controllers (and everything they import).
+            lazy = g.lazy_controllers or g.running_as_script
+            if not lazy:
+                controllers.load_controllers()
             config['r2.plugins'].load_controllers()
+
+            if lazy:
+                # the controllers will be imported as requests are routed to
+                # them. check the routing table now so a route to nowhere
+                # shows up at startup rather than on some request later on.
+                for name in routed_controllers(config['routes.map']):
+                    if not controllers.has_controller(name):
+                        g.log.error("no controller %r for route", name)
+
+            timer.stop("lazy_controllers" if lazy else "controllers")
+            if g.log_start and not g.running_as_script:
+                g.log.error("%s:%s loaded controllers (took %.02fs)",
+                            g.reddit_host, g.reddit_pid,
+                            timer.elapsed_seconds())
+
             self._controllers = controllers
 
     def find_controller(self, controller_name):
@@ -20,18 +20,83 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import importlib
+
+# the reddit controllers and the modules they live in. they're imported all at
+# once by load_controllers() or one module at a time, the first time a request
+# is routed to one of them, by get_controller().
+_controller_modules = (
+    ("listingcontroller", ("ListingController",
+                           "HotController",
+                           "NewController",
+                           "RisingController",
+                           "BrowseController",
+                           "MessageController",
+                           "RedditsController",
+                           "ByIDController",
+                           "RandomrisingController",
+                           "UserController",
+                           "CommentsController",
+                           "GildedController",
+                           "MyredditsController")),
+    ("feedback", ("FeedbackController",)),
+    ("front", ("FormsController", "FrontController")),
+    ("health", ("HealthController",)),
+    ("buttons", ("ButtonsController",)),
+    ("captcha", ("CaptchaController",)),
+    ("embed", ("EmbedController",)),
+    ("error", ("ErrorController",)),
+    ("post", ("PostController",)),
+    ("toolbar", ("ToolbarController",)),
+    ("awards", ("AwardsController",)),
+    ("errorlog", ("ErrorlogController",)),
+    ("promotecontroller", ("PromoteController",)),
+    ("mediaembed", ("MediaembedController", "AdController")),
+    ("policies", ("PoliciesController",)),
+    ("wiki", ("WikiController", "WikiApiController")),
+    ("api", ("ApiController", "ApiminimalController")),
+    ("api_docs", ("ApidocsController",)),
+    ("apiv1", ("APIv1Controller",)),
+    ("oauth2", ("OAuth2FrontendController", "OAuth2AccessController")),
+    ("redirect", ("RedirectController",)),
+    ("ipn", ("IpnController",
+             "StripeController",
+             "CoinbaseController",
+             "RedditGiftsController")),
+)
+
+_module_controllers = dict(_controller_modules)
+_controller_index = dict((cls_name.lower(), module_name)
+                         for module_name, cls_names in _controller_modules
+                         for cls_name in cls_names)
+
 _reddit_controllers = {}
 _plugin_controllers = {}
 
+def _import_module(module_name):
+    module = importlib.import_module("." + module_name, __name__)
+    for cls_name in _module_controllers[module_name]:
+        _reddit_controllers[cls_name.lower()] = getattr(module, cls_name)
+
 def get_controller(name):
     name = name.lower() + 'controller'
     if name in _reddit_controllers:
         return _reddit_controllers[name]
+    elif name in _controller_index:
+        _import_module(_controller_index[name])
+        return _reddit_controllers[name]
     elif name in _plugin_controllers:
         return _plugin_controllers[name]
     else:
         raise KeyError(name)
 
+def has_controller(name):
+    """Whether get_controller(name) would find anything, without importing
+    the controller's module."""
+    name = name.lower() + 'controller'
+    return (name in _controller_index or name in _reddit_controllers or
+            name in _plugin_controllers)
+
 def add_controller(controller):
     name = controller.__name__.lower()
     assert name not in _plugin_controllers
@@ -39,51 +104,5 @@ def add_controller(controller):
     return controller
 
 def load_controllers():
-    from listingcontroller import ListingController
-    from listingcontroller import HotController
-    from listingcontroller import NewController
-    from listingcontroller import RisingController
-    from listingcontroller import BrowseController
-    from listingcontroller import MessageController
-    from listingcontroller import RedditsController
-    from listingcontroller import ByIDController
-    from listingcontroller import RandomrisingController
-    from listingcontroller import UserController
-    from listingcontroller import CommentsController
-    from listingcontroller import GildedController
-
-    from listingcontroller import MyredditsController
-
-    from feedback import FeedbackController
-    from front import FormsController
-    from front import FrontController
-    from health import HealthController
-    from buttons import ButtonsController
-    from captcha import CaptchaController
-    from embed import EmbedController
-    from error import ErrorController
-    from post import PostController
-    from toolbar import ToolbarController
-    from awards import AwardsController
-    from errorlog import ErrorlogController
-    from promotecontroller import PromoteController
-    from mediaembed import MediaembedController
-    from mediaembed import AdController
-    from policies import PoliciesController
-    
-    from wiki import WikiController
-    from wiki import WikiApiController
-
-    from api import ApiController
-    from api import ApiminimalController
-    from api_docs import ApidocsController
-    from apiv1 import APIv1Controller
-    from oauth2 import OAuth2FrontendController
-    from oauth2 import OAuth2AccessController
-    from redirect import RedirectController
-    from ipn import IpnController
-    from ipn import StripeController
-    from ipn import CoinbaseController
-    from ipn import RedditGiftsController
-
-    _reddit_controllers.update((name.lower(), obj) for name, obj in locals().iteritems())
+    for module_name, cls_names in _controller_modules:
+        _import_module(module_name)
@@ -2678,10 +2678,12 @@ class ApiController(RedditController, OAuth2ResourceController):
               flair_csv = nop('flair_csv'))
     @api_doc(api_section.flair)
     def POST_flaircsv(self, flair_csv):
-        limit = 100  # max of 100 flair settings per call
+        limit = 1000  # max of 1000 flair settings per call
         results = FlairCsv()
         # encode to UTF-8, since csv module doesn't fully support unicode
         infile = csv.reader(flair_csv.strip().encode('utf-8').split('\n'))
+
+        rows = []
         for i, row in enumerate(infile):
             line_result = results.add_line()
             line_no = i + 1
@@ -2689,14 +2691,28 @@ class ApiController(RedditController, OAuth2ResourceController):
                 line_result.error('row',
                                   'limit of %d rows per call reached' % limit)
                 break
-
+            rows.append((line_result, row))
+
+        # resolve all of the users up front, preferring live accounts to
+        # deleted ones just as VFlairAccount does
+        names = set(row[0] for line_result, row in rows
+                    if len(row) == 3 and row[0])
+        users = Account._by_names(names)
+        deleted_names = names - set(users)
+        if deleted_names:
+            users.update(Account._by_names(deleted_names, allow_deleted=True))
+
+        # the last valid row for each user wins, as if they'd been applied
+        # one after another
+        flair_by_user = {}
+        for line_result, row in rows:
             try:
                 name, text, css_class = row
             except ValueError:
                 line_result.error('row', 'improperly formatted row, ignoring')
                 continue
 
-            user = VFlairAccount('name').run(name)
+            user = users.get(name)
             if not user:
                 line_result.error('user',
                                   "unable to resolve user `%s', ignoring"
@@ -2722,19 +2738,15 @@ class ApiController(RedditController, OAuth2ResourceController):
                 continue
 
             # all validation passed, enflair the user
-            if text or css_class:
-                mode = 'added'
-                c.site.add_flair(user)
-            else:
-                mode = 'removed'
-                c.site.remove_flair(user)
-            setattr(user, 'flair_%s_text' % c.site._id, text)
-            setattr(user, 'flair_%s_css_class' % c.site._id, css_class)
-            user._commit()
+            mode = 'added' if text or css_class else 'removed'
+            flair_by_user[user] = (text, css_class)
 
             line_result.status = '%s flair for user %s' % (mode, user.name)
             line_result.ok = True
 
+        if flair_by_user:
+            Flair.store_multi(c.site, flair_by_user)
+
         ModAction.create(c.site, c.user, action='editflair',
                          details='flair_csv')
 
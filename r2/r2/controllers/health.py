@@ -51,3 +51,14 @@ class HealthController(MinimalController):
     def GET_promohealth(self):
         response.content_type = "application/json"
         return json.dumps(promote.health_check())
+
+    def GET_cachehealth(self):
+        """Report the keys this process is replicating as hot, by chain."""
+        stats = {}
+        for name, chain in g.cache_chains.iteritems():
+            for i, cache in enumerate(chain.caches):
+                hot_key_stats = getattr(cache, "hot_key_stats", None)
+                if hot_key_stats and hot_key_stats():
+                    stats["%s[%d]" % (name, i)] = hot_key_stats()
+        response.content_type = "application/json"
+        return json.dumps(stats, sort_keys=True, indent=4)
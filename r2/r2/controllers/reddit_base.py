@@ -20,6 +20,7 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import cPickle as pickle
 import collections
 import json
 import locale
@@ -56,6 +57,7 @@ from r2.lib.errors import (
     errors,
 )
 from r2.lib.filters import _force_utf8
+from r2.lib.singleflight import SingleFlight
 from r2.lib.strings import strings
 from r2.lib.template_helpers import add_sr, JSPreload
 from r2.lib.tracking import encrypt, decrypt
@@ -103,6 +105,7 @@ from r2.models import (
     valid_feed,
     valid_otp_cookie,
 )
+from r2.models.last_modified import LastModified
 
 
 NEVER = datetime(2037, 12, 31, 23, 59, 59)
@@ -132,6 +135,15 @@ def pagecache_policy(policy):
     return pagecache_decorator
 
 
+# when page_cache_stale_time is set, one request renders a page missing from
+# the pagecache while the others wait for it (in the same process, for up to
+# PAGECACHE_FLIGHT_WAIT seconds) or serve the stale copy (in other processes,
+# while the renderer holds its PAGECACHE_LEASE_TIME second lease).
+PAGECACHE_LEASE_TIME = 10
+PAGECACHE_FLIGHT_WAIT = 5
+_pagecache_flights = SingleFlight(timeout=PAGECACHE_LEASE_TIME)
+
+
 cache_affecting_cookies = ('over18', '_options')
 
 class Cookies(dict):
@@ -748,11 +760,75 @@ class MinimalController(BaseController):
 
         return False
 
+    def _pagecache_miss(self, key):
+        """Decide who renders a page that's missing from the pagecache.
+
+        Returns a cached response to use instead of rendering, if there is
+        one, or None to render the page.
+
+        """
+        flight, is_leader = _pagecache_flights.join(key)
+        if not is_leader:
+            result = flight.wait(PAGECACHE_FLIGHT_WAIT)
+            if result:
+                g.stats.simple_event('pagecache.coalesced')
+                c.pagecache_state = "coalesced"
+                return pickle.loads(result)
+            return None
+
+        lease_key = "pagecache_lease-" + key
+        try:
+            leased = g.lock_cache.add(lease_key, 1, time=PAGECACHE_LEASE_TIME)
+        except MemcachedError:
+            leased = True
+
+        if not leased:
+            # another process is rendering it already
+            stale = g.pagecache.get("stale-" + key)
+            if stale:
+                g.stats.simple_event('pagecache.stale')
+                c.pagecache_state = "stale"
+                _pagecache_flights.land(key, flight,
+                    pickle.dumps(stale, pickle.HIGHEST_PROTOCOL))
+                return stale
+        else:
+            c.pagecache_lease = lease_key
+
+        # post() lands the flight once the page is rendered
+        c.pagecache_flight = (key, flight)
+        return None
+
+    def _end_pagecache_flight(self, cached=None):
+        """Land this request's page cache flight, if it's leading one, and
+        give up its lease on rendering the page."""
+        if c.pagecache_flight:
+            key, flight = c.pagecache_flight
+            c.pagecache_flight = None
+            if cached:
+                cached = pickle.dumps(cached, pickle.HIGHEST_PROTOCOL)
+            _pagecache_flights.land(key, flight, cached)
+        if c.pagecache_lease:
+            lease_key = c.pagecache_lease
+            c.pagecache_lease = None
+            g.lock_cache.delete(lease_key)
+
+    def __call__(self, environ, start_response):
+        try:
+            return BaseController.__call__(self, environ, start_response)
+        finally:
+            # post() isn't run if the action raises, and the followers of a
+            # flight this request was leading mustn't wait on it for the
+            # rest of the lease
+            self._end_pagecache_flight()
+
     def try_pagecache(self):
         c.can_use_pagecache = self.can_use_pagecache()
 
         if request.method.upper() == 'GET' and c.can_use_pagecache:
-            r = g.pagecache.get(self.request_key())
+            key = self.request_key()
+            r = g.pagecache.get(key)
+            if not r and g.page_cache_stale_time:
+                r = self._pagecache_miss(key)
             if r:
                 r, c.cookies = r
                 response.headers = r.headers
@@ -788,6 +864,7 @@ class MinimalController(BaseController):
         # save the result of this page to the pagecache if possible.  we
         # mustn't cache things that rely on state not tracked by request_key
         # such as If-Modified-Since headers for 304s or requesting IP for 429s.
+        cached = None
         if (g.page_cache_time
             and request.method.upper() == 'GET'
             and c.can_use_pagecache
@@ -795,20 +872,28 @@ class MinimalController(BaseController):
             and response.status_int not in (304, 429)
             and not response.status.startswith("5")
             and not c.is_exception_response):
+            cached = (response._current_obj(), c.cookies)
             try:
-                g.pagecache.set(self.request_key(),
-                                (response._current_obj(), c.cookies),
+                g.pagecache.set(self.request_key(), cached,
                                 g.page_cache_time)
+                if g.page_cache_stale_time:
+                    g.pagecache.set("stale-" + self.request_key(), cached,
+                                    g.page_cache_time +
+                                    g.page_cache_stale_time)
             except MemcachedError as e:
                 # this codepath will actually never be hit as long as
                 # the pagecache memcached client is in no_reply mode.
                 g.log.warning("Ignored exception (%r) on pagecache "
                               "write for %r", e, request.path)
 
+        self._end_pagecache_flight(cached)
+
         pragmas = [p.strip() for p in
                    request.headers.get("Pragma", "").split(",")]
         if g.debug or "x-reddit-pagecache" in pragmas:
-            if c.can_use_pagecache:
+            if c.pagecache_state:
+                pagecache_state = c.pagecache_state
+            elif c.can_use_pagecache:
                 pagecache_state = "hit" if c.used_cache else "miss"
             else:
                 pagecache_state = "disallowed"
@@ -1126,9 +1211,23 @@ class RedditController(MinimalController):
             response.content = "".join(body_parts)
 
     def check_modified(self, thing, action):
-        # this is a legacy shim until the old last_modified system is dead
-        last_modified = utils.last_modified_date(thing, action)
-        return self.abort_if_not_modified(last_modified)
+        return self.check_modified_multi([(thing, action)])
+
+    def check_modified_multi(self, things_and_actions):
+        """Check If-Modified-Since against several (thing, action) pairs.
+
+        All of the timestamps are looked up together and the newest one is
+        used as the Last-Modified of the response.
+
+        """
+        if c.user_is_loggedin and not c.allow_loggedin_cache:
+            return
+
+        pairs = [(thing._fullname, action.capitalize())
+                 for thing, action in things_and_actions]
+        last_modified = LastModified.get_many(pairs, touch_if_not_set=True,
+                                              local=True)
+        return self.abort_if_not_modified(max(last_modified.itervalues()))
 
     def abort_if_not_modified(self, last_modified, private=True,
                               max_age=timedelta(0),
@@ -50,6 +50,7 @@ from r2.lib.cache import (
     MemcacheChain,
     SelfEmptyingCache,
     StaleCacheChain,
+    ValueCodec,
 )
 from r2.lib.configparse import ConfigValue, ConfigValueParser
 from r2.lib.contrib import ipaddress
@@ -89,8 +90,12 @@ class Globals(object):
             'db_pool_size',
             'db_pool_overflow_size',
             'page_cache_time',
+            'page_cache_stale_time',
             'commentpane_cache_time',
             'num_mc_clients',
+            'hot_key_replicas',
+            'hot_key_threshold',
+            'hot_key_ttl',
             'MAX_CAMPAIGNS_PER_LINK',
             'MIN_DOWN_LINK',
             'MIN_UP_KARMA',
@@ -132,6 +137,7 @@ class Globals(object):
         ConfigValue.float: [
             'min_promote_bid',
             'max_promote_bid',
+            'cpm_selfserve',
             'statsd_sample_rate',
             'querycache_prune_chance',
         ],
@@ -142,6 +148,8 @@ class Globals(object):
             'sqlprinting',
             'template_debug',
             'reload_templates',
+            'lazy_controllers',
+            'cache_codec',
             'uncompressedJS',
             'css_killswitch',
             'db_create_tables',
@@ -429,11 +437,28 @@ class Globals(object):
         ################# MEMCACHE
         num_mc_clients = self.num_mc_clients
 
+        # the binary codec for the caches holding Things, listings, memoized
+        # results and comment trees. the others keep letting pylibmc pickle.
+        if self.cache_codec:
+            codec = ValueCodec(compress_threshold=50 * 1024)
+        else:
+            codec = None
+
+        # keys that get a huge share of the reads (rising, sup, front page
+        # listings...) are replicated across the servers of these pools
+        hot_keys = dict(
+            hot_key_replicas=self.hot_key_replicas,
+            hot_key_threshold=self.hot_key_threshold,
+            hot_key_ttl=self.hot_key_ttl,
+        )
+
         # the main memcache pool. used for most everything.
         self.memcache = CMemcache(
             self.memcaches,
             min_compress_len=50 * 1024,
             num_clients=num_mc_clients,
+            codec=codec,
+            **hot_keys
         )
 
         # a pool just used for @memoize results
@@ -441,6 +466,8 @@ class Globals(object):
             self.memoizecaches,
             min_compress_len=50 * 1024,
             num_clients=num_mc_clients,
+            codec=codec,
+            **hot_keys
         )
 
         # a smaller pool of caches used only for distributed locks.
@@ -455,7 +482,9 @@ class Globals(object):
         if self.permacache_memcaches:
             permacache_memcaches = CMemcache(self.permacache_memcaches,
                                              min_compress_len=50 * 1024,
-                                             num_clients=num_mc_clients)
+                                             num_clients=num_mc_clients,
+                                             codec=codec,
+                                             **hot_keys)
         else:
             permacache_memcaches = None
 
@@ -507,7 +536,8 @@ class Globals(object):
             'permacache',
             self.cassandra_pools[self.cassandra_default_pool],
             read_consistency_level=self.cassandra_rcl,
-            write_consistency_level=self.cassandra_wcl
+            write_consistency_level=self.cassandra_wcl,
+            codec=codec,
         )
 
         self.startup_timer.intermediate("cassandra")
@@ -615,12 +645,14 @@ class Globals(object):
 
         if self.log_start:
             self.log.error(
-                "%s:%s started %s at %s (took %.02fs)",
+                "%s:%s started %s at %s (took %.02fs: %s)",
                 self.reddit_host,
                 self.reddit_pid,
                 self.short_version,
                 datetime.now().strftime("%H:%M:%S"),
-                self.startup_timer.elapsed_seconds()
+                self.startup_timer.elapsed_seconds(),
+                " ".join("%s=%.02fs" % step
+                         for step in self.startup_timer.breakdown()),
             )
 
     def record_repo_version(self, repo_name, git_dir):
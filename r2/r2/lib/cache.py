@@ -20,13 +20,25 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from threading import local
+from datetime import datetime
+from threading import local, Lock
 from hashlib import md5
 import cPickle as pickle
 from copy import copy
+import heapq
+import random
+import struct
+import sys
+import time
+import zlib
 
 import pylibmc
 from _pylibmc import MemcachedError
+import pytz
+try:
+    import snappy
+except ImportError:
+    snappy = None
 
 from pycassa import ColumnFamily
 from pycassa.cassandra.ttypes import ConsistencyLevel
@@ -41,6 +53,409 @@ from r2.lib.sgm import sgm # get this into our namespace so that it's
 
 class NoneResult(object): pass
 
+
+class CodecError(Exception):
+    pass
+
+
+_len_struct = struct.Struct('<I')
+_int_struct = struct.Struct('<q')
+_int32_struct = struct.Struct('<i')
+_float_struct = struct.Struct('<d')
+_datetime_struct = struct.Struct('<HBBBBBI')
+
+
+class ValueCodec(object):
+    """A compact binary encoding for cached values.
+
+    The types that make up most of what we cache (the base props and data
+    dicts of Things, the (fullname, sort value...) tuple lists that
+    CachedResults keep in the permacache and the int lists and dicts of
+    comment trees) have their own type tags and are packed with struct in
+    bulk. Anything else is pickled inside the encoding.
+
+    Dicts are walked rather than pickled, so that the base props and data
+    of Things get the short encodings of their str keys and small ints.
+
+    Encoded values start with MAGIC and a version byte, so values written
+    before the codec was turned on (plain pickles) can still be read, and a
+    process that sees a version it doesn't know treats the value as a miss.
+
+    """
+
+    MAGIC = '\x00rc'
+    VERSION = 1
+    # prefixed to strs stored raw in memcache that could be mistaken for an
+    # encoding or for an escaped str
+    ESCAPE = '\x01'
+
+    COMPRESS_NONE = '\x00'
+    COMPRESS_ZLIB = '\x01'
+    COMPRESS_SNAPPY = '\x02'
+
+    # classes that are encoded with their _codec_getstate/_codec_setstate
+    # instead of being pickled, see register_type
+    _types = ()
+
+    def __init__(self, compress_threshold=50 * 1024, compression=None):
+        self.compress_threshold = compress_threshold
+        if compression is None:
+            compression = 'snappy' if snappy else 'zlib'
+        self.compression = compression
+        self.header = self.MAGIC + chr(self.VERSION)
+
+    @classmethod
+    def register_type(cls, type_):
+        cls._types += (type_,)
+        return type_
+
+    def encode(self, val):
+        """Return the encoding of val as a str."""
+        out = []
+        _encode(val, out, self._types)
+        body = ''.join(out)
+
+        flag = self.COMPRESS_NONE
+        if self.compress_threshold and len(body) >= self.compress_threshold:
+            if self.compression == 'snappy':
+                compressed = snappy.compress(body)
+                compressed_flag = self.COMPRESS_SNAPPY
+            else:
+                compressed = zlib.compress(body, 1)
+                compressed_flag = self.COMPRESS_ZLIB
+            if len(compressed) < len(body):
+                body, flag = compressed, compressed_flag
+
+        return self.header + flag + body
+
+    def decode(self, data):
+        """Decode a value written by encode, or a plain pickle."""
+        if not data.startswith(self.MAGIC):
+            return pickle.loads(data)
+
+        version, flag = data[3:5]
+        if ord(version) != self.VERSION:
+            raise CodecError("unknown codec version %d" % ord(version))
+
+        body = data[5:]
+        if flag == self.COMPRESS_SNAPPY:
+            if not snappy:
+                raise CodecError("snappy isn't installed")
+            body = snappy.decompress(body)
+        elif flag == self.COMPRESS_ZLIB:
+            body = zlib.decompress(body)
+        elif flag != self.COMPRESS_NONE:
+            raise CodecError("unknown compression %r" % flag)
+
+        try:
+            val, pos = _decode(body, 0)
+        except (IndexError, KeyError, struct.error), e:
+            raise CodecError("corrupt value: %r" % e)
+        return val
+
+    # memcached stores strs and ints itself and we rely on that for append
+    # and incr, so only other values go through the codec there. strs that
+    # are empty or start with MAGIC's or ESCAPE's first byte are stored with
+    # ESCAPE in front. appends never change the first byte of a value, so
+    # a str built up by them can't come to look like an encoding either.
+    def to_memcache(self, val):
+        if type(val) in (int, long, bool):
+            return val
+        if type(val) is str:
+            if val and val[0] != self.MAGIC[0] and val[0] != self.ESCAPE:
+                return val
+            return self.ESCAPE + val
+        return self.encode(val)
+
+    def from_memcache(self, val):
+        if type(val) is str:
+            if val.startswith(self.MAGIC):
+                return self.decode(val)
+            elif val.startswith(self.ESCAPE):
+                return val[1:]
+        return val
+
+
+# lists and tuples longer than this that don't have a packed encoding are
+# pickled whole, cPickle walks them faster than we can. dicts are walked up
+# to a bigger size, as most of them are the props of Things.
+_MAX_WALKED = 16
+_MAX_WALKED_DICT = 256
+
+_float_types = set([float])
+_int_types = set([int, long])
+
+
+def _encode(val, out, types):
+    t = type(val)
+
+    if val is None:
+        out.append('N')
+    elif t is bool:
+        out.append('T' if val else 'F')
+    elif t is int or t is long:
+        if 0 <= val < 256:
+            out.append('b' + chr(val))
+        elif -2 ** 31 <= val < 2 ** 31:
+            out.append('j' + _int32_struct.pack(val))
+        else:
+            try:
+                out.append('i' + _int_struct.pack(val))
+            except struct.error:
+                _encode_pickle(val, out)
+    elif t is float:
+        out.append('f' + _float_struct.pack(val))
+    elif t is str:
+        if len(val) < 256:
+            out.append('k' + chr(len(val)))
+        else:
+            out.append('s' + _len_struct.pack(len(val)))
+        out.append(val)
+    elif t is unicode:
+        s = val.encode('utf-8')
+        if len(s) < 256:
+            out.append('w' + chr(len(s)))
+        else:
+            out.append('u' + _len_struct.pack(len(s)))
+        out.append(s)
+    elif t is list or t is tuple:
+        if t is list and _encode_records(val, out):
+            pass
+        elif _encode_array(val, 'L' if t is list else 'U', out):
+            pass
+        elif len(val) <= _MAX_WALKED:
+            out.append(('l' if t is list else 't') +
+                       _len_struct.pack(len(val)))
+            for item in val:
+                _encode(item, out, types)
+        else:
+            _encode_pickle(val, out)
+    elif t is dict:
+        if _encode_int_dict(val, out):
+            pass
+        elif len(val) <= _MAX_WALKED_DICT:
+            out.append('d' + _len_struct.pack(len(val)))
+            for key, item in val.iteritems():
+                _encode(key, out, types)
+                _encode(item, out, types)
+        else:
+            _encode_pickle(val, out)
+    elif t is datetime and (val.tzinfo is None or val.tzinfo is pytz.utc):
+        out.append('D' if val.tzinfo is None else 'Z')
+        out.append(_datetime_struct.pack(val.year, val.month, val.day,
+                                         val.hour, val.minute, val.second,
+                                         val.microsecond))
+    elif val is NoneResult:
+        out.append('n')
+    elif types and isinstance(val, types):
+        name = '%s.%s' % (t.__module__, t.__name__)
+        out.append('O' + _len_struct.pack(len(name)) + name)
+        _encode(val._codec_getstate(), out, types)
+    else:
+        _encode_pickle(val, out)
+
+
+def _encode_pickle(val, out):
+    s = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+    out.append('P' + _len_struct.pack(len(s)))
+    out.append(s)
+
+
+def _pack_column(column):
+    """Return (struct code, packed str) for a sequence of numbers using the
+    narrowest code that holds them all, or None if it isn't one."""
+    types = set(map(type, column))
+    if types == _float_types:
+        code = 'd'
+    elif types <= _int_types:
+        low, high = min(column), max(column)
+        if low >= 0 and high < 2 ** 16:
+            code = 'H'
+        elif low >= -2 ** 31 and high < 2 ** 31:
+            code = 'i'
+        else:
+            code = 'q'
+    else:
+        return None
+
+    try:
+        return code, struct.pack('<%d%s' % (len(column), code), *column)
+    except struct.error:
+        return None
+
+
+def _unpack_column(code, count, data, pos):
+    fmt = '<%d%s' % (count, code)
+    return struct.unpack_from(fmt, data, pos), pos + struct.calcsize(fmt)
+
+
+def _encode_records(val, out):
+    """Pack a list of (str, number, number...) tuples, all with the same
+    shape, like the ones stored by CachedResults.
+
+    They're stored by column, so that both directions are done a column at a
+    time by zip and struct rather than by looping over the rows.
+
+    """
+    if not val or type(val[0]) is not tuple or len(val[0]) < 2:
+        return False
+    if len(set(map(type, val))) != 1 or len(set(map(len, val))) != 1:
+        return False
+
+    columns = zip(*val)
+    names = columns[0]
+    if set(map(type, names)) != set([str]):
+        return False
+    joined = '\x00'.join(names)
+    if joined.count('\x00') != len(names) - 1:
+        return False
+
+    packed = []
+    for column in columns[1:]:
+        column = _pack_column(column)
+        if not column:
+            return False
+        packed.append(column)
+
+    codes = ''.join(code for code, data in packed)
+    out.append('R' + _len_struct.pack(len(val)) + chr(len(codes)) + codes)
+    out.append(_len_struct.pack(len(joined)))
+    out.append(joined)
+    out.extend(data for code, data in packed)
+    return True
+
+
+def _encode_array(val, tag, out):
+    if not val:
+        return False
+    packed = _pack_column(val)
+    if not packed or packed[0] == 'd':
+        return False
+    code, data = packed
+    out.append(tag + _len_struct.pack(len(val)) + code)
+    out.append(data)
+    return True
+
+
+def _encode_int_dict(val, out):
+    if not val:
+        return False
+    keys = _pack_column(val.keys())
+    if not keys or keys[0] == 'd':
+        return False
+    values = _pack_column(val.values())
+    if not values or values[0] == 'd':
+        return False
+    out.append('M' + _len_struct.pack(len(val)) + keys[0] + values[0])
+    out.append(keys[1])
+    out.append(values[1])
+    return True
+
+
+_type_cache = {}
+
+def _find_type(name):
+    try:
+        return _type_cache[name]
+    except KeyError:
+        module_name, cls_name = name.rsplit('.', 1)
+        __import__(module_name)
+        cls = _type_cache[name] = getattr(sys.modules[module_name], cls_name)
+        return cls
+
+
+def _decode(data, pos):
+    tag = data[pos]
+    pos += 1
+
+    if tag == 'N':
+        return None, pos
+    elif tag == 'T':
+        return True, pos
+    elif tag == 'F':
+        return False, pos
+    elif tag == 'b':
+        return ord(data[pos]), pos + 1
+    elif tag == 'j':
+        return _int32_struct.unpack_from(data, pos)[0], pos + 4
+    elif tag == 'i':
+        return _int_struct.unpack_from(data, pos)[0], pos + 8
+    elif tag in 'kw':
+        length = ord(data[pos])
+        s = data[pos + 1:pos + 1 + length]
+        pos += 1 + length
+        return (s if tag == 'k' else s.decode('utf-8')), pos
+    elif tag == 'f':
+        return _float_struct.unpack_from(data, pos)[0], pos + 8
+    elif tag in 'suP':
+        length = _len_struct.unpack_from(data, pos)[0]
+        pos += 4
+        s = data[pos:pos + length]
+        pos += length
+        if tag == 's':
+            return s, pos
+        elif tag == 'u':
+            return s.decode('utf-8'), pos
+        else:
+            return pickle.loads(s), pos
+    elif tag in 'lt':
+        count = _len_struct.unpack_from(data, pos)[0]
+        pos += 4
+        items = []
+        for i in xrange(count):
+            item, pos = _decode(data, pos)
+            items.append(item)
+        return (items if tag == 'l' else tuple(items)), pos
+    elif tag == 'd':
+        count = _len_struct.unpack_from(data, pos)[0]
+        pos += 4
+        items = {}
+        for i in xrange(count):
+            key, pos = _decode(data, pos)
+            items[key], pos = _decode(data, pos)
+        return items, pos
+    elif tag in 'LU':
+        count = _len_struct.unpack_from(data, pos)[0]
+        items, pos = _unpack_column(data[pos + 4], count, data, pos + 5)
+        return (list(items) if tag == 'L' else items), pos
+    elif tag == 'M':
+        count = _len_struct.unpack_from(data, pos)[0]
+        key_code, value_code = data[pos + 4:pos + 6]
+        keys, pos = _unpack_column(key_code, count, data, pos + 6)
+        values, pos = _unpack_column(value_code, count, data, pos)
+        return dict(zip(keys, values)), pos
+    elif tag == 'R':
+        count = _len_struct.unpack_from(data, pos)[0]
+        width = ord(data[pos + 4])
+        codes = data[pos + 5:pos + 5 + width]
+        pos += 5 + width
+        length = _len_struct.unpack_from(data, pos)[0]
+        pos += 4
+        columns = [data[pos:pos + length].split('\x00')]
+        pos += length
+        for code in codes:
+            column, pos = _unpack_column(code, count, data, pos)
+            columns.append(column)
+        return zip(*columns), pos
+    elif tag in 'DZ':
+        fields = _datetime_struct.unpack_from(data, pos)
+        pos += _datetime_struct.size
+        tzinfo = pytz.utc if tag == 'Z' else None
+        return datetime(*fields, tzinfo=tzinfo), pos
+    elif tag == 'n':
+        return NoneResult, pos
+    elif tag == 'O':
+        length = _len_struct.unpack_from(data, pos)[0]
+        pos += 4
+        cls = _find_type(data[pos:pos + length])
+        state, pos = _decode(data, pos + length)
+        obj = cls.__new__(cls)
+        obj._codec_setstate(state)
+        return obj, pos
+    else:
+        raise CodecError("unknown type tag %r" % tag)
+
+
 class CacheUtils(object):
     # Caches that never expire entries should set this to true, so that
     # CacheChain can properly count hits and misses.
@@ -90,6 +505,72 @@ class PyMemcache(CacheUtils, memcache.Client):
         memcache.Client.delete_multi(self, keys, time = time,
                                      key_prefix = prefix)
 
+class HotKeyTracker(object):
+    """Find the keys this process reads far more than others.
+
+    A sample of reads is counted, and at the end of each window the keys
+    whose estimated read rate is over `threshold` reads per second (at most
+    `max_hot` of them) become the hot keys for the next window.
+
+    """
+
+    def __init__(self, threshold, sample_rate=0.01, window=60, max_hot=100):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.window = window
+        self.max_hot = max_hot
+        self.hot = {}
+        self.counts = {}
+        self.window_start = time.time()
+        self.replica_reads = {}
+        self.backfills = {}
+        self.lock = Lock()
+
+    def record(self, keys):
+        if random.random() >= self.sample_rate:
+            return
+
+        counts = self.counts
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+        now = time.time()
+        if now - self.window_start >= self.window:
+            self._rotate(now)
+
+    def _rotate(self, now):
+        with self.lock:
+            elapsed = now - self.window_start
+            if elapsed < self.window:
+                return
+            counts, self.counts = self.counts, {}
+            self.window_start = now
+
+        scale = 1. / (self.sample_rate * elapsed)
+        min_count = self.threshold / scale
+        candidates = ((count, key) for key, count in counts.iteritems()
+                      if count >= min_count)
+        hot = heapq.nlargest(self.max_hot, candidates)
+        self.hot = dict((key, count * scale) for count, key in hot)
+        self.replica_reads = {}
+        self.backfills = {}
+
+    def is_hot(self, key):
+        return key in self.hot
+
+    def stats(self):
+        return {
+            'window': self.window,
+            'threshold': self.threshold,
+            'sample_rate': self.sample_rate,
+            'hot': dict((key, {
+                'reads_per_sec': round(rate, 1),
+                'replica_reads': self.replica_reads.get(key, 0),
+                'backfills': self.backfills.get(key, 0),
+            }) for key, rate in self.hot.items()),
+        }
+
+
 class CMemcache(CacheUtils):
     def __init__(self,
                  servers,
@@ -97,9 +578,14 @@ class CMemcache(CacheUtils):
                  noreply = False,
                  no_block = False,
                  min_compress_len=512 * 1024,
-                 num_clients = 10):
+                 num_clients = 10,
+                 codec=None,
+                 hot_key_replicas=0,
+                 hot_key_threshold=50,
+                 hot_key_ttl=10):
         self.servers = servers
         self.clients = pylibmc.ClientPool(n_slots = num_clients)
+        self._all_clients = []
         for x in xrange(num_clients):
             client = pylibmc.Client(servers, binary=True)
             behaviors = {
@@ -111,19 +597,182 @@ class CMemcache(CacheUtils):
 
             client.behaviors.update(behaviors)
             self.clients.put(client)
+            self._all_clients.append(client)
 
         self.min_compress_len = min_compress_len
+        # a ValueCodec to encode values with instead of letting pylibmc
+        # pickle them, it handles compression of the values it encodes
+        self.codec = codec
+
+        # keys this process finds hot are copied to hot_key_replicas - 1 more
+        # keys, which ketama puts on other servers, and reads of them are
+        # spread over the copies. another process may not think a key is hot
+        # and so only write the original, so the copies are kept for just
+        # hot_key_ttl seconds to bound how stale they can be.
+        self.hot_key_replicas = hot_key_replicas
+        self.hot_key_ttl = hot_key_ttl
+        if hot_key_replicas > 1:
+            self.hot_keys = HotKeyTracker(hot_key_threshold)
+        else:
+            self.hot_keys = None
+
+    def disconnect_all(self):
+        """Close every client's connections; they reconnect when they're
+        next used. Like db_manager.dispose, do this before fork()ing."""
+        for client in self._all_clients:
+            client.disconnect_all()
+
+    def _encode(self, val):
+        """Return (value to store, min_compress_len to store it with)."""
+        if not self.codec:
+            return val, self.min_compress_len
+        encoded = self.codec.to_memcache(val)
+        if encoded is val:
+            return val, self.min_compress_len
+        return encoded, 0
+
+    def _decode_multi(self, results):
+        if self.codec:
+            for key, val in results.items():
+                try:
+                    results[key] = self.codec.from_memcache(val)
+                except CodecError:
+                    # treat values we can't read as misses
+                    del results[key]
+        return results
+
+    def _decode(self, ret, default=None):
+        if ret is None:
+            return default
+        if self.codec:
+            try:
+                return self.codec.from_memcache(ret)
+            except CodecError:
+                return default
+        return ret
+
+    def _replica_key(self, key, replica):
+        if replica == 0:
+            return key
+        replica_key = '%s:hot%d' % (key, replica)
+        # memcached's key length limit
+        if len(replica_key) > 250:
+            return key
+        return replica_key
+
+    def _replica_keys(self, key):
+        replicas = set(self._replica_key(key, i)
+                       for i in xrange(1, self.hot_key_replicas))
+        replicas.discard(key)
+        return replicas
+
+    def _hot(self, keys):
+        if not self.hot_keys.hot:
+            return []
+        return [key for key in keys if self.hot_keys.is_hot(key)]
+
+    def _drop_replicas(self, keys):
+        """Delete the copies of `keys` (already prefixed), for writes that
+        we can't just repeat on the copies. Any process that thinks a key
+        is hot may have copied it, so this is done whether or not we do."""
+        if not self.hot_keys:
+            return
+        replicas = [replica for key in keys
+                    for replica in self._replica_keys(key)]
+        if replicas:
+            with self.clients.reserve() as mc:
+                mc.delete_multi(replicas)
+
+    def _write_replicas(self, values, time=0, min_compress_len=0):
+        """Copy {prefixed key: value to store} to the replicas of those keys
+        that are hot, and delete the replicas of the rest."""
+        if not self.hot_keys:
+            return
+        hot = set(self._hot(values))
+        self._drop_replicas(key for key in values if key not in hot)
+        if not hot:
+            return
+
+        if time:
+            time = min(time, self.hot_key_ttl)
+        else:
+            time = self.hot_key_ttl
+        replicas = dict((replica, values[key]) for key in hot
+                        for replica in self._replica_keys(key))
+        if replicas:
+            with self.clients.reserve() as mc:
+                mc.set_multi(replicas, time=time,
+                             min_compress_len=min_compress_len)
+
+    def _get_multi_hot(self, keys):
+        """Fetch raw values for the (prefixed) keys, reading the hot ones
+        from a random one of their copies."""
+        fetch = {}
+        for key in keys:
+            if self.hot_keys.is_hot(key):
+                replica = random.randrange(self.hot_key_replicas)
+                fetch[self._replica_key(key, replica)] = key
+            else:
+                fetch[key] = key
+
+        with self.clients.reserve() as mc:
+            found = mc.get_multi(fetch.keys())
+
+            results = {}
+            missed = {}
+            for fetched, key in fetch.iteritems():
+                if fetched in found:
+                    results[key] = found[fetched]
+                    if fetched != key:
+                        reads = self.hot_keys.replica_reads
+                        reads[key] = reads.get(key, 0) + 1
+                elif fetched != key:
+                    missed[key] = fetched
+
+            # copies that have expired (or were never written) are filled in
+            # from the original
+            if missed:
+                originals = mc.get_multi(missed.keys())
+                results.update(originals)
+                if originals:
+                    # the codec's output is already compressed if it's
+                    # worth compressing
+                    compress_len = 0 if self.codec else self.min_compress_len
+                    mc.set_multi(dict((missed[key], val)
+                                      for key, val in originals.iteritems()),
+                                 time=self.hot_key_ttl,
+                                 min_compress_len=compress_len)
+                    backfills = self.hot_keys.backfills
+                    for key in originals:
+                        backfills[key] = backfills.get(key, 0) + 1
+
+        return results
+
+    # pass replicas=False to read the original of a hot key rather than
+    # one of its copies, for a read that needs the latest value
+    def get(self, key, default = None, replicas = True):
+        if self.hot_keys and replicas:
+            self.hot_keys.record((key,))
+            if self.hot_keys.is_hot(key):
+                ret = self._get_multi_hot([key]).get(key)
+                return self._decode(ret, default)
 
-    def get(self, key, default = None):
         with self.clients.reserve() as mc:
             ret =  mc.get(key)
-            if ret is None:
-                return default
-            return ret
+        return self._decode(ret, default)
+
+    def get_multi(self, keys, prefix = '', replicas = True):
+        if self.hot_keys and replicas:
+            self.hot_keys.record(prefix + str(key) for key in keys)
+            if self._hot(prefix + str(key) for key in keys):
+                raw = self._get_multi_hot([prefix + str(key) for key in keys])
+                results = dict((key[len(prefix):], val)
+                               for key, val in raw.iteritems())
+                return self._decode_multi(results)
 
-    def get_multi(self, keys, prefix = ''):
         with self.clients.reserve() as mc:
-            return mc.get_multi(keys, key_prefix = prefix)
+            results = mc.get_multi(keys, key_prefix = prefix)
+        return self._decode_multi(results)
 
     # simple_get_multi exists so that a cache chain can
     # single-instance the handling of prefixes for performance, but
@@ -133,57 +782,98 @@ class CMemcache(CacheUtils):
     # them, so here it is
     simple_get_multi = get_multi
 
+    def hot_key_stats(self):
+        if not self.hot_keys:
+            return None
+        stats = self.hot_keys.stats()
+        stats['replicas'] = self.hot_key_replicas
+        stats['replica_ttl'] = self.hot_key_ttl
+        return stats
+
     def set(self, key, val, time = 0):
+        val, min_compress_len = self._encode(val)
         with self.clients.reserve() as mc:
-            return mc.set(key, val, time = time,
-                          min_compress_len = self.min_compress_len)
+            ret = mc.set(key, val, time = time,
+                         min_compress_len = min_compress_len)
+        self._write_replicas({key: val}, time=time,
+                             min_compress_len=min_compress_len)
+        return ret
 
     def set_multi(self, keys, prefix='', time=0):
-        new_keys = {}
+        # values the codec encoded are already compressed if they're worth
+        # compressing, so they're sent separately from any it didn't
+        by_compress_len = {}
         for k,v in keys.iteritems():
-            new_keys[str(k)] = v
+            v, min_compress_len = self._encode(v)
+            by_compress_len.setdefault(min_compress_len, {})[str(k)] = v
+
+        failed = []
         with self.clients.reserve() as mc:
-            return mc.set_multi(new_keys, key_prefix = prefix,
-                                time = time,
-                                min_compress_len = self.min_compress_len)
+            for compress_len, new_keys in by_compress_len.iteritems():
+                failed.extend(mc.set_multi(new_keys, key_prefix = prefix,
+                                           time = time,
+                                           min_compress_len = compress_len))
+
+        if self.hot_keys:
+            for compress_len, new_keys in by_compress_len.iteritems():
+                self._write_replicas(dict((prefix + k, v)
+                                          for k, v in new_keys.iteritems()),
+                                     time=time, min_compress_len=compress_len)
+        return failed
 
     def add_multi(self, keys, prefix='', time=0):
         new_keys = {}
         for k,v in keys.iteritems():
-            new_keys[str(k)] = v
+            new_keys[str(k)] = self._encode(v)[0]
         with self.clients.reserve() as mc:
-            return mc.add_multi(new_keys, key_prefix = prefix,
-                                time = time)
+            ret = mc.add_multi(new_keys, key_prefix = prefix,
+                               time = time)
+        self._drop_replicas(prefix + k for k in new_keys)
+        return ret
 
     def incr_multi(self, keys, prefix='', delta=1):
+        keys = map(str, keys)
         with self.clients.reserve() as mc:
-            return mc.incr_multi(map(str, keys),
-                                 key_prefix = prefix,
-                                 delta=delta)
+            ret = mc.incr_multi(keys,
+                                key_prefix = prefix,
+                                delta=delta)
+        self._drop_replicas(prefix + k for k in keys)
+        return ret
 
     def append(self, key, val, time=0):
         with self.clients.reserve() as mc:
-            return mc.append(key, val, time=time)
+            ret = mc.append(key, val, time=time)
+        self._drop_replicas((key,))
+        return ret
 
     def incr(self, key, delta=1, time=0):
         # ignore the time on these
         with self.clients.reserve() as mc:
-            return mc.incr(key, delta)
+            ret = mc.incr(key, delta)
+        self._drop_replicas((key,))
+        return ret
 
     def add(self, key, val, time=0):
+        val = self._encode(val)[0]
         try:
             with self.clients.reserve() as mc:
-                return mc.add(key, val, time=time)
+                ret = mc.add(key, val, time=time)
         except pylibmc.DataExists:
             return None
+        self._drop_replicas((key,))
+        return ret
 
     def delete(self, key, time=0):
         with self.clients.reserve() as mc:
-            return mc.delete(key)
+            ret = mc.delete(key)
+        self._drop_replicas((key,))
+        return ret
 
     def delete_multi(self, keys, prefix=''):
         with self.clients.reserve() as mc:
-            return mc.delete_multi(keys, key_prefix=prefix)
+            ret = mc.delete_multi(keys, key_prefix=prefix)
+        self._drop_replicas(prefix + str(k) for k in keys)
+        return ret
 
     def __repr__(self):
         return '<%s(%r)>' % (self.__class__.__name__,
@@ -221,7 +911,7 @@ class HardCache(CacheUtils):
 
         for category in category_bundles:
             idses = category_bundles[category]
-            chunks = in_chunks(idses, size=50)
+            chunks = in_chunks(idses, size=500)
             for chunk in chunks:
                 new_results = self.backend.get_multi(category, chunk)
                 results.update(new_results)
@@ -229,9 +919,15 @@ class HardCache(CacheUtils):
         return results
 
     def set_multi(self, keys, prefix='', time=0):
+        category_bundles = {}
         for k,v in keys.iteritems():
             if v != NoneResult:
-                self.set(prefix+str(k), v, time=time)
+                category, ids = self._split_key(prefix+str(k))
+                category_bundles.setdefault(category, {})[ids] = v
+
+        for category, vals in category_bundles.iteritems():
+            for chunk in in_chunks(vals.items(), size=500):
+                self.backend.set_multi(category, dict(chunk), time)
 
     def get(self, key, default=None):
         category, ids = self._split_key(key)
@@ -253,6 +949,24 @@ class HardCache(CacheUtils):
         category, ids = self._split_key(key)
         return self.backend.incr(category, ids, delta=delta, time=time)
 
+    def incr_multi(self, keys, delta=1, prefix='', time=0):
+        """Returns a dict of keys (without the prefix) to their new values,
+        leaving out keys that weren't incremented."""
+        category_bundles = {}
+        for key in keys:
+            category, ids = self._split_key(prefix + key)
+            category_bundles.setdefault(category, {})[ids] = key
+
+        results = {}
+        for category, keys_by_ids in category_bundles.iteritems():
+            for chunk in in_chunks(keys_by_ids.keys(), size=500):
+                new_results = self.backend.incr_multi(category, chunk, time,
+                                                      delta=delta)
+                for ids, value in new_results.iteritems():
+                    results[keys_by_ids[ids]] = value
+
+        return results
+
 
 class LocalCache(dict, CacheUtils):
     def __init__(self, *a, **kw):
@@ -368,7 +1082,11 @@ class CacheChain(CacheUtils, local):
                 if not allow_local and isinstance(c,LocalCache):
                     continue
 
-                val = c.get(key)
+                if not allow_local and isinstance(c, CMemcache):
+                    # nor a possibly stale copy of a hot key
+                    val = c.get(key, replicas=False)
+                else:
+                    val = c.get(key)
 
                 if val is not None:
                     if not c.permanent:
@@ -418,7 +1136,10 @@ class CacheChain(CacheUtils, local):
             if len(out) == len(keys):
                 # we've found them all
                 break
-            r = c.simple_get_multi(need)
+            if not allow_local and isinstance(c, CMemcache):
+                r = c.simple_get_multi(need, replicas=False)
+            else:
+                r = c.simple_get_multi(need)
             #update other caches
             if r:
                 if not c.permanent:
@@ -653,7 +1374,7 @@ class CassandraCacheChain(CacheChain):
                                            columns=['value']),
                               chunk_size):
             print rows[0][0]
-            rows = dict((key, pickle.loads(cols['value']))
+            rows = dict((key, self.cassa._loads(cols['value']))
                         for (key, cols)
                         in rows
                         if (cols
@@ -669,7 +1390,8 @@ class CassandraCache(CacheUtils):
        column-name 'value'"""
     def __init__(self, column_family, client,
                  read_consistency_level = CL_ONE,
-                 write_consistency_level = CL_QUORUM):
+                 write_consistency_level = CL_QUORUM,
+                 codec=None):
         self.column_family = column_family
         self.client = client
         self.read_consistency_level = read_consistency_level
@@ -678,6 +1400,18 @@ class CassandraCache(CacheUtils):
                                self.column_family,
                                read_consistency_level = read_consistency_level,
                                write_consistency_level = write_consistency_level)
+        # values written by the codec are still read fine after it's turned
+        # off, as are pickles after it's turned on
+        self.codec = codec or ValueCodec()
+        self.use_codec = codec is not None
+
+    def _dumps(self, val):
+        if self.use_codec:
+            return self.codec.encode(val)
+        return pickle.dumps(val)
+
+    def _loads(self, data):
+        return self.codec.decode(data)
 
     def _rcl(self, alternative):
         return (alternative if alternative is not None
@@ -692,8 +1426,8 @@ class CassandraCache(CacheUtils):
             rcl = self._rcl(read_consistency_level)
             row = self.cf.get(key, columns=['value'],
                               read_consistency_level = rcl)
-            return pickle.loads(row['value'])
-        except (CassandraNotFound, KeyError):
+            return self._loads(row['value'])
+        except (CassandraNotFound, KeyError, CodecError):
             return default
 
     def simple_get_multi(self, keys, read_consistency_level = None):
@@ -701,8 +1435,13 @@ class CassandraCache(CacheUtils):
         rows = self.cf.multiget(list(keys),
                                 columns=['value'],
                                 read_consistency_level = rcl)
-        return dict((key, pickle.loads(row['value']))
-                    for (key, row) in rows.iteritems())
+        ret = {}
+        for key, row in rows.iteritems():
+            try:
+                ret[key] = self._loads(row['value'])
+            except CodecError:
+                pass
+        return ret
 
     def set(self, key, val,
             write_consistency_level = None,
@@ -712,7 +1451,7 @@ class CassandraCache(CacheUtils):
             return
 
         wcl = self._wcl(write_consistency_level)
-        ret = self.cf.insert(key, {'value': pickle.dumps(val)},
+        ret = self.cf.insert(key, {'value': self._dumps(val)},
                               write_consistency_level = wcl,
                              ttl = time)
         self._warm([key])
@@ -732,7 +1471,7 @@ class CassandraCache(CacheUtils):
             for key, val in keys.iteritems():
                 if val != NoneResult:
                     ret[key] = self.cf.insert('%s%s' % (prefix, key),
-                                              {'value': pickle.dumps(val)},
+                                              {'value': self._dumps(val)},
                                               ttl = time)
 
         self._warm(keys.keys())
@@ -883,3 +1622,104 @@ def test_stale():
     assert len(ca.localcache) == 0
     assert ca.get_multi(['foo'], stale=False) == {'foo': 'baz'}
     ca.localcache.clear()
+
+def _codec_sample_values(count):
+    """Build values shaped like the ones in our caches: Things, listings,
+    comment trees and memoized id lists."""
+    from r2.models import Account, Link
+
+    now = time.time()
+    values = {}
+
+    for i in xrange(count):
+        link = Link(ups=random.randint(1, 5000), downs=random.randint(0, 500),
+                    id=100000 + i, url='http://example.com/%d' % i,
+                    title=u'link number %d' % i, sr_id=i % 50,
+                    author_id=i % 1000, domain='example.com', selftext='',
+                    is_self=False, over_18=False, num_comments=i % 300)
+        link._loaded = True
+        values['Link_%d' % link._id] = link
+
+        account = Account(id=200000 + i, name='user%d' % i,
+                          link_karma=random.randint(0, 10 ** 5),
+                          comment_karma=random.randint(0, 10 ** 5),
+                          pref_numsites=25, pref_lang='en')
+        account._loaded = True
+        values['Account_%d' % account._id] = account
+
+    for i in xrange(count):
+        values['hot_%d' % i] = [
+            ('t3_%x' % (j + i), random.uniform(1000, 5000), now - j * 60.0)
+            for j in xrange(1000)]
+        values['top_%d' % i] = [('t3_%x' % (j + i), random.randint(1, 50000),
+                                 now - j * 60.0)
+                                for j in xrange(1000)]
+
+        cids = range(i * 1000, i * 1000 + 500)
+        tree = {None: cids[:50]}
+        for cid in cids[50:]:
+            tree.setdefault(random.choice(cids[:50]), []).append(cid)
+        depth = dict((cid, 0 if cid in tree[None] else 1) for cid in cids)
+        num_children = dict((cid, len(tree.get(cid, ()))) for cid in cids)
+        values['comments_%d' % i] = (cids, tree, depth, num_children)
+
+        values['memoize_%d' % i] = range(i, i + 100)
+        values['memoize_none_%d' % i] = NoneResult
+
+    return values
+
+
+def benchmark_codec(keys=None, count=100, repeat=5):
+    """Compare pickle (and zlib, as pylibmc does over 50KB) with the
+    ValueCodec on values captured from the permacache and cache with `keys`,
+    or on generated values shaped like them if no keys are given."""
+    from pylons import g
+
+    if keys:
+        values = g.permacache.get_multi(keys)
+        values.update(g.cache.get_multi(keys))
+    else:
+        values = _codec_sample_values(count)
+
+    def comparable(val):
+        if isinstance(val, ValueCodec._types):
+            return val._codec_getstate()
+        elif isinstance(val, list):
+            return map(comparable, val)
+        return val
+
+    codec = ValueCodec(compress_threshold=50 * 1024)
+
+    def pickle_dumps(val):
+        data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= 50 * 1024:
+            data = zlib.compress(data)
+        return data
+
+    def pickle_loads(data):
+        if not data.startswith('\x80'):
+            data = zlib.decompress(data)
+        return pickle.loads(data)
+
+    kinds = {}
+    for key, val in values.iteritems():
+        kinds.setdefault(key.split('_')[0], []).append(val)
+
+    for kind, vals in sorted(kinds.iteritems()):
+        for name, dumps, loads in (('pickle', pickle_dumps, pickle_loads),
+                                   ('codec', codec.encode, codec.decode)):
+            start = time.time()
+            for i in xrange(repeat):
+                encoded = map(dumps, vals)
+            dumps_secs = (time.time() - start) / repeat
+
+            start = time.time()
+            for i in xrange(repeat):
+                decoded = map(loads, encoded)
+            loads_secs = (time.time() - start) / repeat
+
+            assert map(comparable, decoded) == map(comparable, vals), \
+                "%s values don't round trip through %s" % (kind, name)
+            print ("%-10s %-6s %6d values %9d bytes  dumps %.4fs  loads %.4fs"
+                   % (kind, name, len(vals), sum(map(len, encoded)),
+                      dumps_secs, loads_secs))
@@ -22,11 +22,15 @@
 
 import collections
 import cPickle as pickle
+import cStringIO
 from datetime import datetime, timedelta
+import errno
 import functools
 import httplib
 import json
 from lxml import etree
+import multiprocessing
+import os
 from pylons import g, c
 import re
 import time
@@ -44,6 +48,12 @@ from r2.models import (Account, Link, Subreddit, Thing, All, DefaultSR,
 
 
 _CHUNK_SIZE = 4000000 # Approx. 4 MB, to stay under the 5MB limit
+_BATCH_PATH = "/2011-02-01/documents/batch"
+_BATCH_OPEN = "<batch>"
+_BATCH_CLOSE = "</batch>"
+# reconnect rather than risk reusing a connection the other end has
+# given up on
+_KEEPALIVE_IDLE = 30
 _VERSION_OFFSET = 13257906857
 ILLEGAL_XML = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
 
@@ -334,6 +344,8 @@ class CloudSearchUploader(object):
         self.doc_api = doc_api
         self._version_offset = version_offset
         self.things = self.desired_things(things) if things else []
+        self._connection = None
+        self._last_used = 0
 
     @classmethod
     def desired_fullnames(cls, items):
@@ -391,9 +403,7 @@ class CloudSearchUploader(object):
         version = self._version()
         deletes = [etree.Element("delete", id=id_, version=str(version))
                    for id_ in ids]
-        batch = etree.Element("batch")
-        batch.extend(deletes)
-        return self.send_documents(batch)
+        return self.send_documents(deletes)
 
     def xml_from_things(self):
         '''Generate a <batch> XML tree to send to cloudsearch for
@@ -401,16 +411,22 @@ class CloudSearchUploader(object):
         
         '''
         batch = etree.Element("batch")
+        batch.extend(self.documents())
+        return batch
+
+    def documents(self):
+        '''Yield the add and delete elements for the given things one at a
+        time, so that they can be serialized as they're built
+        
+        '''
         self.batch_lookups()
         version = self._version()
         for thing in self.things:
             try:
                 if thing._spam or thing._deleted:
-                    delete_node = self.delete_xml(thing, version)
-                    batch.append(delete_node)
+                    yield self.delete_xml(thing, version)
                 elif self.should_index(thing):
-                    add_node = self.add_xml(thing, version)
-                    batch.append(add_node)
+                    yield self.add_xml(thing, version)
             except (AttributeError, KeyError) as e:
                 # Problem! Bail out, which means these items won't get
                 # "consumed" from the queue. If the problem is from DB
@@ -423,7 +439,6 @@ class CloudSearchUploader(object):
                 else:
                     g.log.warning("Ignoring problem on thing %r.\n\n%r",
                                   thing, e)
-        return batch
 
     def should_index(self, thing):
         raise NotImplementedError
@@ -439,41 +454,64 @@ class CloudSearchUploader(object):
         of the communication with the cloudsearch endpoint
         
         '''
-        xml_things = self.xml_from_things()
-
         cs_start = datetime.now(g.tz)
-        if len(xml_things):
-            sent = self.send_documents(xml_things)
-            if not quiet:
-                print sent
+        sent = self.send_documents(self.documents())
+        if sent and not quiet:
+            print sent
         return (datetime.now(g.tz) - cs_start).total_seconds()
 
+    def _get_connection(self):
+        now = time.time()
+        if (self._connection is not None and
+            now - self._last_used > _KEEPALIVE_IDLE):
+            self.close()
+        if self._connection is None:
+            self._connection = httplib.HTTPConnection(self.doc_api, 80)
+        self._last_used = now
+        return self._connection
+
+    def close(self):
+        '''Close the keep-alive connection to the cloudsearch endpoint, if
+        one is open'''
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _read_response(self, connection):
+        response = connection.getresponse()
+        # always read the body, or the connection can't be reused
+        body = response.read()
+        self._last_used = time.time()
+        if not 200 <= response.status < 300:
+            raise CloudSearchHTTPError(response.status, response.reason, body)
+        return body
+
     def send_documents(self, docs):
-        '''Open a connection to the cloudsearch endpoint, and send the documents
-        for indexing. Multiple requests are sent if a large number of documents
-        are being sent (see chunk_xml())
+        '''Send the documents (an iterable of add/delete elements) for
+        indexing over a keep-alive connection to the cloudsearch endpoint.
+        Multiple requests are sent if a large number of documents are being
+        sent (see chunk_xml()), and each chunk is serialized while the
+        previous one is still being processed by the endpoint.
         
         Raises CloudSearchHTTPError if the endpoint indicates a failure
         '''
         responses = []
-        connection = httplib.HTTPConnection(self.doc_api, 80)
-        chunker = chunk_xml(docs)
+        headers = {'Content-Type': 'application/xml'}
+        connection = self._get_connection()
+        in_flight = False
         try:
-            for data in chunker:
-                headers = {}
-                headers['Content-Type'] = 'application/xml'
+            for data in chunk_xml(docs):
+                if in_flight:
+                    responses.append(self._read_response(connection))
                 # HTTPLib calculates Content-Length header automatically
-                connection.request('POST', "/2011-02-01/documents/batch",
-                                   data, headers)
-                response = connection.getresponse()
-                if 200 <= response.status < 300:
-                    responses.append(response.read())
-                else:
-                    raise CloudSearchHTTPError(response.status,
-                                               response.reason,
-                                               response.read())
-        finally:
-            connection.close()
+                connection.request('POST', _BATCH_PATH, data, headers)
+                in_flight = True
+            if in_flight:
+                responses.append(self._read_response(connection))
+        except:
+            # whatever state the connection is in, don't reuse it
+            self.close()
+            raise
         return responses
 
 
@@ -530,31 +568,34 @@ class SubredditUploader(CloudSearchUploader):
         return getattr(thing, 'author_id', None) != -1
 
 
-def chunk_xml(xml, depth=0):
-    '''Chunk POST data into pieces that are smaller than the 20 MB limit.
+def chunk_xml(docs, chunk_size=_CHUNK_SIZE):
+    '''Serialize docs (an iterable of add/delete elements, or a <batch>)
+    into <batch> POST bodies that are smaller than chunk_size.
     
-    Ideally, this never happens (if chunking is necessary, would be better
-    to avoid xml'ifying before testing content_length)'''
-    data = etree.tostring(xml)
-    content_length = len(data)
-    if content_length < _CHUNK_SIZE:
-        yield data
-    else:
-        depth += 1
-        print "WARNING: Chunking (depth=%s)" % depth
-        half = len(xml) / 2
-        left_half = xml # for ease of reading
-        right_half = etree.Element("batch")
-        # etree magic simultaneously removes the elements from one tree
-        # when they are appended to a different tree
-        right_half.append(xml[half:])
-        for chunk in chunk_xml(left_half, depth=depth):
-            yield chunk
-        for chunk in chunk_xml(right_half, depth=depth):
-            yield chunk
-
-
-def _run_changed(msgs, chan):
+    Each element is serialized exactly once, into a buffer whose size is
+    tracked as it grows, and a chunk is cut before the element that would
+    take it over the limit. A single element that's over the limit on its
+    own is still sent, alone.'''
+    overhead = len(_BATCH_OPEN) + len(_BATCH_CLOSE)
+    buf = cStringIO.StringIO()
+    for doc in docs:
+        data = etree.tostring(doc)
+        if buf.tell() and buf.tell() + len(data) + overhead > chunk_size:
+            yield _BATCH_OPEN + buf.getvalue() + _BATCH_CLOSE
+            buf = cStringIO.StringIO()
+        if len(data) + overhead > chunk_size:
+            g.log.warning("Sending a %d byte document on its own", len(data))
+        buf.write(data)
+    if buf.tell():
+        yield _BATCH_OPEN + buf.getvalue() + _BATCH_CLOSE
+
+
+def _cloudsearch_uploaders(things):
+    return [LinkUploader(g.CLOUDSEARCH_DOC_API, things=things),
+            SubredditUploader(g.CLOUDSEARCH_SUBREDDIT_DOC_API, things=things)]
+
+
+def _run_changed(msgs, chan, make_uploaders=_cloudsearch_uploaders):
     '''Consume the cloudsearch_changes queue, and print reporting information
     on how long it took and how many remain
     
@@ -568,13 +609,12 @@ def _run_changed(msgs, chan):
     fullnames.update(SubredditUploader.desired_fullnames(changed))
     things = Thing._by_fullname(fullnames, data=True, return_dict=False)
 
-    link_uploader = LinkUploader(g.CLOUDSEARCH_DOC_API, things=things)
-    subreddit_uploader = SubredditUploader(g.CLOUDSEARCH_SUBREDDIT_DOC_API,
-                                           things=things)
-
-    link_time = link_uploader.inject()
-    subreddit_time = subreddit_uploader.inject()
-    cloudsearch_time = link_time + subreddit_time
+    uploaders = make_uploaders(things)
+    try:
+        cloudsearch_time = sum(uploader.inject() for uploader in uploaders)
+    finally:
+        for uploader in uploaders:
+            uploader.close()
 
     totaltime = (datetime.now(g.tz) - start).total_seconds()
 
@@ -586,14 +626,16 @@ def _run_changed(msgs, chan):
 
 
 def run_changed(drain=False, min_size=500, limit=1000, sleep_time=10,
-                use_safe_get=False, verbose=False):
+                use_safe_get=False, verbose=False,
+                make_uploaders=_cloudsearch_uploaders):
     '''Run by `cron` (through `paster run`) on a schedule to send Things to
         Amazon CloudSearch
     
     '''
     if use_safe_get:
         CloudSearchUploader.use_safe_get = True
-    amqp.handle_items('cloudsearch_changes', _run_changed, min_size=min_size,
+    callback = functools.partial(_run_changed, make_uploaders=make_uploaders)
+    amqp.handle_items('cloudsearch_changes', callback, min_size=min_size,
                       limit=limit, drain=drain, sleep_time=sleep_time,
                       verbose=verbose)
 
@@ -627,22 +669,25 @@ def rebuild_link_index(start_at=None, sleeptime=1, cls=Link,
     q = r2utils.fetch_things2(q, chunk_size=chunk_size)
     q = r2utils.progress(q, verbosity=1000, estimate=estimate, persec=True,
                          key=_progress_key)
-    for chunk in r2utils.in_chunks(q, size=chunk_size):
-        uploader.things = chunk
-        for x in range(5):
-            try:
-                uploader.inject()
-            except httplib.HTTPException as err:
-                print "Got %s, sleeping %s secs" % (err, x)
-                time.sleep(x)
-                continue
+    try:
+        for chunk in r2utils.in_chunks(q, size=chunk_size):
+            uploader.things = chunk
+            for x in range(5):
+                try:
+                    uploader.inject()
+                except httplib.HTTPException as err:
+                    print "Got %s, sleeping %s secs" % (err, x)
+                    time.sleep(x)
+                    continue
+                else:
+                    break
             else:
-                break
-        else:
-            raise err
-        last_update = chunk[-1]
-        g.cache.set(cache_key, last_update._fullname)
-        time.sleep(sleeptime)
+                raise err
+            last_update = chunk[-1]
+            g.cache.set(cache_key, last_update._fullname)
+            time.sleep(sleeptime)
+    finally:
+        uploader.close()
 
 
 rebuild_subreddit_index = functools.partial(rebuild_link_index,
@@ -653,6 +698,183 @@ rebuild_subreddit_index = functools.partial(rebuild_link_index,
                                             chunk_size=1000)
 
 
+def _inject_with_retries(uploader, tries=5):
+    for x in range(tries):
+        try:
+            return uploader.inject(quiet=True)
+        except httplib.HTTPException as err:
+            print "Got %s, sleeping %s secs" % (err, x)
+            time.sleep(x)
+    raise err
+
+
+_REBUILD_CHECKPOINT_KEY = "cloudsearch_rebuild-%s-%d-%d"
+# the ranges are cut from the newest _id when the rebuild started, which is
+# kept with the checkpoints so that a rerun cuts the same ones
+_REBUILD_MAX_ID_KEY = "cloudsearch_rebuild-%s-max_id"
+_REBUILD_CHECKPOINT_TTL = 30 * 86400
+
+
+def _load_checkpoint(checkpoint_dir, key):
+    if not checkpoint_dir:
+        return g.hardcache.get(key)
+    try:
+        with open(os.path.join(checkpoint_dir, key)) as f:
+            return int(f.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+
+def _save_checkpoint(checkpoint_dir, key, value):
+    if not checkpoint_dir:
+        g.hardcache.set(key, value, _REBUILD_CHECKPOINT_TTL)
+        return
+    path = os.path.join(checkpoint_dir, key)
+    with open(path + ".tmp", "w") as f:
+        f.write(str(value))
+    os.rename(path + ".tmp", path)
+
+
+def _delete_checkpoint(checkpoint_dir, key):
+    if not checkpoint_dir:
+        g.hardcache.delete(key)
+        return
+    try:
+        os.remove(os.path.join(checkpoint_dir, key))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _rebuild_range(args):
+    '''Index every `cls` with lo <= _id < hi, newest first, recording the
+    lowest _id indexed so far after each chunk so that a rerun can pick up
+    where this one left off. Run in a worker of rebuild_index_parallel'''
+    cls, uploader_cls, doc_api, lo, hi, chunk_size, checkpoint_dir = args
+    key = _REBUILD_CHECKPOINT_KEY % (uploader_cls.__name__.lower(), lo, hi)
+    resume_below = _load_checkpoint(checkpoint_dir, key)
+    if resume_below is None:
+        resume_below = hi
+    if resume_below <= lo:
+        return lo, hi, 0, 0.0
+
+    uploader = uploader_cls(getattr(g, doc_api))
+    q = cls._query(cls.c._id >= lo, cls.c._id < resume_below,
+                   cls.c._deleted == (True, False),
+                   sort=desc('_id'), data=True)
+    start = time.time()
+    count = 0
+    try:
+        for chunk in r2utils.fetch_things2(q, chunk_size=chunk_size,
+                                           chunks=True):
+            uploader.things = chunk
+            _inject_with_retries(uploader)
+            count += len(chunk)
+            _save_checkpoint(checkpoint_dir, key, chunk[-1]._id)
+            elapsed = time.time() - start
+            print ("worker %d: [%d, %d) %d docs in %.1fs (%.1f docs/sec)" %
+                   (os.getpid(), lo, hi, count, elapsed,
+                    count / max(elapsed, 0.001)))
+    finally:
+        uploader.close()
+    _save_checkpoint(checkpoint_dir, key, lo)
+    return lo, hi, count, time.time() - start
+
+
+def _close_connections():
+    '''Close pooled database, cassandra and memcache connections, so that
+    fork()ed workers open their own instead of sharing our sockets'''
+    g.dbm.dispose()
+    for pool in g.cassandra_pools.itervalues():
+        pool.dispose()
+    for chain in g.cache_chains.itervalues():
+        for cache in chain.caches:
+            if hasattr(cache, "disconnect_all"):
+                cache.disconnect_all()
+
+
+def rebuild_index_parallel(cls=Link, uploader=LinkUploader,
+                           doc_api='CLOUDSEARCH_DOC_API',
+                           workers=multiprocessing.cpu_count(), ranges=None,
+                           chunk_size=1000, checkpoint_dir=None, max_id=None,
+                           restart=False):
+    '''Rebuild the index for `cls` with a pool of `workers` processes.
+
+    The _id space is split into `ranges` (4 per worker by default) that
+    are indexed in parallel, each by its own uploader with its own
+    connections. Progress through each range is checkpointed in
+    `checkpoint_dir` if it's given, or the hardcache if not, so rerunning
+    with the same arguments after a crash resumes every range where it
+    stopped. Pass `restart=True` to throw the checkpoints away and start
+    over instead. Once every range has finished the checkpoints are
+    deleted, so the next rebuild starts from scratch.
+
+    The ranges are cut up to `max_id`, which defaults to the newest _id
+    when the rebuild is first started. It's saved with the checkpoints,
+    so things created since then don't move the ranges on a rerun.
+
+    '''
+    ranges = ranges or workers * 4
+    if checkpoint_dir and not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+
+    max_id_key = _REBUILD_MAX_ID_KEY % uploader.__name__.lower()
+    if max_id is None and not restart:
+        max_id = _load_checkpoint(checkpoint_dir, max_id_key)
+    if max_id is None:
+        newest = list(cls._query(cls.c._deleted == (True, False),
+                                 sort=desc('_id'), limit=1))
+        if not newest:
+            return
+        max_id = newest[0]._id
+    _save_checkpoint(checkpoint_dir, max_id_key, max_id)
+
+    step = max_id // ranges + 1
+    bounds = [(lo, min(lo + step, max_id + 1))
+              for lo in xrange(0, max_id + 1, step)]
+    args = [(cls, uploader, doc_api, lo, hi, chunk_size, checkpoint_dir)
+            for lo, hi in bounds]
+    checkpoint_keys = [_REBUILD_CHECKPOINT_KEY % (uploader.__name__.lower(),
+                                                  lo, hi)
+                       for lo, hi in bounds]
+
+    if restart:
+        for key in checkpoint_keys:
+            _delete_checkpoint(checkpoint_dir, key)
+
+    _close_connections()
+    pool = multiprocessing.Pool(workers)
+    start = time.time()
+    total = 0
+    try:
+        for lo, hi, count, elapsed in pool.imap_unordered(_rebuild_range,
+                                                          args):
+            total += count
+            print ("finished [%d, %d): %d docs in %.1fs; %d docs so far "
+                   "(%.1f docs/sec)" % (lo, hi, count, elapsed, total,
+                                        total / max(time.time() - start,
+                                                    0.001)))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    # every range is done, so don't let a later rebuild resume this one
+    for key in checkpoint_keys + [max_id_key]:
+        _delete_checkpoint(checkpoint_dir, key)
+
+
+rebuild_subreddit_index_parallel = functools.partial(
+    rebuild_index_parallel,
+    cls=Subreddit,
+    uploader=SubredditUploader,
+    doc_api='CLOUDSEARCH_SUBREDDIT_DOC_API')
+
+
 def test_run_link(start_link, count=1000):
     '''Inject `count` number of links, starting with `start_link`'''
     if isinstance(start_link, basestring):
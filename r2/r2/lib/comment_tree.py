@@ -23,6 +23,7 @@
 from pylons import g, c
 from itertools import chain
 from r2.lib.utils import SimpleSillyStub, tup, to36
+from r2.lib.db import sorts
 from r2.lib.db.sorts import epoch_seconds
 from r2.lib.cache import sgm
 from r2.models.comment_tree import CommentTree
@@ -43,10 +44,27 @@ def sort_comments_key(link_id, sort):
     assert sort.startswith('_')
     return '%s%s' % (to36(link_id), sort)
 
-def _get_sort_value(comment, sort):
-    if sort == "_date":
-        return epoch_seconds(comment._date)
-    return getattr(comment, sort)
+_batch_sorts = {
+    "_score": sorts.score_many,
+    "_controversy": sorts.controversy_many,
+    "_confidence": sorts.confidence_many,
+}
+
+def _get_sort_values(comments, sort):
+    """Return the `sort` value of each of `comments`, in order, scoring
+       them all at once with the batch sort functions"""
+    if sort in ("_date", "_hot"):
+        dates = [epoch_seconds(cm._date) for cm in comments]
+        if sort == "_date":
+            return dates
+
+    ups = [cm._ups for cm in comments]
+    downs = [cm._downs for cm in comments]
+    if sort == "_hot":
+        return sorts.hot_many(ups, downs, dates)
+    elif sort in _batch_sorts:
+        return _batch_sorts[sort](ups, downs)
+    return [getattr(cm, sort) for cm in comments]
 
 def add_comments(comments):
     links = Link._byID([com.link_id for com in tup(comments)], data=True)
@@ -92,8 +110,8 @@ def update_comment_votes(comments, write_consistency_level = None):
             # Cassandra always uses the id36 instead of the integer
             # ID, so we'll map that first before sending it
             c_key = sort_comments_key(link_id, sort)
-            c_r = dict((cm._id36, _get_sort_value(cm, sort))
-                       for cm in coms)
+            c_r = dict(zip((cm._id36 for cm in coms),
+                           _get_sort_values(coms, sort)))
             CommentSortsCache._set_values(c_key, c_r,
                                           write_consistency_level = write_consistency_level)
 
@@ -115,7 +133,8 @@ def delete_comment(comment):
 
 def _comment_sorter_from_cids(cids, sort):
     comments = Comment._byID(cids, data = False, return_dict = False)
-    return dict((x._id, _get_sort_value(x, sort)) for x in comments)
+    return dict(zip((x._id for x in comments),
+                    _get_sort_values(comments, sort)))
 
 def _get_comment_sorter(link_id, sort):
     from r2.models import CommentSortsCache
@@ -20,31 +20,287 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
-from r2.models import Link, Subreddit
+"""Counting of link views and subreddit votes, for rising, organic and
+sr_pops.
+
+Counts are accumulated in each process on the request path, and every
+FLUSH_INTERVAL seconds (or sooner, once MAX_PENDING members are waiting)
+they're flushed to memcache as batched incr_multis into keys for
+BUCKET_SECONDS wide time buckets:
+
+    count-<kind>-<bucket>-<member>               the count itself
+    count-<kind>-<bucket>-index-<shard>          "<member>," for each member
+                                                 counted in the bucket
+    count-<kind>-<bucket>-index-<shard>-bytes    the length of that index
+    count-<kind>-<bucket>-cms-<row>-<column>     count-min sketch cells
+
+The rollups (get_link_counts and get_sr_counts) sum the buckets in a
+period. memcache evicts the least recently touched keys first, which are
+the counters of the long tail of rarely viewed links, so the counts are
+also added to a count-min sketch per bucket. Its number of cells is fixed
+however many members are counted, and a member whose counter has gone
+missing has its count estimated from the sketch instead.
+
+A member is appended to the index by whichever process creates its
+counter in the bucket, so it's listed once however many processes count
+it. An index stops growing at MAX_INDEX_BYTES, well short of memcache's
+item size limit. Members first counted after that are left out of the
+rollups, though their counters and the sketch still count them.
+"""
+
+import atexit
+import collections
+import math
+import threading
+import time
+import zlib
+from array import array
+
+from r2.models import Subreddit
 from r2.lib import utils
 from r2.lib.db.operators import desc
+from r2.lib.memoize import memoize
 from pylons import g
 
 count_period = g.rising_period
 
-#stubs
+BUCKET_SECONDS = 15 * 60
+FLUSH_INTERVAL = 30
+MAX_PENDING = 5000
+INDEX_SHARDS = 16
+MAX_INDEX_BYTES = 512 * 1024
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+ROLLUP_CACHE_TIME = 60
+SR_COUNT_PERIOD = '1 day'
+
+
+def sketch_cells(key, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    """The (row, column) of the cell for key in each row of a sketch"""
+    return [(row, (zlib.crc32('%d:%s' % (row, key)) & 0xffffffff) % width)
+            for row in xrange(depth)]
+
+
+class CountMinSketch(object):
+    """Approximate counts of any number of keys in a fixed amount of
+       memory. Estimates never undercount, and overcount by more than
+       e / width of the total of all counts with probability at most
+       e ** -depth."""
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('l', [0]) * width for x in xrange(depth)]
+
+    def cells(self, key):
+        return sketch_cells(key, self.width, self.depth)
+
+    def add(self, key, count=1):
+        for row, column in self.cells(key):
+            self.rows[row][column] += count
+
+    def estimate(self, key):
+        return min(self.rows[row][column] for row, column in self.cells(key))
+
+    def merge(self, other):
+        if (other.width, other.depth) != (self.width, self.depth):
+            raise ValueError("can't merge sketches of different sizes")
+        for row, other_row in zip(self.rows, other.rows):
+            for column in xrange(self.width):
+                row[column] += other_row[column]
+
+
+def _bucket(t=None):
+    return int((t or time.time()) // BUCKET_SECONDS)
+
+
+def _period_seconds(period):
+    return utils.timeinterval_fromstr(period).total_seconds()
+
+
+def _prefix(kind, bucket):
+    return 'count-%s-%d-' % (kind, bucket)
+
+
+def _index_key(kind, bucket, shard):
+    return '%sindex-%d' % (_prefix(kind, bucket), shard)
+
+
+def _cell_key(kind, bucket, row, column):
+    return '%scms-%d-%d' % (_prefix(kind, bucket), row, column)
+
+
+def _index_bytes_key(kind, bucket, shard):
+    return _index_key(kind, bucket, shard) + '-bytes'
+
+
+def _shard(member):
+    return (zlib.crc32(member) & 0xffffffff) % INDEX_SHARDS
+
+
+def _incr_all(deltas, time):
+    """incr each key in deltas by its delta, creating it first if needed.
+       Returns the keys that were created."""
+    failed = g.memcache.add_multi(dict((key, 0) for key in deltas),
+                                  time=time)
+    by_delta = collections.defaultdict(list)
+    for key, delta in deltas.iteritems():
+        by_delta[delta].append(key)
+    for delta, keys in by_delta.iteritems():
+        g.memcache.incr_multi(keys, delta=delta)
+    return set(deltas).difference(failed or ())
+
+
+class PendingCounts(object):
+    """The counts of one kind of thing that this process hasn't flushed
+       to memcache yet"""
+
+    def __init__(self, kind, period):
+        self.kind = kind
+        # keep the buckets for as long as a rollup might want them
+        self.expire = int(_period_seconds(period)) + BUCKET_SECONDS
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.last_flush = time.time()
+
+    def incr(self, members):
+        with self.lock:
+            for member in members:
+                self.counts[member] += 1
+            due = (len(self.counts) >= MAX_PENDING or
+                   time.time() - self.last_flush >= FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts, self.counts = self.counts, collections.Counter()
+            self.last_flush = time.time()
+            bucket = _bucket(self.last_flush)
+
+        if not counts:
+            return
+
+        try:
+            self._write(bucket, counts)
+        except Exception:
+            # these are best-effort, so don't take the request down
+            g.log.exception('count: dropping %d %s counts',
+                            len(counts), self.kind)
+
+    def _write(self, bucket, counts):
+        prefix = _prefix(self.kind, bucket)
+        deltas = collections.Counter()
+        for member, n in counts.iteritems():
+            deltas[prefix + member] += n
+            for row, column in sketch_cells(member):
+                deltas[_cell_key(self.kind, bucket, row, column)] += n
+        created = _incr_all(deltas, self.expire)
+
+        # only the process that created a member's counter indexes it
+        shards = collections.defaultdict(list)
+        for member in counts:
+            if prefix + member in created:
+                shards[_shard(member)].append(member)
+        for shard, members in shards.iteritems():
+            self._append_index(bucket, shard, ','.join(members) + ',')
+
+    def _append_index(self, bucket, shard, text):
+        # reserve the space first, so that racing processes can't take
+        # the index past MAX_INDEX_BYTES between them
+        bytes_key = _index_bytes_key(self.kind, bucket, shard)
+        g.memcache.add(bytes_key, 0, time=self.expire)
+        size = g.memcache.incr(bytes_key, len(text))
+        if size is None or size > MAX_INDEX_BYTES:
+            g.log.warning('count: %s index %d of bucket %d is full',
+                          self.kind, shard, bucket)
+            return
+
+        key = _index_key(self.kind, bucket, shard)
+        g.memcache.add(key, '', time=self.expire)
+        g.memcache.append(key, text, time=self.expire)
+
+
+def _load_sketch(kind, bucket):
+    sketch = CountMinSketch()
+    keys = [_cell_key(kind, bucket, row, column)
+            for row in xrange(sketch.depth)
+            for column in xrange(sketch.width)]
+    cells = g.memcache.get_multi(keys)
+    for row in xrange(sketch.depth):
+        for column in xrange(sketch.width):
+            sketch.rows[row][column] = int(
+                cells.get(_cell_key(kind, bucket, row, column), 0))
+    return sketch
+
+
+def rollup(kind, period):
+    """Sum the counts of `kind` over the buckets in the last `period`"""
+    last = _bucket()
+    first = last - int(math.ceil(_period_seconds(period) / BUCKET_SECONDS))
+    totals = collections.Counter()
+    for bucket in xrange(first + 1, last + 1):
+        index_keys = [_index_key(kind, bucket, shard)
+                      for shard in xrange(INDEX_SHARDS)]
+        members = set()
+        for index in g.memcache.get_multi(index_keys).itervalues():
+            members.update(m for m in index.split(',') if m)
+        if not members:
+            continue
+
+        counts = g.memcache.get_multi(list(members),
+                                      prefix=_prefix(kind, bucket))
+        missing = members.difference(counts)
+        if missing:
+            sketch = _load_sketch(kind, bucket)
+            for member in missing:
+                counts[member] = sketch.estimate(member)
+
+        for member, n in counts.iteritems():
+            totals[member] += int(n)
+    return totals
+
+
+_link_counts = PendingCounts('link', count_period)
+_sr_counts = PendingCounts('sr', SR_COUNT_PERIOD)
+
+
+@atexit.register
+def flush_counts():
+    _link_counts.flush()
+    _sr_counts.flush()
+
 
 def incr_counts(wrapped):
-    pass
+    """Count views of the links in a listing"""
+    _link_counts.incr('%s.%d' % (item._fullname, item.sr_id)
+                      for item in wrapped
+                      if getattr(item, 'sr_id', None) is not None)
 
 def incr_sr_count(sr):
-    pass
+    """Count a vote on a link in sr, for get_sr_vote_counts"""
+    _sr_counts.incr([sr._fullname])
 
+@memoize('count.get_link_counts', time=ROLLUP_CACHE_TIME)
 def get_link_counts(period = count_period):
-    links = Link._query(Link.c._date >= utils.timeago(period),
-                        limit=50, data = True)
-    return dict((l._fullname, (0, l.sr_id)) for l in links)
+    """Return {link fullname: (views in period, sr_id)}"""
+    link_counts = {}
+    for member, n in rollup('link', period).iteritems():
+        fullname, sr_id = member.rsplit('.', 1)
+        link_counts[fullname] = (n, int(sr_id))
+    return link_counts
 
 def get_sr_counts():
+    """Return {subreddit fullname: subscribers}, which sr_pops sorts the
+       popular subreddits by"""
     srs = utils.fetch_things2(Subreddit._query(sort=desc("_date")))
 
     return dict((sr._fullname, sr._ups) for sr in srs)
 
+def get_sr_vote_counts(period = SR_COUNT_PERIOD):
+    """Return {subreddit fullname: votes on its links in period}"""
+    return dict(rollup('sr', period))
+
 try:
     from r2admin.lib.count import *
 except ImportError:
@@ -20,12 +20,20 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+cimport cython
+from cpython cimport array
+from libc.stdlib cimport calloc, labs
+
+import array
 from datetime import datetime, timedelta
 from pylons import g
 
 cdef extern from "math.h":
-    double log10(double)
-    double sqrt(double)
+    double log10(double) nogil
+    double sqrt(double) nogil
+    double fabs(double) nogil
+    double floor(double) nogil
+    double fma(double, double, double) nogil
 
 epoch = datetime(1970, 1, 1, tzinfo = g.tz)
 
@@ -62,6 +70,9 @@ cpdef double controversy(long ups, long downs):
 cpdef double _confidence(int ups, int downs):
     """The confidence sort.
        http://www.evanmiller.org/how-not-to-sort-by-average-rating.html"""
+    return _confidence_c(ups, downs)
+
+cdef double _confidence_c(int ups, int downs) nogil:
     cdef float n = ups + downs
 
     if n == 0:
@@ -69,6 +80,7 @@ cpdef double _confidence(int ups, int downs):
 
     cdef float z = 1.281551565545 # 80% confidence
     cdef float p = float(ups) / n
+    cdef double left, right, under
 
     left = p + 1/(2*n)*z*z
     right = z*sqrt(p*(1-p)/n + z*z/(4*n*n))
@@ -76,16 +88,191 @@ cpdef double _confidence(int ups, int downs):
 
     return (left - right) / under
 
-cdef int up_range = 400
-cdef int down_range = 100
-cdef list _confidences = []
-for ups in xrange(up_range):
-    for downs in xrange(down_range):
-        _confidences.append(_confidence(ups, downs))
+# The table of precomputed confidences is allocated once at its maximum
+# size and filled in lazily, growing the filled rectangle whenever a
+# lookup falls outside of it. calloc() only commits the pages that are
+# actually touched, and because the table never moves and filled cells
+# never change, the batch functions can read it without the GIL.
+cdef int max_up_range = 4096
+cdef int max_down_range = 1024
+cdef int up_range = 0
+cdef int down_range = 0
+cdef double *_confidences = <double *>calloc(max_up_range * max_down_range,
+                                             sizeof(double))
+if _confidences == NULL:
+    raise MemoryError()
+
+cdef int _grown_range(int current, int needed, int minimum, int maximum):
+    cdef int new = max(current, minimum)
+    while new <= needed:
+        new *= 2
+    return min(new, maximum)
+
+cdef void _grow_confidences(int ups, int downs):
+    """Make sure (ups, downs) is in the table, if it's small enough for
+       the table to hold. Must be called with the GIL held."""
+    global up_range, down_range
+    cdef int new_up_range, new_down_range, u, d
+
+    if ups < 0 or downs < 0:
+        return
+    if ups < up_range and downs < down_range:
+        return
+    if ups >= max_up_range or downs >= max_down_range:
+        return
+
+    new_up_range = _grown_range(up_range, ups, 400, max_up_range)
+    new_down_range = _grown_range(down_range, downs, 100, max_down_range)
+
+    for u in range(new_up_range):
+        for d in range(new_down_range):
+            if u < up_range and d < down_range:
+                continue
+            _confidences[d + u * max_down_range] = _confidence_c(u, d)
+
+    down_range = new_down_range
+    up_range = new_up_range
+
 def confidence(int ups, int downs):
     if ups + downs == 0:
         return 0
-    elif ups < up_range and downs < down_range:
-        return _confidences[downs + ups * down_range]
+
+    _grow_confidences(ups, downs)
+    if 0 <= ups < up_range and 0 <= downs < down_range:
+        return _confidences[downs + ups * max_down_range]
     else:
         return _confidence(ups, downs)
+
+cdef inline double _round7(double x) nogil:
+    """Python's round(x, 7) for the magnitudes that hot scores have.
+
+       The product x * 1e7 is rounded, so fma recovers its exact error
+       to decide on which side of .5 the true product lies."""
+    cdef double ax = fabs(x)
+    cdef double prod = ax * 1e7
+    cdef double err = fma(ax, 1e7, -prod)
+    cdef double whole = floor(prod)
+    cdef double frac = prod - whole - 0.5
+
+    if frac + err >= 0:
+        whole += 1
+    if x < 0:
+        return -whole / 1e7
+    return whole / 1e7
+
+cdef inline double _hot_c(long ups, long downs, double date) nogil:
+    cdef long s = ups - downs
+    cdef double order = log10(max(labs(s), 1))
+    cdef int sign = 0
+    if s > 0:
+        sign = 1
+    elif s < 0:
+        sign = -1
+    cdef double seconds = date - 1134028003
+    return _round7(order + sign * seconds / 45000)
+
+cdef long[:] _as_longs(values):
+    try:
+        return values
+    except (TypeError, ValueError):
+        return array.array('l', values)
+
+cdef double[:] _as_doubles(values):
+    try:
+        return values
+    except (TypeError, ValueError):
+        return array.array('d', values)
+
+cdef array.array _double_template = array.array('d', [])
+cdef array.array _long_template = array.array('l', [])
+
+cdef _check_lengths(Py_ssize_t n, Py_ssize_t m):
+    if n != m:
+        raise ValueError("expected arrays of the same length (%d != %d)"
+                         % (n, m))
+
+# The batch versions of the sorts take sequences (typically NumPy
+# arrays or array.arrays of C longs and doubles, though anything else is
+# converted) and return an array.array of the results. The number
+# crunching is done with the GIL released.
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def score_many(ups, downs):
+    cdef long[:] u = _as_longs(ups), d = _as_longs(downs)
+    cdef Py_ssize_t i, n = u.shape[0]
+    _check_lengths(n, d.shape[0])
+    cdef array.array ret = array.clone(_long_template, n, zero=False)
+    cdef long[:] out = ret
+
+    with nogil:
+        for i in range(n):
+            out[i] = u[i] - d[i]
+    return ret
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def hot_many(ups, downs, dates):
+    """`dates` are in seconds since the epoch, as for `_hot`"""
+    cdef long[:] u = _as_longs(ups), d = _as_longs(downs)
+    cdef double[:] t = _as_doubles(dates)
+    cdef Py_ssize_t i, n = u.shape[0]
+    _check_lengths(n, d.shape[0])
+    _check_lengths(n, t.shape[0])
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+
+    with nogil:
+        for i in range(n):
+            out[i] = _hot_c(u[i], d[i], t[i])
+    return ret
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def controversy_many(ups, downs):
+    cdef long[:] u = _as_longs(ups), d = _as_longs(downs)
+    cdef Py_ssize_t i, n = u.shape[0]
+    _check_lengths(n, d.shape[0])
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+
+    with nogil:
+        for i in range(n):
+            out[i] = (<double>(u[i] + d[i])) / max(labs(u[i] - d[i]), 1)
+    return ret
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def confidence_many(ups, downs):
+    cdef long[:] u = _as_longs(ups), d = _as_longs(downs)
+    cdef Py_ssize_t i, n = u.shape[0]
+    _check_lengths(n, d.shape[0])
+    cdef array.array ret = array.clone(_double_template, n, zero=False)
+    cdef double[:] out = ret
+    cdef long max_ups = 0, max_downs = 0
+    cdef int ups_limit, downs_limit
+
+    with nogil:
+        for i in range(n):
+            if u[i] > max_ups:
+                max_ups = u[i]
+            if d[i] > max_downs:
+                max_downs = d[i]
+
+    # grow the shared table to cover as much of this batch as it can
+    # while we still hold the GIL, then only read it below
+    _grow_confidences(min(max_ups, max_up_range - 1),
+                      min(max_downs, max_down_range - 1))
+    ups_limit = up_range
+    downs_limit = down_range
+
+    with nogil:
+        for i in range(n):
+            if u[i] + d[i] == 0:
+                out[i] = 0
+            elif (0 <= u[i] < ups_limit and 0 <= d[i] < downs_limit):
+                out[i] = _confidences[d[i] + u[i] * max_down_range]
+            else:
+                out[i] = _confidence_c(u[i], d[i])
+    return ret
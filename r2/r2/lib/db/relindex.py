@@ -0,0 +1,205 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""Membership indexes that answer Relation._fast_query in a few keys.
+
+_fast_query keeps every (thing1_id, thing2_id, name) triple under its own
+cache key, so checking a page of 25 links against a user's saves and
+hides fetches 50 keys, nearly all of them for rels that don't exist. A
+relation with a _fast_index_side keeps, for each thing on that side and
+each rel name, the sorted ids of the things on the other side packed into
+a single key. A lookup fetches one of those per (thing, name), answers
+membership in-process, and only goes to the per-triple keys for the rels
+that do exist, since those are the ones that have to be loaded anyway.
+
+Things related to more than INDEX_LIMIT others by one name aren't
+indexed, and lookups for them fall back to the per-triple keys. The limit
+bounds what every commit of a rel rewrites under a lock: 2000 ids pack to
+16KB, which takes under a millisecond to unpack, change and repack.
+
+Indexes are built from the master so that a rel committed just before
+the build can't be left out of one by replication lag, and expire after
+INDEX_TTL in case a write-through is lost anyway.
+"""
+
+import array
+import bisect
+import time
+
+from pylons import g
+
+from r2.config import cache
+from r2.lib.cache import sgm
+import tdb_sql as tdb
+
+
+INDEX_LIMIT = 2000
+INDEX_TTL = 24 * 60 * 60
+
+# ids are packed as native C longs. an index that's too big is cached as
+# OVERFLOW, which can't be mistaken for a packed one as its length isn't
+# a multiple of the item size
+ID_TYPECODE = 'l'
+OVERFLOW = '-'
+
+
+def pack(ids):
+    return array.array(ID_TYPECODE, sorted(ids)).tostring()
+
+
+def unpack(packed):
+    ids = array.array(ID_TYPECODE)
+    ids.fromstring(packed)
+    return ids
+
+
+def contains(ids, thing_id):
+    i = bisect.bisect_left(ids, thing_id)
+    return i < len(ids) and ids[i] == thing_id
+
+
+class FastQueryIndex(object):
+    """The index of one relation's rels by their thing1 (side 1) or
+    thing2 (side 2)."""
+
+    def __init__(self, prefix, rel_type_id, side):
+        self.prefix = prefix
+        self.rel_type_id = rel_type_id
+        self.side = side
+
+    def _split(self, triple):
+        """Return the index key for a triple, and the id to look up in it"""
+        thing1_id, thing2_id, name = triple
+        if self.side == 1:
+            return (thing1_id, name), thing2_id
+        else:
+            return (thing2_id, name), thing1_id
+
+    def keys_needed(self, triples):
+        return set(self._split(triple)[0] for triple in triples)
+
+    def worthwhile(self, triples):
+        return len(self.keys_needed(triples)) < len(triples)
+
+    def _load(self, keys):
+        indexes = {}
+        for thing_id, name in keys:
+            ids = tdb.get_rel_partners(self.rel_type_id, self.side, thing_id,
+                                       name, INDEX_LIMIT + 1)
+            if len(ids) > INDEX_LIMIT:
+                indexes[(thing_id, name)] = OVERFLOW
+            else:
+                indexes[(thing_id, name)] = pack(ids)
+        return indexes
+
+    def lookup(self, triples):
+        """Split triples into those that are known to have no rel and those
+        that have to be looked up individually."""
+        by_key = {}
+        for triple in triples:
+            key, other_id = self._split(triple)
+            by_key.setdefault(key, []).append((triple, other_id))
+
+        indexes = sgm(cache, by_key.keys(), self._load, self.prefix,
+                      time=INDEX_TTL)
+
+        missing, candidates = [], []
+        for key, entries in by_key.iteritems():
+            packed = indexes[key]
+            if packed == OVERFLOW:
+                candidates.extend(triple for triple, other_id in entries)
+                continue
+
+            ids = unpack(packed)
+            for triple, other_id in entries:
+                if contains(ids, other_id):
+                    candidates.append(triple)
+                else:
+                    missing.append(triple)
+        return missing, candidates
+
+    def _apply(self, key, add, remove):
+        cache_key = self.prefix + str(key)
+        with g.make_lock("fast_query_index", 'lock_' + cache_key):
+            packed = cache.get(cache_key, allow_local=False)
+            if packed is None or packed == OVERFLOW:
+                # an index that isn't cached is built from the db when
+                # it's next needed
+                return
+
+            ids = set(unpack(packed))
+            ids.update(add)
+            ids.difference_update(remove)
+            if len(ids) > INDEX_LIMIT:
+                cache.set(cache_key, OVERFLOW, time=INDEX_TTL)
+            else:
+                cache.set(cache_key, pack(ids), time=INDEX_TTL)
+
+    def update(self, added=(), removed=()):
+        """Write through the triples of rels that were created or deleted"""
+        changes = {}
+        for triple in added:
+            key, other_id = self._split(triple)
+            changes.setdefault(key, (set(), set()))[0].add(other_id)
+        for triple in removed:
+            key, other_id = self._split(triple)
+            changes.setdefault(key, (set(), set()))[1].add(other_id)
+
+        for key, (add, remove) in changes.iteritems():
+            self._apply(key, add, remove)
+
+
+def benchmark(rel, thing1s, thing2s, names, iterations=100):
+    """Compare rel._fast_query with and without its index.
+
+    Prints the number of cache keys each way fetches for the lookup and
+    their mean latency, with the local cache emptied before every call.
+    """
+    index = rel._get_fast_index()
+    if not index:
+        raise ValueError("%r has no fast query index" % rel)
+
+    triples = [(thing1._id, thing2._id, name)
+               for thing1 in thing1s
+               for thing2 in thing2s
+               for name in names]
+    missing, candidates = index.lookup(triples)
+    keys_without = len(triples)
+    keys_with = len(index.keys_needed(triples)) + len(candidates)
+
+    def timed(use_index):
+        start = time.time()
+        for i in xrange(iterations):
+            cache.reset()
+            rel._fast_query(thing1s, thing2s, names, use_index=use_index)
+        return (time.time() - start) / iterations
+
+    without_index = timed(False)
+    with_index = timed(True)
+
+    print "%d triples, %d looked up individually" % (len(triples),
+                                                     len(candidates))
+    print "without index: %4d keys, %.2fms" % (keys_without,
+                                              without_index * 1000)
+    print "with index:    %4d keys, %.2fms" % (keys_with, with_index * 1000)
+    return (keys_without, without_index), (keys_with, with_index)
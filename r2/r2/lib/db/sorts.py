@@ -22,3 +22,40 @@
 
 from r2.lib.db._sorts import epoch_seconds, score, hot, _hot
 from r2.lib.db._sorts import controversy, confidence
+from r2.lib.db._sorts import score_many, hot_many, controversy_many
+from r2.lib.db._sorts import confidence_many
+
+
+def benchmark_batch_sorts(count=1000000):
+    """Compare scoring `count` random comments one at a time with the
+       batch functions, checking that both give the same results."""
+    import array
+    import random
+    import time
+
+    # vote counts on comments are heavily skewed towards small numbers
+    ups = array.array('l', (min(int(random.paretovariate(1)), 100000)
+                            for i in xrange(count)))
+    downs = array.array('l', (min(int(random.paretovariate(1.5)) - 1, 100000)
+                              for i in xrange(count)))
+    now = time.time()
+    dates = array.array('d', (now - random.uniform(0, 86400 * 30)
+                              for i in xrange(count)))
+
+    cases = (('score', score, score_many, (ups, downs)),
+             ('hot', _hot, hot_many, (ups, downs, dates)),
+             ('controversy', controversy, controversy_many, (ups, downs)),
+             ('confidence', confidence, confidence_many, (ups, downs)))
+
+    for name, scalar_fn, batch_fn, args in cases:
+        start = time.time()
+        scalar = map(scalar_fn, *args)
+        scalar_secs = time.time() - start
+
+        start = time.time()
+        batch = batch_fn(*args)
+        batch_secs = time.time() - start
+
+        assert list(batch) == scalar, "%s results differ" % name
+        print "%-12s scalar: %.3fs  batch: %.3fs" % (name, scalar_secs,
+                                                     batch_secs)
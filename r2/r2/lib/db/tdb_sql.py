@@ -20,12 +20,16 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from collections import namedtuple
 from copy import deepcopy
 from datetime import datetime
 import cPickle as pickle
 import logging
+import operator
 import operators
+import Queue
 import re
+import sys
 import threading
 
 from pylons import g, c, request
@@ -497,6 +501,46 @@ def make_relation(rel_type_id, thing1_id, thing2_id, name, date=None):
         raise CreationError, "Relation exists (%s, %s, %s)" % (name, thing1_id, thing2_id)
         
 
+def make_relations(rel_type_id, triples, date=None):
+    """make_relation for many (thing1_id, thing2_id, name) triples with one
+    multi-row insert. Returns a dict mapping each triple to its new rel_id.
+
+    """
+    table = get_rel_table(rel_type_id, action = 'write')[0]
+    transactions.add_engine(table.bind)
+
+    if not triples:
+        return {}
+    if not date: date = datetime.now(g.tz)
+
+    params = dict(date=date)
+    values = []
+    for i, (thing1_id, thing2_id, name) in enumerate(triples):
+        values.append('(:thing1_id_%d, :thing2_id_%d, :name_%d, :date)'
+                      % (i, i, i))
+        params['thing1_id_%d' % i] = thing1_id
+        params['thing2_id_%d' % i] = thing2_id
+        params['name_%d' % i] = name
+
+    ins = sa.text('INSERT INTO %s (thing1_id, thing2_id, name, date) '
+                  'VALUES %s RETURNING rel_id, thing1_id, thing2_id, name'
+                  % (table.name, ', '.join(values)))
+    try:
+        r = table.bind.execute(ins, **params)
+    except sa.exc.DBAPIError, e:
+        if not 'IntegrityError' in e.message:
+            raise
+        # wrap the error to prevent db layer bleeding out
+        raise CreationError, "Relation exists (%s)" % (triples,)
+
+    counter = g.stats.get_counter('event.rel.create')
+    if counter:
+        counter.increment(table.rel_name, delta=len(triples))
+        counter.increment('total', delta=len(triples))
+
+    return dict(((row.thing1_id, row.thing2_id, row.name), row.rel_id)
+                for row in r)
+
 def set_rel_props(rel_type_id, rel_id, **props):
     t = get_rel_table(rel_type_id, action = 'write')[0]
 
@@ -565,6 +609,49 @@ def update_data(table, thing_id, **vals):
         i.execute(*inserts)
 
 
+def update_data_multi(table, vals_by_id):
+    """update_data for many things at once.
+
+    vals_by_id maps thing ids to dicts of data attributes. Existing rows are
+    updated with a single UPDATE ... FROM (VALUES ...) and the rows that
+    weren't there yet are added with one insert.
+
+    """
+    transactions.add_engine(table.bind)
+
+    rows = []
+    for thing_id, vals in vals_by_id.iteritems():
+        for key, val in vals.iteritems():
+            val, kind = py2db(val, return_kind=True)
+            rows.append(dict(thing_id=thing_id, key=key, value=val, kind=kind))
+
+    if not rows:
+        return
+
+    params = {}
+    values = []
+    for i, row in enumerate(rows):
+        values.append('(CAST(:thing_id_%d AS bigint), CAST(:key_%d AS text), '
+                      'CAST(:value_%d AS text), CAST(:kind_%d AS text))'
+                      % (i, i, i, i))
+        for col, val in row.iteritems():
+            params['%s_%d' % (col, i)] = val
+
+    u = sa.text('UPDATE %(table)s SET value = v.value, kind = v.kind '
+                'FROM (VALUES %(values)s) AS v (thing_id, key, value, kind) '
+                'WHERE %(table)s.thing_id = v.thing_id '
+                'AND %(table)s.key = v.key '
+                'RETURNING %(table)s.thing_id, %(table)s.key'
+                % dict(table=table.name, values=', '.join(values)))
+    updated = set((r.thing_id, r.key)
+                  for r in table.bind.execute(u, **params))
+
+    inserts = [row for row in rows
+               if (row['thing_id'], row['key']) not in updated]
+    if inserts:
+        table.insert().execute(*inserts)
+
+
 def create_data(table, thing_id, **vals):
     transactions.add_engine(table.bind)
 
@@ -630,6 +717,10 @@ def set_thing_data(type_id, thing_id, brand_new_thing, **vals):
     else:
         return update_data(table, thing_id, **vals)
 
+def set_thing_data_multi(type_id, vals_by_id):
+    table = get_thing_table(type_id, action = 'write')[1]
+    return update_data_multi(table, vals_by_id)
+
 def incr_thing_data(type_id, thing_id, prop, amount):
     table = get_thing_table(type_id, action = 'write')[1]
     return incr_data_prop(table, type_id, thing_id, prop, amount)    
@@ -661,6 +752,159 @@ def get_thing(type_id, thing_id):
             res[row.thing_id] = stor
     return res
 
+
+# a thing row and its data (or the requested subset of it), as produced by
+# scan_things
+ThingRecord = namedtuple('ThingRecord',
+                         'thing_id ups downs date deleted spam data')
+
+
+def _scan_window(tables, after, batch_size, keys, reverse, thing_filters):
+    """Read the next window of up to batch_size things past the keyset
+    `after` and merge-join them with their data rows in one pass.
+
+    The thing rows are read first, which fixes the id range of the window,
+    then the data rows in that range are streamed from a server-side cursor
+    in the same id order.
+    """
+    thing_table, data_table = tables
+    precedes = operator.gt if reverse else operator.lt
+    order = sa.desc if reverse else sa.asc
+
+    s = sa.select([thing_table.c.thing_id, thing_table.c.ups,
+                   thing_table.c.downs, thing_table.c.date,
+                   thing_table.c.deleted, thing_table.c.spam])
+    if after is not None:
+        s = s.where(precedes(after, thing_table.c.thing_id))
+    for column, value in thing_filters:
+        s = s.where(thing_table.c[column] == value)
+    s = s.order_by(order(thing_table.c.thing_id)).limit(batch_size)
+
+    try:
+        things = thing_table.bind.execute(s).fetchall()
+    except Exception:
+        dbm.mark_dead(thing_table.bind)
+        raise
+
+    if not things:
+        return []
+
+    if keys is not None and not keys:
+        return [ThingRecord(t.thing_id, t.ups, t.downs, t.date,
+                            t.deleted, t.spam, {})
+                for t in things]
+
+    first, last = things[0].thing_id, things[-1].thing_id
+    low, high = (last, first) if reverse else (first, last)
+    d = sa.select([data_table.c.thing_id, data_table.c.key,
+                   data_table.c.value, data_table.c.kind],
+                  sa.and_(data_table.c.thing_id >= low,
+                          data_table.c.thing_id <= high))
+    if keys is not None:
+        d = d.where(data_table.c.key.in_(keys))
+    d = d.order_by(order(data_table.c.thing_id))
+
+    conn = data_table.bind.connect().execution_options(stream_results=True)
+    try:
+        data_rows = iter(conn.execute(d))
+        row = next(data_rows, None)
+        records = []
+        for t in things:
+            data = {}
+            # rows for things that the filters skipped
+            while row is not None and precedes(row.thing_id, t.thing_id):
+                row = next(data_rows, None)
+            while row is not None and row.thing_id == t.thing_id:
+                data[row.key] = db2py(row.value, row.kind)
+                row = next(data_rows, None)
+            records.append(ThingRecord(t.thing_id, t.ups, t.downs, t.date,
+                                       t.deleted, t.spam, data))
+    except Exception:
+        dbm.mark_dead(data_table.bind)
+        raise
+    finally:
+        conn.close()
+
+    return records
+
+
+def scan_things(type_id, keys=None, after=None, batch_size=1000,
+                reverse=False, deleted=None, spam=None, prefetch=True):
+    """Stream every thing of type_id in thing_id order as lists of up to
+    batch_size ThingRecords.
+
+    This walks the thing and data tables directly, one keyset window at a
+    time, rather than paging through find_things and then loading each
+    page's data, so a full scan costs two queries per batch. `keys`
+    restricts the data to those keys (an empty sequence skips the data
+    table entirely); `deleted` and `spam` filter on those columns when not
+    None; `after` resumes a scan after the given thing_id. With `prefetch`,
+    the next batch is read on a background thread while the caller works
+    on the current one.
+    """
+    # resolved here rather than in the prefetch thread, which has no
+    # request context
+    tables = get_thing_table(type_id)[:2]
+    keys = tuple(keys) if keys is not None else None
+    thing_filters = [(column, value)
+                     for column, value in (('deleted', deleted),
+                                           ('spam', spam))
+                     if value is not None]
+
+    def windows():
+        cursor = after
+        while True:
+            batch = _scan_window(tables, cursor, batch_size, keys, reverse,
+                                 thing_filters)
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+            cursor = batch[-1].thing_id
+
+    if not prefetch:
+        for batch in windows():
+            yield batch
+        return
+
+    # the queue holds one batch so the reader stays exactly one ahead
+    batches = Queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for batch in windows():
+                if not put((batch, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((None, None))
+
+    thread = threading.Thread(target=reader, name='scan_things')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            batch, exc_info = batches.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if batch is None:
+                return
+            yield batch
+    finally:
+        stopped.set()
+
 def set_rel_data(rel_type_id, thing_id, brand_new_thing, **vals):
     table = get_rel_table(rel_type_id, action = 'write')[3]
 
@@ -693,6 +937,28 @@ def get_rel(rel_type_id, rel_id):
             res[row.rel_id] = stor
     return res
 
+def get_rel_partners(rel_type_id, side, thing_id, name, limit):
+    """Return the ids of the things that thing_id is related to by `name`
+    rels, where thing_id is the rels' thing1 (side 1) or thing2 (side 2).
+
+    At most `limit` ids are returned, in no particular order. They're read
+    from the master, as a replica may not have the latest rels yet.
+    """
+    r_table = rel_types_id[rel_type_id].tables[0][0]
+    if side == 1:
+        mine, theirs = r_table.c.thing1_id, r_table.c.thing2_id
+    else:
+        mine, theirs = r_table.c.thing2_id, r_table.c.thing1_id
+
+    s = sa.select([theirs], sa.and_(mine == thing_id,
+                                    r_table.c.name == name), limit=limit)
+    try:
+        r = add_request_info(s).execute().fetchall()
+    except Exception:
+        dbm.mark_dead(r_table.bind)
+        raise
+    return [row[0] for row in r]
+
 def del_rel(rel_type_id, rel_id):
     tables = get_rel_table(rel_type_id, action = 'write')
     table = tables[0]
@@ -704,6 +970,20 @@ def del_rel(rel_type_id, rel_id):
     table.delete(table.c.rel_id == rel_id).execute()
     data_table.delete(data_table.c.thing_id == rel_id).execute()
 
+def del_rels(rel_type_id, rel_ids):
+    if not rel_ids:
+        return
+
+    tables = get_rel_table(rel_type_id, action = 'write')
+    table = tables[0]
+    data_table = tables[3]
+
+    transactions.add_engine(table.bind)
+    transactions.add_engine(data_table.bind)
+
+    table.delete(table.c.rel_id.in_(rel_ids)).execute()
+    data_table.delete(data_table.c.thing_id.in_(rel_ids)).execute()
+
 def sa_op(op):
     #if BooleanOp
     if isinstance(op, operators.or_):
@@ -30,10 +30,11 @@ from copy import copy, deepcopy
 import operators
 import tdb_sql as tdb
 import sorts
+from relindex import FastQueryIndex
 from .. utils import iters, Results, tup, to36, Storage, timefromnow
 from .. utils import iters, Results, tup, to36, Storage, thing_utils, timefromnow
 from r2.config import cache
-from r2.lib.cache import sgm
+from r2.lib.cache import sgm, ValueCodec
 from r2.lib.log import log_text
 from r2.lib import stats, hooks
 from pylons import g
@@ -44,6 +45,7 @@ CreationError = tdb.CreationError
 
 thing_types = {}
 rel_types = {}
+fast_indexes = {}
 
 def begin():
     tdb.transactions.begin()
@@ -95,6 +97,18 @@ class DataThing(object):
             self._asked_for_data = True # You just created it; of course
                                         # you're allowed to touch its data
 
+    def _codec_getstate(self):
+        # safe_set_attr only refers back to us, so the ValueCodec rebuilds
+        # it on load rather than storing it. plain pickles still carry it so
+        # that processes without the codec can read them.
+        state = self.__dict__.copy()
+        state.pop('safe_set_attr', None)
+        return state
+
+    def _codec_setstate(self, state):
+        self.__dict__.update(state)
+        self.__dict__['safe_set_attr'] = SafeSetAttr(self)
+
     #TODO some protection here?
     def __setattr__(self, attr, val, make_dirty=True):
         if attr.startswith('__') or self.__safe__:
@@ -299,6 +313,66 @@ class DataThing(object):
 
         hooks.get_hook("thing.commit").call(thing=self, changes=to_set)
 
+    @classmethod
+    def _commit_multi(cls, things):
+        """Commit changed data attributes of many existing things at once.
+
+        Each thing is locked and synced with its cached copy just as in
+        _commit, but the data for all of them is written with one multi-row
+        update and they're cached with a single set_multi. Changes to base
+        props (those starting with '_') must go through _commit.
+
+        """
+        things = [t for t in tup(things) if t._dirty]
+        if not things:
+            return
+
+        for thing in things:
+            if not thing._created:
+                raise ValueError("%r must be created before _commit_multi"
+                                 % thing)
+            if any(k.startswith('_') for k in thing._dirties):
+                raise ValueError("%r has base props to commit" % thing)
+
+        locks = []
+        changes = []
+        try:
+            # lock in a consistent order so that two of these can't
+            # deadlock each other
+            for thing in sorted(things, key=lambda t: t._id):
+                lock = g.make_lock("thing_commit", 'commit_' + thing._fullname)
+                lock.acquire()
+                locks.append(lock)
+
+            begin()
+
+            data_by_id = {}
+            for thing in things:
+                if not thing._sync_latest():
+                    continue
+                to_set = thing._dirties.copy()
+                data_by_id[thing._id] = dict((k, new_value) for k, (old_value,
+                                             new_value) in to_set.iteritems())
+                changes.append((thing, to_set))
+
+            cls._set_data_multi(cls._type_id, data_by_id)
+
+            for thing in things:
+                thing._dirties.clear()
+            cache.set_multi(dict((thing._cache_key(), thing)
+                                 for thing in things))
+        except:
+            rollback()
+            raise
+        else:
+            commit()
+        finally:
+            for lock in locks:
+                lock.release()
+
+        for thing, to_set in changes:
+            hooks.get_hook("thing.commit").call(thing=thing, changes=to_set)
+
     @classmethod
     def _load_multi(cls, need):
         need = tup(need)
@@ -528,6 +602,9 @@ class DataThing(object):
     def _set_data(*a, **kw):
         raise NotImplementedError()
 
+    def _set_data_multi(*a, **kw):
+        raise NotImplementedError()
+
     def _incr_data(*a, **kw):
         raise NotImplementedError()
 
@@ -539,6 +616,8 @@ class DataThing(object):
         self._id = self._make_fn(self._type_id, *base_props)
         self._created = True
 
+ValueCodec.register_type(DataThing)
+
 class ThingMeta(type):
     def __init__(cls, name, bases, dct):
         if name == 'Thing' or hasattr(cls, '_nodb') and cls._nodb: return
@@ -567,6 +646,7 @@ class Thing(DataThing):
     _set_props = staticmethod(tdb.set_thing_props)
     _get_data = staticmethod(tdb.get_thing_data)
     _set_data = staticmethod(tdb.set_thing_data)
+    _set_data_multi = staticmethod(tdb.set_thing_data_multi)
     _get_item = staticmethod(tdb.get_thing)
     _incr_data = staticmethod(tdb.incr_thing_data)
     _type_prefix = 't'
@@ -656,6 +736,38 @@ class Thing(DataThing):
 
         return Things(cls, *rules, **kw)
 
+    @classmethod
+    def _scan(cls, keys=None, after=None, chunk_size=1000, reverse=False,
+              deleted=False, spam=False, chunks=False):
+        """Stream every thing of this type in _id order straight from the
+        thing and data tables, as a faster fetch_things2 for full scans.
+
+        As with _query, deleted and spam things are skipped unless
+        `deleted` or `spam` are None (either) or True (only those). If
+        `keys` is given only that data is read, and the things are left
+        marked as not loaded so they aren't mistaken for complete ones;
+        they're never written to the cache either way. `after` may be a
+        thing or an _id to resume from.
+        """
+        after = getattr(after, '_id', after)
+
+        def build(record):
+            thing = cls._build(record.thing_id, record)
+            thing._t.update(record.data)
+            thing._loaded = keys is None
+            thing._asked_for_data = True
+            return thing
+
+        for batch in tdb.scan_things(cls._type_id, keys=keys, after=after,
+                                     batch_size=chunk_size, reverse=reverse,
+                                     deleted=deleted, spam=spam):
+            things = [build(record) for record in batch]
+            if chunks:
+                yield things
+            else:
+                for thing in things:
+                    yield thing
+
     def __getattr__(self, attr):
         return DataThing.__getattr__(self, attr)
 
@@ -698,6 +810,9 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
         _incr_data = staticmethod(tdb.incr_rel_data)
         _type_prefix = Relation._type_prefix
         _eagerly_loaded_data = False
+        # the side (1 or 2) whose things key the fast query index, if
+        # _fast_query should use one. see relindex
+        _fast_index_side = None
 
         # data means, do you load the reddit_data_rel_* fields (the data on the
         # rel itself). eager_load means, do you load thing1 and thing2
@@ -784,14 +899,110 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
                      '[unsaved]' if not self._created else '\b'))
 
         def _commit(self):
+            created = self._created
+            renamed = self._dirties.get('_name')
             DataThing._commit(self)
             #if i denormalized i need to check here
             if denorm1: self._thing1._commit(denorm1[0])
             if denorm2: self._thing2._commit(denorm2[0])
             #set fast query cache
-            cache.set(thing_prefix(self.__class__.__name__)
-                      + str((self._thing1_id, self._thing2_id, self._name)),
-                      self._id)
+            prefix = thing_prefix(self.__class__.__name__)
+            triple = (self._thing1_id, self._thing2_id, self._name)
+            cache.set(prefix + str(triple), self._id)
+            if not created:
+                self._update_fast_index(added=[triple])
+            elif renamed:
+                old_triple = (self._thing1_id, self._thing2_id, renamed[0])
+                cache.set(prefix + str(old_triple), None)
+                self._update_fast_index(added=[triple], removed=[old_triple])
+
+        @classmethod
+        def _get_fast_index(cls):
+            if not cls._fast_index_side:
+                return None
+            try:
+                return fast_indexes[cls]
+            except KeyError:
+                index = FastQueryIndex(thing_prefix(cls.__name__) + 'index_',
+                                       cls._type_id, cls._fast_index_side)
+                return fast_indexes.setdefault(cls, index)
+
+        @classmethod
+        def _update_fast_index(cls, added=(), removed=()):
+            index = cls._get_fast_index()
+            if index:
+                index.update(added=added, removed=removed)
+
+        @classmethod
+        def _create_multi(cls, pairs, name, date=None):
+            """Create a data-less relation named `name` between each
+               (thing1, thing2) in `pairs` with one multi-row insert, and
+               cache them all at once. Returns the new relations."""
+            if denorm1 or denorm2:
+                raise NotImplementedError("can't denormalize in bulk")
+
+            pairs = list(pairs)
+            if not pairs:
+                return []
+
+            if not date: date = datetime.now(g.tz)
+            triples = [(thing1._id, thing2._id, name)
+                       for thing1, thing2 in pairs]
+
+            begin()
+            try:
+                rel_ids = tdb.make_relations(cls._type_id, triples, date)
+            except:
+                rollback()
+                raise
+            else:
+                commit()
+
+            rels = []
+            for thing1, thing2 in pairs:
+                rel = cls(thing1, thing2, name, date,
+                          rel_ids[(thing1._id, thing2._id, name)])
+                rel._loaded = True
+                rels.append(rel)
+
+            prefix = thing_prefix(cls.__name__)
+            to_cache = {}
+            for rel in rels:
+                to_cache[rel._cache_key()] = rel
+                to_cache[prefix + str((rel._thing1_id, rel._thing2_id,
+                                       rel._name))] = rel._id
+            cache.set_multi(to_cache)
+            cls._update_fast_index(added=triples)
+
+            for rel in rels:
+                hooks.get_hook("thing.commit").call(thing=rel, changes={})
+            return rels
+
+        @classmethod
+        def _delete_multi(cls, rels):
+            """_delete for many relations, with one delete per table"""
+            rels = list(rels)
+            if not rels:
+                return
+
+            begin()
+            try:
+                tdb.del_rels(cls._type_id, [rel._id for rel in rels])
+            except:
+                rollback()
+                raise
+            else:
+                commit()
+
+            prefix = thing_prefix(cls.__name__)
+            triples = [(rel._thing1_id, rel._thing2_id, rel._name)
+                       for rel in rels]
+            cache.delete_multi([prefix + str(rel._id) for rel in rels])
+            cache.set_multi(dict((prefix + str(triple), None)
+                                 for triple in triples))
+            cls._update_fast_index(removed=triples)
+            for rel in rels:
+                rel._name = 'un' + rel._name
 
         def _delete(self):
             tdb.del_rel(self._type_id, self._id)
@@ -801,18 +1012,21 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
             #TODO - there should be just one cache key for a rel?
             cache.delete(prefix + str(self._id))
             #update fast query cache
-            cache.set(prefix + str((self._thing1_id,
-                                    self._thing2_id,
-                                    self._name)), None)
+            triple = (self._thing1_id, self._thing2_id, self._name)
+            cache.set(prefix + str(triple), None)
+            self._update_fast_index(removed=[triple])
             #temporarily set this property so the rest of this request
             #know it's deleted. save -> unsave, hide -> unhide
             self._name = 'un' + self._name
 
         @classmethod
         def _fast_query(cls, thing1s, thing2s, name, data=True, eager_load=True,
-                        thing_data=False, timestamp_optimize = False):
+                        thing_data=False, timestamp_optimize = False,
+                        use_index=True):
             """looks up all the relationships between thing1_ids and
-               thing2_ids and caches them"""
+               thing2_ids and caches them. if the relation has a fast
+               query index and it takes fewer keys, that answers which of
+               the pairs have no relationship."""
             prefix = thing_prefix(cls.__name__)
 
             thing1_dict = dict((t._id, t) for t in tup(thing1s))
@@ -863,7 +1077,14 @@ def Relation(type1, type2, denorm1 = None, denorm2 = None):
 
                 return rel_ids
 
-            res = sgm(cache, pairs, items_db, prefix)
+            res = {}
+            index = cls._get_fast_index() if use_index else None
+            if index and index.worthwhile(pairs):
+                missing, pairs = index.lookup(pairs)
+                res.update(dict.fromkeys(missing))
+
+            if pairs:
+                res.update(sgm(cache, pairs, items_db, prefix))
 
             #convert the keys back into objects
 
@@ -148,74 +148,120 @@ def share(link, emails, from_name = "", reply_to = "", body = ""):
                                body = body, reply_to = reply_to,
                                thing = link)
 
-def send_queued_mail(test = False):
-    """sends mail from the mail queue to smtplib for delivery.  Also,
-    on successes, empties the mail queue and adds all emails to the
-    sent_mail list."""
+def _render_queued(email):
+    """Fill in the body of a queued email, returning False if it shouldn't
+    be sent."""
     from r2.lib.pages import Share, Mail_Opt
+
+    should_queue = email.should_queue()
+    # check only on sharing that the mail is invalid
+    if email.kind == Email.Kind.SHARE:
+        if should_queue:
+            email.body = Share(username = email.from_name(),
+                               msg_hash = email.msg_hash,
+                               link = email.thing,
+                               body =email.body).render(style = "email")
+        else:
+            return False
+    elif email.kind == Email.Kind.OPTOUT:
+        email.body = Mail_Opt(msg_hash = email.msg_hash,
+                              leave = True).render(style = "email")
+    elif email.kind == Email.Kind.OPTIN:
+        email.body = Mail_Opt(msg_hash = email.msg_hash,
+                              leave = False).render(style = "email")
+    # handle unknown types here
+    elif not email.body:
+        return False
+    return True
+
+SET_SENT_BATCH = 100
+
+def send_queued_mail(test = False, smtp_server = None, sessions = 4,
+                     per_domain = 2):
+    """sends mail from the mail queue to smtplib for delivery.  Also,
+    removes each email that was sent or rejected from the mail queue and
+    adds it to the sent_mail or reject_mail list.  Emails that only got
+    transient errors are left in the queue to be tried again.
+
+    Emails are rendered here and sent by a pool of `sessions` SMTP
+    sessions, no more than `per_domain` of them to the same domain at
+    once (see r2.lib.smtp_pipeline).  To try it out without sending any
+    mail, run python's debugging server (python -m smtpd -n -c
+    DebuggingServer localhost:1025) and pass smtp_server =
+    "localhost:1025"."""
+    from r2.lib.smtp_pipeline import (
+        Delivery,
+        DeliveryPipeline,
+        FAILED,
+        SENT,
+    )
+
     now = datetime.datetime.now(g.tz)
     if not c.site:
         c.site = DefaultSR()
 
-    clear = False
-    if not test:
-        session = smtplib.SMTP(g.smtp_server)
-    def sendmail(email):
-        try:
-            mimetext = email.to_MIMEText()
-            if mimetext is None:
-                print ("Got None mimetext for email from %r and to %r"
-                       % (email.fr_addr, email.to_addr))
-            if test:
-                print mimetext.as_string()
-            else:
-                session.sendmail(email.fr_addr, email.to_addr,
-                                 mimetext.as_string())
-                email.set_sent(rejected = False)
-        # exception happens only for local recipient that doesn't exist
-        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused,
-                UnicodeDecodeError, AttributeError):
-            # handle error and print, but don't stall the rest of the queue
-            print "Handled error sending mail (traceback to follow)"
-            traceback.print_exc(file = sys.stdout)
-            email.set_sent(rejected = True)
+    found = [False]
+    sent = []
+    rejected = []
+    printed = []
 
+    def record(emails, rejected):
+        Email.set_sent_multi(emails, rejected = rejected)
+        Email.handler.remove_from_queue([email.uid for email in emails])
+        del emails[:]
 
-    try:
+    def deliveries():
         for email in Email.get_unsent(now):
-            clear = True
-
-            should_queue = email.should_queue()
-            # check only on sharing that the mail is invalid
-            if email.kind == Email.Kind.SHARE:
-                if should_queue:
-                    email.body = Share(username = email.from_name(),
-                                       msg_hash = email.msg_hash,
-                                       link = email.thing,
-                                       body =email.body).render(style = "email")
-                else:
-                    email.set_sent(rejected = True)
-                    continue
-            elif email.kind == Email.Kind.OPTOUT:
-                email.body = Mail_Opt(msg_hash = email.msg_hash,
-                                      leave = True).render(style = "email")
-            elif email.kind == Email.Kind.OPTIN:
-                email.body = Mail_Opt(msg_hash = email.msg_hash,
-                                      leave = False).render(style = "email")
-            # handle unknown types here
-            elif not email.body:
-                email.set_sent(rejected = True)
+            found[0] = True
+            if len(rejected) >= SET_SENT_BATCH:
+                record(rejected, True)
+
+            if not _render_queued(email):
+                rejected.append(email)
                 continue
-            sendmail(email)
 
-    finally:
-        if not test:
-            session.quit()
+            try:
+                mimetext = email.to_MIMEText()
+                if mimetext is None:
+                    print ("Got None mimetext for email from %r and to %r"
+                           % (email.fr_addr, email.to_addr))
+                message = mimetext.as_string()
+            # handle error and print, but don't stall the rest of the queue
+            except (UnicodeDecodeError, AttributeError):
+                print "Handled error sending mail (traceback to follow)"
+                traceback.print_exc(file = sys.stdout)
+                rejected.append(email)
+                continue
 
-    # clear is true if anything was found and processed above
-    if clear:
-        Email.handler.clear_queue(now)
+            if test:
+                print message
+                printed.append(email.uid)
+            else:
+                yield Delivery(email, email.fr_addr, email.to_addr, message)
 
+    pipeline = DeliveryPipeline(smtp_server or g.smtp_server,
+                                sessions = sessions,
+                                per_domain = per_domain)
+    try:
+        for delivery, outcome in pipeline.deliver(deliveries()):
+            if outcome == SENT:
+                sent.append(delivery.key)
+                if len(sent) >= SET_SENT_BATCH:
+                    record(sent, False)
+            elif outcome == FAILED:
+                rejected.append(delivery.key)
+            # deferred messages (the server kept giving transient errors)
+            # stay in the queue for the next run
+    finally:
+        record(sent, False)
+        record(rejected, True)
+        Email.handler.remove_from_queue(printed)
+
+    if found[0] and not test:
+        print pipeline.summary()
+        g.stats.simple_event('email.sent', delta = pipeline.sent)
+        g.stats.simple_event('email.failed', delta = pipeline.failed)
+        g.stats.simple_event('email.deferred', delta = pipeline.deferred)
 
 
 def opt_out(msg_hash):
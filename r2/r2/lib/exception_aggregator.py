@@ -0,0 +1,333 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""Group the exceptions reported to log_q by fingerprint.
+
+A fingerprint names the code path an exception came from: its type and the
+file, line number and function of each frame of its traceback. The values
+involved (the exception's message and the source text of each line) are
+left out, so the same bug hit with different data is one fingerprint.
+
+Occurrences are counted in buckets of a minute per fingerprint so that they
+can be summed over sliding windows, next to when the fingerprint was first
+and last seen and a sample of its latest occurrence. All of that is kept in
+a SQLite file so that it survives restarts of the consumer.
+
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import time
+
+
+BUCKET_SIZE = 60
+WINDOWS = (
+    ("5 minutes", 5 * 60),
+    ("hour", 60 * 60),
+    ("day", 24 * 60 * 60),
+)
+DIGEST_INTERVAL = 60 * 60
+DIGEST_SIZE = 25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fingerprints (
+    fingerprint TEXT PRIMARY KEY,
+    nickname TEXT,
+    exc_type TEXT,
+    first_seen REAL,
+    last_seen REAL,
+    total INTEGER,
+    sample TEXT
+);
+CREATE TABLE IF NOT EXISTS counts (
+    fingerprint TEXT,
+    bucket INTEGER,
+    count INTEGER,
+    PRIMARY KEY (fingerprint, bucket)
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+
+# strip the install location from paths so that every app server agrees
+_install_prefix = re.compile(r"^.*/(?:site-packages|dist-packages)/|"
+                             r"^.*/(?=r2/)")
+
+
+def normalize_path(filename):
+    filename = _install_prefix.sub("", filename)
+    if filename.endswith((".pyc", ".pyo")):
+        filename = filename[:-1]
+    return filename
+
+
+def _known_fingerprint(exc_type, exc_desc, traceback):
+    """Recognize the operational errors that get one fingerprint no matter
+    where they're raised from."""
+    make_lock_seen = False
+    cassandra_seen = False
+
+    for filename, lineno, funcname, text in traceback:
+        if text and (text.startswith("with g.make_lock(") or
+                     text.startswith("with make_lock(")):
+            make_lock_seen = True
+        if ('/cassandra/' in filename.lower() or
+            '/pycassa/' in filename.lower()):
+            cassandra_seen = True
+
+    if exc_desc.startswith("QueuePool limit of size"):
+        return "QueuePool_overflow"
+    elif exc_desc.startswith("error 2 from memcached_get: HOSTNAME "):
+        return "memcache_suckitude"
+    elif exc_type == "TimeoutExpired" and make_lock_seen:
+        return "make_lock_timeout"
+    elif exc_desc.startswith("(OperationalError) FATAL: the database " +
+                             "system is in recovery mode"):
+        return "recovering_db"
+    elif exc_desc.startswith("(OperationalError) could not connect " +
+                             "to server"):
+        return "unconnectable_db"
+    elif exc_desc.startswith("(OperationalError) server closed the " +
+                             "connection unexpectedly"):
+        return "flaky_db_op"
+    elif cassandra_seen:
+        return "something's wrong with cassandra"
+    return None
+
+
+def fingerprint(exc_type, exc_desc, traceback):
+    """Return the fingerprint for an exception.
+
+    `traceback` is a list of (filename, lineno, funcname, text) as from
+    traceback.extract_tb. The description is only used to recognize a few
+    operational errors, it's never part of the hash.
+
+    """
+    known = _known_fingerprint(exc_type, exc_desc, traceback)
+    if known:
+        return known
+
+    frames = ["%s:%s %s" % (normalize_path(filename), lineno, funcname)
+              for filename, lineno, funcname, text in traceback]
+    key_material = "\n".join([exc_type] + frames)
+    return hashlib.md5(key_material).hexdigest()
+
+
+def legacy_fingerprint(exc_type, exc_desc, traceback):
+    """Return the fingerprint log_q used to give an exception, which its
+    error_nickname-* and error_status-* hardcache keys were made from.
+
+    It hashed each frame's raw filename and function name but not the line
+    number.
+
+    """
+    known = _known_fingerprint(exc_type, exc_desc, traceback)
+    if known:
+        return known
+
+    key_material = exc_type
+    for filename, lineno, funcname, text in traceback:
+        key_material += "%s %s " % (filename, funcname)
+    return hashlib.md5(key_material).hexdigest()
+
+
+def format_traceback(traceback):
+    lines = []
+    for filename, lineno, funcname, text in traceback:
+        lines.append("%s:%s: %s()" % (filename, lineno, funcname))
+        lines.append("    %s" % text)
+    return "\n".join(lines)
+
+
+class ExceptionAggregator(object):
+    """Counts of exceptions by fingerprint, stored in a SQLite file.
+
+    record() doesn't commit, so a consumer can record a whole batch of
+    messages and then commit() once.
+
+    """
+
+    def __init__(self, path, bucket_size=BUCKET_SIZE, windows=WINDOWS,
+                 digest_interval=DIGEST_INTERVAL):
+        self.bucket_size = bucket_size
+        self.windows = windows
+        self.digest_interval = digest_interval
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        if self._get_state("last_digest") is None:
+            # a fresh file's first digest shouldn't cover everything ever
+            self._set_state("last_digest", time.time())
+        self.db.commit()
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def record(self, exc_type, exc_desc, traceback, when=None,
+               occurrence=None, nickname=None):
+        """Count one occurrence of an exception.
+
+        `when` is in seconds since the epoch and defaults to now.
+        `nickname` is only stored if this is the first time the fingerprint
+        has been seen. Returns the fingerprint and whether it's new.
+
+        """
+        if when is None:
+            when = time.time()
+
+        fp = fingerprint(exc_type, exc_desc, traceback)
+        sample = json.dumps(dict(
+            exception="%s: %s" % (exc_type, exc_desc),
+            traceback=traceback,
+            occurrence=occurrence,
+        ))
+
+        cursor = self.db.execute(
+            "UPDATE fingerprints SET total = total + 1,"
+            " first_seen = MIN(first_seen, ?),"
+            " last_seen = MAX(last_seen, ?), sample = ?"
+            " WHERE fingerprint = ?", (when, when, sample, fp))
+        is_new = cursor.rowcount == 0
+        if is_new:
+            self.db.execute(
+                "INSERT INTO fingerprints (fingerprint, nickname, exc_type,"
+                " first_seen, last_seen, total, sample)"
+                " VALUES (?, ?, ?, ?, ?, 1, ?)",
+                (fp, nickname or fp, exc_type, when, when, sample))
+
+        bucket = int(when // self.bucket_size)
+        cursor = self.db.execute(
+            "UPDATE counts SET count = count + 1"
+            " WHERE fingerprint = ? AND bucket = ?", (fp, bucket))
+        if cursor.rowcount == 0:
+            self.db.execute(
+                "INSERT INTO counts (fingerprint, bucket, count)"
+                " VALUES (?, ?, 1)", (fp, bucket))
+
+        return fp, is_new
+
+    def get(self, fp):
+        row = self.db.execute("SELECT * FROM fingerprints"
+                              " WHERE fingerprint = ?", (fp,)).fetchone()
+        if row is None:
+            return None
+        info = dict(zip(row.keys(), row))
+        info["sample"] = json.loads(info["sample"])
+        return info
+
+    def count_since(self, since):
+        """Return {fingerprint: occurrences} for all occurrences at or after
+        `since`, to the resolution of the buckets."""
+        bucket = int(since // self.bucket_size)
+        rows = self.db.execute(
+            "SELECT fingerprint, SUM(count) FROM counts WHERE bucket >= ?"
+            " GROUP BY fingerprint", (bucket,))
+        return dict((fp, count) for fp, count in rows)
+
+    def window_counts(self, now=None):
+        """Return {fingerprint: {window name: occurrences}} over each of the
+        sliding windows, for every fingerprint seen in the longest one."""
+        if now is None:
+            now = time.time()
+
+        ret = {}
+        for name, length in self.windows:
+            for fp, count in self.count_since(now - length).iteritems():
+                ret.setdefault(fp, dict.fromkeys(
+                    (n for n, l in self.windows), 0))[name] = count
+        return ret
+
+    def prune(self, now=None):
+        """Forget counts that have fallen out of every window."""
+        if now is None:
+            now = time.time()
+        longest = max(length for name, length in self.windows)
+        bucket = int((now - longest) // self.bucket_size)
+        self.db.execute("DELETE FROM counts WHERE bucket < ?", (bucket,))
+
+    def _get_state(self, key):
+        row = self.db.execute("SELECT value FROM state WHERE key = ?",
+                              (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO state (key, value)"
+                        " VALUES (?, ?)", (key, value))
+
+    def digest_due(self, now=None):
+        if now is None:
+            now = time.time()
+        return now - self._get_state("last_digest") >= self.digest_interval
+
+    def digest(self, now=None, limit=DIGEST_SIZE):
+        """Summarize the fingerprints seen since the last digest.
+
+        Returns the text of the digest, or None if nothing happened, and
+        starts the next digest period.
+
+        """
+        if now is None:
+            now = time.time()
+
+        since = self._get_state("last_digest")
+        self._set_state("last_digest", now)
+        self.prune(now)
+        self.commit()
+
+        recent = self.count_since(since)
+        if not recent:
+            return None
+
+        windows = self.window_counts(now)
+        top = sorted(recent, key=recent.get, reverse=True)[:limit]
+
+        lines = ["%d kinds of exception happened %d times since %s." % (
+            len(recent), sum(recent.itervalues()),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(since)))]
+        for fp in top:
+            info = self.get(fp)
+            counts = windows.get(fp, {})
+            lines.append("")
+            lines.append("%s (%s): %d since the last digest, %d ever" % (
+                info["nickname"], fp, recent[fp], info["total"]))
+            lines.append("    " + ", ".join(
+                "%d in the last %s" % (counts.get(name, 0), name)
+                for name, length in self.windows))
+            lines.append("    first seen %s, last seen %s" % (
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.gmtime(info["first_seen"])),
+                time.strftime("%Y-%m-%d %H:%M:%S",
+                              time.gmtime(info["last_seen"]))))
+            lines.append("    %s" % info["sample"]["exception"])
+        if len(recent) > len(top):
+            lines.append("")
+            lines.append("...and %d more." % (len(recent) - len(top)))
+        return "\n".join(lines)
@@ -24,9 +24,11 @@ from pylons import g
 from datetime import timedelta as timedelta
 from datetime import datetime
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import ARRAY
 from r2.lib.db.tdb_lite import tdb_lite
 import pytz
 import random
+import time
 
 COUNT_CATEGORY = 'hc_count'
 ELAPSED_CATEGORY = 'hc_elapsed'
@@ -37,6 +39,26 @@ def expiration_from_time(time):
         raise ValueError ("HardCache items *must* have an expiration time")
     return datetime.now(TZ) + timedelta(0, time)
 
+def any_of(column, values):
+    """column = ANY(values), with the values sent as one array rather than
+    as a clause each."""
+    return column == sa.func.any(sa.literal(list(values), ARRAY(sa.String)))
+
+COLUMNS = ('category', 'ids', 'value', 'kind', 'expiration')
+
+def multi_insert(table, rows):
+    """A single INSERT of all of rows (dicts of COLUMNS), and its bind
+    parameters."""
+    values = []
+    params = {}
+    for i, row in enumerate(rows):
+        names = ["%s_%d" % (column, i) for column in COLUMNS]
+        values.append("(%s)" % ", ".join(":" + name for name in names))
+        params.update(zip(names, (row[column] for column in COLUMNS)))
+    statement = sa.text("INSERT INTO %s (%s) VALUES %s" %
+                        (table.name, ", ".join(COLUMNS), ", ".join(values)))
+    return statement, params
+
 class HardCacheBackend(object):
     def __init__(self, gc):
         self.tdb = tdb_lite(gc)
@@ -160,6 +182,53 @@ class HardCacheBackend(object):
 
         self.profile_stop(prof)
 
+    def set_multi(self, category, vals, time):
+        """set() each of a dict of ids to values in one category.
+
+        Our postgres has no upsert, so the existing rows are deleted and
+        the new ones written with a single multi-row insert, in one
+        transaction.
+        """
+        if not vals:
+            return
+
+        expiration = expiration_from_time(time)
+
+        rows = []
+        for ids, val in vals.iteritems():
+            value, kind = self.tdb.py2db(val, True)
+            rows.append(dict(category=category, ids=ids, value=value,
+                             kind=kind, expiration=expiration))
+
+        prof = self.profile_start('set_multi', category)
+
+        engine = self.engine_by_category(category, "master")
+
+        conn = engine.bind.connect()
+        try:
+            trans = conn.begin()
+            try:
+                conn.execute(engine.delete(
+                    sa.and_(engine.c.category==category,
+                            any_of(engine.c.ids, vals.keys()))))
+                statement, params = multi_insert(engine, rows)
+                conn.execute(statement, params)
+                trans.commit()
+                conflicted = False
+            except sa.exc.IntegrityError:
+                # one of them was added in between the delete and the
+                # insert, so fall back to setting them one at a time
+                trans.rollback()
+                conflicted = True
+        finally:
+            conn.close()
+
+        self.profile_stop(prof)
+
+        if conflicted:
+            for ids, val in vals.iteritems():
+                self.set(category, ids, val, time)
+
     def add(self, category, ids, val, time=0):
         self.delete_if_expired(category, ids)
 
@@ -222,6 +291,38 @@ class HardCacheBackend(object):
         else:
             raise ValueError("Somehow %d rows got updated" % rp.rowcount)
 
+    def incr_multi(self, category, idses, time, delta=1):
+        """incr() a list of ids in one category with a single UPDATE.
+
+        Returns a dict of ids to their new values. Unlike incr(), ids that
+        aren't set, have expired or aren't numbers are left out of it
+        rather than raising ValueError.
+        """
+        expiration = expiration_from_time(time)
+
+        prof = self.profile_start('incr_multi', category)
+
+        engine = self.engine_by_category(category, "master")
+
+        rp = engine.update(sa.and_(engine.c.category==category,
+                                   any_of(engine.c.ids, idses),
+                                   engine.c.kind=='num',
+                                   engine.c.expiration >= datetime.now(TZ)),
+                           values = {
+                                   engine.c.value:
+                                           sa.cast(
+                                           sa.cast(engine.c.value, sa.Integer)
+                                           + delta, sa.String),
+                                   engine.c.expiration: expiration
+                                   }
+                           ).returning(engine.c.ids, engine.c.value).execute()
+        rows = rp.fetchall()
+
+        self.profile_stop(prof)
+
+        return dict((row.ids, self.tdb.db2py(row.value, 'num'))
+                    for row in rows)
+
     def get(self, category, ids, force_write_table=False):
         if force_write_table:
             type = "master"
@@ -259,8 +360,7 @@ class HardCacheBackend(object):
                        engine.c.kind,
                        engine.c.expiration],
                       sa.and_(engine.c.category==category,
-                              sa.or_(*[engine.c.ids==ids
-                                       for ids in idses])))
+                              any_of(engine.c.ids, idses)))
         rows = s.execute().fetchall()
 
         self.profile_stop(prof)
@@ -321,6 +421,34 @@ class HardCacheBackend(object):
                               expiration_clause)).execute()
         self.profile_stop(prof)
 
+    def sweep_batch(self, engine, cursor=None, limit=500):
+        """Delete the next batch of up to limit expired rows from a master.
+
+        cursor is the expiration the previous batch got up to, so that the
+        expiration index is read from there rather than from the start,
+        where the rows already deleted wait to be vacuumed. Returns the
+        number of rows deleted and the cursor for the next batch.
+        """
+        expiration_clause = self.clause_from_expiration(engine, "now")
+        if cursor is not None:
+            expiration_clause = sa.and_(expiration_clause,
+                                        engine.c.expiration >= cursor)
+
+        rows = self.expired(engine, expiration_clause, limit)
+        if not rows:
+            return 0, cursor
+        last_expiration = rows[-1][0]
+
+        mc_keys = [ "%s-%s" % (c, i) for e, c, i in rows ]
+        g.memcache.delete_multi(mc_keys)
+
+        # this also gets any rows past the limit that expired at the same
+        # moment as the last one, which memcache will have expired as well
+        rp = engine.delete(
+            sa.and_(expiration_clause,
+                    engine.c.expiration <= last_expiration)).execute()
+        return rp.rowcount, last_expiration
+
 
 def delete_expired(expiration="now", limit=5000):
     hcb = HardCacheBackend(g)
@@ -350,3 +478,56 @@ def delete_expired(expiration="now", limit=5000):
         # near-instantaneous expiration could have been added and expired, and
         # thus it'll be deleted from the backend but not memcache. But that's
         # okay, because it should be expired from memcache anyway by now.
+
+
+def sweep_expired(batch_size=500, max_rate=1000, idle_time=10,
+                  report_interval=60):
+    """Delete expired rows from every master as they expire, forever.
+
+    Masters are swept a batch at a time (see HardCacheBackend.sweep_batch),
+    at no more than max_rate rows a second between them, and the rate
+    actually achieved is reported every report_interval seconds.
+    """
+    hcb = HardCacheBackend(g)
+
+    masters = set()
+
+    for engines in hcb.mapping.values():
+        masters.add(engines[0])
+
+    cursors = {}
+    report_start = time.time()
+    swept = 0
+
+    while True:
+        batch_start = time.time()
+        deleted = 0
+        full = False
+
+        for engine in masters:
+            count, cursors[engine] = hcb.sweep_batch(engine,
+                                                     cursors.get(engine),
+                                                     batch_size)
+            deleted += count
+            full = full or count >= batch_size
+
+        if deleted:
+            g.stats.simple_event('hardcache.sweep.deleted', delta=deleted)
+        swept += deleted
+
+        now = time.time()
+        if now - report_start >= report_interval:
+            print ("hardcache sweeper: %d rows in %.0fs (%.1f rows/s)" %
+                   (swept, now - report_start,
+                    swept / (now - report_start)))
+            report_start = now
+            swept = 0
+            # start over from the oldest rows now and then, in case any
+            # got written behind a cursor by a server with a slow clock
+            cursors.clear()
+
+        if full:
+            # keep up with the backlog, no faster than max_rate
+            time.sleep(max(0, float(deleted) / max_rate - (now - batch_start)))
+        else:
+            time.sleep(idle_time)
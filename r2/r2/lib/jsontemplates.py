@@ -39,6 +39,16 @@ def make_fullname(typ, _id):
     return '%s_%s' % (make_typename(typ), to36(_id))
 
 
+class ExtractedData(dict):
+    """Finished data for a thing from a compiled extractor.
+
+    It has no stubs or template variables left in it, so ObjectTemplate
+    passes it through as is rather than rebuilding it field by field.
+
+    """
+    pass
+
+
 class ObjectTemplate(StringTemplate):
     def __init__(self, d):
         self.d = d
@@ -47,6 +57,8 @@ class ObjectTemplate(StringTemplate):
         def _update(obj):
             if isinstance(obj, (str, unicode)):
                 return StringTemplate(obj).finalize(kw)
+            elif isinstance(obj, ExtractedData):
+                return obj
             elif isinstance(obj, dict):
                 return dict((k, _update(v)) for k, v in obj.iteritems())
             elif isinstance(obj, (list, tuple)):
@@ -102,12 +114,114 @@ class UserItemHTMLJsonTemplate(TableRowTemplate):
         return "thing"
 
 
+# compiled extractors by (template class, api subtype, moderator)
+_extractors = {}
+
+_AUTHOR_ATTRS = ("author", "author_flair_text", "author_flair_css_class")
+_TIMESTAMP_ATTRS = ("created", "created_utc")
+_MODERATOR_ATTRS = ("num_reports", "banned_by", "approved_by")
+
+
+def _timestamps(date):
+    """The created and created_utc of a thing, as thing_attr has them."""
+    return (time.mktime(date.timetuple()),
+            time.mktime(date.astimezone(pytz.UTC).timetuple()) - time.timezone)
+
+
+def _author_attrs(thing):
+    """The author, author_flair_text and author_flair_css_class of a thing,
+    as thing_attr has them."""
+    author = thing.author
+    if author._deleted:
+        return "[deleted]", None, None
+    sr_id = thing.subreddit._id
+    if not author.flair_enabled_in_sr(sr_id):
+        return author.name, None, None
+    return (author.name,
+            getattr(author, 'flair_%s_text' % sr_id, None),
+            getattr(author, 'flair_%s_css_class' % sr_id, None))
+
+
+def _distinguished(thing):
+    distinguished = getattr(thing, 'distinguished', 'no')
+    if distinguished == 'no':
+        return None
+    return distinguished
+
+
+def _moderator_attr(thing, attr):
+    """thing_attr of num_reports, banned_by or approved_by for a moderator
+    of the thing's subreddit."""
+    if attr == "num_reports":
+        return thing.reported
+    ban_info = getattr(thing, "ban_info", {})
+    if attr == "banned_by":
+        banner = (ban_info.get("banner")
+                  if ban_info.get('moderator_banned')
+                  else True)
+        return banner if thing._spam else None
+    return ban_info.get("unbanner") if not thing._spam else None
+
+
+def _unfinished(value):
+    """Whether value still has stubs or template variables for ObjectTemplate
+    to fill in."""
+    if isinstance(value, basestring):
+        return StringTemplate.start_delim in value
+    elif isinstance(value, dict):
+        return any(_unfinished(v) for v in value.itervalues())
+    elif isinstance(value, (list, tuple)):
+        return any(_unfinished(v) for v in value)
+    return isinstance(value, CacheStub)
+
+
+def extract_thing(wrapped, moderators):
+    """Return the data for a thing in a listing from its template's compiled
+    extractor, or None if the thing has to be rendered.
+
+    moderators caches whether c.user moderates each subreddit, by id, for
+    the things of one listing.
+
+    """
+    from r2.config.templates import tpm
+
+    try:
+        template = tpm.get(wrapped.render_class, c.render_style,
+                           cache=not g.reload_templates)
+    except AttributeError:
+        return None
+    if not isinstance(template, ThingJsonTemplate):
+        return None
+
+    moderator = False
+    if c.user_is_loggedin and template.moderator_attrs():
+        sr = wrapped.subreddit
+        if sr._id not in moderators:
+            moderators[sr._id] = bool(sr.is_moderator(c.user))
+        moderator = moderators[sr._id]
+
+    extract = template.extractor(moderator)
+    if not extract:
+        return None
+    data = extract(template, wrapped)
+    if _unfinished(data):
+        return None
+    return ExtractedData(kind=template.kind(wrapped), data=data)
+
+
 class ThingJsonTemplate(JsonTemplate):
     _data_attrs_ = dict(id           = "_id36",
                         name         = "_fullname",
                         created      = "created",
                         created_utc  = "created_utc")
 
+    # the attrs thing_attr computes, rather than just getting them from the
+    # thing. a subclass that overrides thing_attr lists the attrs it handles
+    # in its own _computed_attrs_, or it won't get a compiled extractor.
+    _computed_attrs_ = frozenset(_AUTHOR_ATTRS + _TIMESTAMP_ATTRS +
+                                 _MODERATOR_ATTRS +
+                                 ("child", "distinguished"))
+
     @classmethod
     def data_attrs(cls, **kw):
         d = cls._data_attrs_.copy()
@@ -216,6 +330,78 @@ class ThingJsonTemplate(JsonTemplate):
         return ObjectTemplate(dict(kind = self.kind(thing),
                                    data = self.data(thing)))
 
+    @classmethod
+    def moderator_attrs(cls):
+        """The attrs of this template that differ for moderators."""
+        return set(_MODERATOR_ATTRS).intersection(cls._data_attrs_.values())
+
+    @classmethod
+    def extractor(cls, moderator=False):
+        """Return a function of (template, thing) giving the same data as
+        raw_data, compiled for this template, or None if there isn't one."""
+        key = (cls, get_api_subtype(), moderator)
+        try:
+            return _extractors[key]
+        except KeyError:
+            extract = None if key[1] else cls._compile_extractor(moderator)
+            _extractors[key] = extract
+            return extract
+
+    @classmethod
+    def _compile_extractor(cls, moderator):
+        # only raw_data and thing_attr are compiled, so subclasses that
+        # build their data some other way, or handle attrs in thing_attr
+        # without saying which, have to be rendered
+        computed = set()
+        for klass in cls.__mro__:
+            if klass is ThingJsonTemplate:
+                break
+            if any(name in klass.__dict__
+                   for name in ('raw_data', 'data', 'render')):
+                return None
+            if 'thing_attr' in klass.__dict__:
+                if '_computed_attrs_' not in klass.__dict__:
+                    return None
+                computed.update(klass.__dict__['_computed_attrs_'])
+
+        attrs = cls._data_attrs_
+        # replies are filled in by the listing after the thing is rendered
+        if "child" in attrs.values():
+            return None
+
+        def inherited(names):
+            return set(names).intersection(attrs.values()) - computed
+
+        lines = ["def extract(template, thing):"]
+        if inherited(_TIMESTAMP_ATTRS):
+            lines.append("    created, created_utc = _timestamps(thing._date)")
+        if inherited(_AUTHOR_ATTRS):
+            lines.append("    (author, author_flair_text,"
+                         " author_flair_css_class) = _author_attrs(thing)")
+        lines.append("    return {")
+        for k, attr in sorted(attrs.iteritems()):
+            if attr in computed:
+                value = "template.thing_attr(thing, %r)" % attr
+            elif attr in _TIMESTAMP_ATTRS or attr in _AUTHOR_ATTRS:
+                value = attr
+            elif attr == "distinguished":
+                value = "_distinguished(thing)"
+            elif attr in _MODERATOR_ATTRS and moderator:
+                value = "_moderator_attr(thing, %r)" % attr
+            else:
+                value = "getattr(thing, %r, None)" % attr
+            lines.append("        %r: %s," % (k, value))
+        lines.append("    }")
+
+        namespace = dict(_timestamps=_timestamps,
+                         _author_attrs=_author_attrs,
+                         _distinguished=_distinguished,
+                         _moderator_attr=_moderator_attr)
+        code = compile("\n".join(lines) + "\n",
+                       "<%s extractor>" % cls.__name__, "exec")
+        exec code in namespace
+        return namespace["extract"]
+
 class SubredditJsonTemplate(ThingJsonTemplate):
     _data_attrs_ = ThingJsonTemplate.data_attrs(subscribers  = "_ups",
                                                 title        = "title",
@@ -230,6 +416,8 @@ class SubredditJsonTemplate(ThingJsonTemplate):
                                                 header_title = "header_title",
                                                 accounts_active = "accounts_active",
                                                 )
+    _computed_attrs_ = frozenset(("_ups", "accounts_active",
+                                  "description_html"))
 
     def thing_attr(self, thing, attr):
         if attr == "_ups" and thing.hide_subscribers:
@@ -251,6 +439,7 @@ class IdentityJsonTemplate(ThingJsonTemplate):
                                                 over_18 = "pref_over_18",
                                                 has_verified_email = "email_verified",
                                                 )
+    _computed_attrs_ = frozenset(("is_mod",))
 
     def thing_attr(self, thing, attr):
         from r2.models import Subreddit
@@ -322,6 +511,9 @@ class LinkJsonTemplate(ThingJsonTemplate):
                                                 permalink    = "permalink",
                                                 edited       = "editted"
                                                 )
+    _computed_attrs_ = frozenset(("media_embed", "editted", "subreddit",
+                                  "subreddit_id", "selftext",
+                                  "selftext_html"))
 
     def thing_attr(self, thing, attr):
         from r2.lib.scraper import get_media_embed
@@ -548,9 +740,12 @@ class ListingJsonTemplate(ThingJsonTemplate):
             return c.modhash
         elif attr == "things":
             res = []
+            moderators = {}
             for a in thing.things:
                 a.childlisting = False
-                r = a.render()
+                r = extract_thing(a, moderators)
+                if r is None:
+                    r = a.render()
                 res.append(r)
             return res
         return ThingJsonTemplate.thing_attr(self, thing, attr)
@@ -0,0 +1,1002 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""An in-process search backend answering the same queries as CloudSearch.
+
+This is meant for development and CI, where there is no CloudSearch
+domain to talk to, and for small installs that would rather not have
+another network hop on every search. Set
+
+    search_provider = local
+    local_search_dir = /path/to/index
+
+in the ini and run the queue consumer in place of cloudsearch's:
+
+    paster run $INI r2/lib/localsearch.py -c 'run_changed()'
+
+Documents are the same LinkFields/SubredditFields dicts that the
+cloudsearch uploaders send, and they're indexed through those uploaders
+too (see LocalUploaderMixin). Each index is a directory of immutable
+segments, each written in one go by a batch of updates and read back
+through mmap:
+
+    meta.json     document count, total length and deleted fullnames
+    ids           "fullname\\tversion" for every document
+    stored        the JSON document fields, used when merging segments
+    terms.bin     the sorted, concatenated utf-8 terms
+    terms.idx     (term offset, term length, postings offset, doc freq)
+    postings.bin  (document, term frequency) pairs
+    lengths.bin   the number of default-field words in each document
+    <name>.num    a double for each document, for sorts and ranges
+    <name>.facet  an int index into <name>.values for each document
+
+All of the binary files are in native byte order, so an index isn't
+portable between architectures. `segments.json` lists the current
+segments, oldest first, and is replaced atomically by writers, which
+also hold `write.lock` while they work. As in CloudSearch, the document
+with the highest version wins, so readers work out which documents are
+live whenever the segment list changes.
+"""
+
+import array
+import collections
+import contextlib
+import errno
+import fcntl
+import functools
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+
+from lxml import etree
+from pylons import g
+
+from r2.lib import cloudsearch
+from r2.lib.cloudsearch import (DEFAULT_FACETS, InvalidQuery, LinkFields,
+                                LinkSearchQuery, LinkUploader, Results,
+                                SubredditFields, SubredditSearchQuery,
+                                SubredditUploader, _safe_xml_str)
+from r2.lib.db.sorts import _hot
+import r2.lib.utils as r2utils
+from r2.models import Link, Subreddit
+
+
+FORMAT_VERSION = 1
+MANIFEST = "segments.json"
+LOCK = "write.lock"
+META = "meta.json"
+IDS = "ids"
+STORED = "stored"
+TERMS = "terms.bin"
+TERM_INDEX = "terms.idx"
+POSTINGS = "postings.bin"
+LENGTHS = "lengths.bin"
+
+# segments are merged once there are this many of roughly the same size
+MERGE_FACTOR = 10
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+_TERM_ENTRY = struct.Struct("=IIII")
+_POSTING_SIZE = 8
+_WORD = re.compile(r"\w+", re.UNICODE)
+RELEVANCE_RANKS = ("relevance", "text_relevance")
+
+
+class Schema(object):
+    '''What to do with each field of the documents in an index.
+
+    Numeric fields are kept in columns for sorting and ranges, and all
+    other fields are split into words. Words from the default fields are
+    also what unqualified query terms are matched against, and ranks are
+    extra sort columns computed from the numeric fields at index time,
+    like the rank expressions defined in CloudSearch.
+
+    '''
+    def __init__(self, name, fields, numeric_fields, default_fields,
+                 facet_fields=(), ranks=None):
+        self.name = name
+        self.numeric_fields = tuple(numeric_fields)
+        self.field_names = (set(fields.cloudsearch_fieldnames()) |
+                            set(self.numeric_fields))
+        self.default_fields = frozenset(default_fields)
+        self.facet_fields = tuple(facet_fields)
+        self.ranks = ranks or {}
+        self.sort_fields = self.numeric_fields + tuple(sorted(self.ranks))
+
+
+LINK_SCHEMA = Schema(
+    "links",
+    fields=LinkFields,
+    numeric_fields=LinkFields.cloudsearch_fieldnames(type_=int),
+    default_fields=("title", "selftext", "author", "reddit", "site", "url",
+                    "flair_text"),
+    facet_fields=("reddit",),
+    ranks={
+        "hot2": lambda n: _hot(n["ups"], n["downs"], n["timestamp"]),
+        "top": lambda n: n["ups"] - n["downs"],
+    },
+)
+
+
+SUBREDDIT_SCHEMA = Schema(
+    "subreddits",
+    fields=SubredditFields,
+    # activity, subscribers and type_id are sent as strings, but are
+    # numbers as far as searching goes
+    numeric_fields=(SubredditFields.cloudsearch_fieldnames(type_=int) +
+                    ["activity", "subscribers", "type_id"]),
+    default_fields=("name", "title", "description", "header_title"),
+)
+
+
+def tokenize(text):
+    return [word.lower() for word in _WORD.findall(text)]
+
+
+def _values(value):
+    if isinstance(value, (list, tuple)):
+        return value
+    return [value]
+
+
+def _number(value):
+    if isinstance(value, (list, tuple)):
+        value = value[0] if value else None
+    if value is None:
+        return 0.0
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def _text_term(field_name, word):
+    '''Words from default fields are also indexed with an empty field
+    name, which is what unqualified query terms look up'''
+    return (u"%s:%s" % (field_name or u"", word)).encode("utf-8")
+
+
+def _number_term(field_name, number):
+    return "%s=%r" % (field_name, float(number))
+
+
+def _analyze(schema, fields):
+    '''Return the term frequencies and the default-field length of a
+    document'''
+    terms = collections.Counter()
+    length = 0
+    for name, value in fields.iteritems():
+        if name in schema.numeric_fields:
+            terms[_number_term(name, _number(value))] += 1
+            continue
+        for item in _values(value):
+            for word in tokenize(item):
+                terms[_text_term(name, word)] += 1
+                if name in schema.default_fields:
+                    terms[_text_term(None, word)] += 1
+                    length += 1
+    return terms, length
+
+
+def _numbers(schema, fields):
+    numbers = dict((name, _number(fields.get(name)))
+                   for name in schema.numeric_fields)
+    for name, rank in schema.ranks.iteritems():
+        numbers[name] = float(rank(numbers))
+    return numbers
+
+
+def _write_segment(path, schema, docs, deletes):
+    '''Write `docs`, a list of (fullname, version, fields), and `deletes`,
+    a dict of fullname to version, as a new segment in the directory
+    `path`'''
+    postings = collections.defaultdict(list)
+    lengths = array.array("I")
+    columns = dict((name, array.array("d")) for name in schema.sort_fields)
+    facets = dict((name, array.array("i")) for name in schema.facet_fields)
+    facet_values = dict((name, {}) for name in schema.facet_fields)
+    total_length = 0
+
+    with open(os.path.join(path, IDS), "wb") as ids, \
+         open(os.path.join(path, STORED), "wb") as stored:
+        for doc, (fullname, version, fields) in enumerate(docs):
+            ids.write("%s\t%d\n" % (fullname.encode("utf-8"), version))
+            stored.write(json.dumps([fullname, version, fields]) + "\n")
+
+            terms, length = _analyze(schema, fields)
+            for term, frequency in terms.iteritems():
+                postings[term].append((doc, frequency))
+            lengths.append(length)
+            total_length += length
+
+            numbers = _numbers(schema, fields)
+            for name in schema.sort_fields:
+                columns[name].append(numbers[name])
+
+            for name in schema.facet_fields:
+                values = _values(fields.get(name))
+                if not values or values[0] is None:
+                    facets[name].append(-1)
+                else:
+                    ordinals = facet_values[name]
+                    facets[name].append(ordinals.setdefault(values[0],
+                                                            len(ordinals)))
+
+    term_index = array.array("I")
+    posting_data = array.array("I")
+    with open(os.path.join(path, TERMS), "wb") as terms_file:
+        term_offset = 0
+        for term in sorted(postings):
+            term_postings = postings[term]
+            term_index.extend((term_offset, len(term),
+                               len(posting_data) / 2, len(term_postings)))
+            for doc, frequency in term_postings:
+                posting_data.append(doc)
+                posting_data.append(frequency)
+            terms_file.write(term)
+            term_offset += len(term)
+
+    def write_array(filename, data):
+        with open(os.path.join(path, filename), "wb") as f:
+            data.tofile(f)
+
+    write_array(TERM_INDEX, term_index)
+    write_array(POSTINGS, posting_data)
+    write_array(LENGTHS, lengths)
+    for name, column in columns.iteritems():
+        write_array("%s.num" % name, column)
+    for name, column in facets.iteritems():
+        write_array("%s.facet" % name, column)
+        values = sorted(facet_values[name], key=facet_values[name].get)
+        with open(os.path.join(path, "%s.values" % name), "wb") as f:
+            json.dump(values, f)
+
+    meta = {"format": FORMAT_VERSION,
+            "docs": len(docs),
+            "total_length": total_length,
+            "deletes": deletes}
+    with open(os.path.join(path, META), "wb") as f:
+        json.dump(meta, f)
+
+
+class _Column(object):
+    '''Random access to a file of fixed width numbers'''
+    def __init__(self, buf, typecode):
+        self.buf = buf
+        self.struct = struct.Struct("=" + typecode)
+
+    def __getitem__(self, i):
+        return self.struct.unpack_from(self.buf, i * self.struct.size)[0]
+
+
+class Segment(object):
+    def __init__(self, path, schema):
+        self.path = path
+        self.name = os.path.basename(path)
+        self._maps = []
+
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        if meta["format"] != FORMAT_VERSION:
+            raise ValueError("%s has unknown format %r" %
+                             (path, meta["format"]))
+        self.doc_count = meta["docs"]
+        self.total_length = meta["total_length"]
+        self.deletes = meta["deletes"]
+
+        self.fullnames = []
+        self.versions = []
+        with open(os.path.join(path, IDS)) as f:
+            for line in f:
+                fullname, version = line.rstrip("\n").split("\t")
+                self.fullnames.append(fullname.decode("utf-8"))
+                self.versions.append(int(version))
+
+        self._terms = self._map(TERMS)
+        self._term_index = self._map(TERM_INDEX)
+        self.term_count = len(self._term_index) / _TERM_ENTRY.size
+        self._postings = self._map(POSTINGS)
+        self.lengths = _Column(self._map(LENGTHS), "I")
+        self.columns = dict((name, _Column(self._map("%s.num" % name), "d"))
+                            for name in schema.sort_fields)
+        self.facets = {}
+        for name in schema.facet_fields:
+            with open(os.path.join(path, "%s.values" % name)) as f:
+                values = json.load(f)
+            column = _Column(self._map("%s.facet" % name), "i")
+            self.facets[name] = (column, values)
+
+        # filled in by LocalIndex once it knows about every segment
+        self.live = bytearray(self.doc_count)
+
+    def _map(self, filename):
+        with open(os.path.join(self.path, filename), "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                # empty files can't be mapped
+                return ""
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(buf)
+        return buf
+
+    def close(self):
+        for buf in self._maps:
+            buf.close()
+        self._maps = []
+
+    def _term_entry(self, i):
+        offset, length, postings, doc_freq = _TERM_ENTRY.unpack_from(
+            self._term_index, i * _TERM_ENTRY.size)
+        return self._terms[offset:offset + length], postings, doc_freq
+
+    def _find(self, term):
+        '''Return the position of the first term >= `term`'''
+        lo, hi = 0, self.term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term_entry(mid)[0] < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_postings(self, offset, doc_freq):
+        data = struct.unpack_from("=%dI" % (2 * doc_freq), self._postings,
+                                  offset * _POSTING_SIZE)
+        return zip(data[::2], data[1::2])
+
+    def doc_freq(self, term):
+        i = self._find(term)
+        if i < self.term_count:
+            found, offset, doc_freq = self._term_entry(i)
+            if found == term:
+                return doc_freq
+        return 0
+
+    def postings(self, term):
+        '''Return a list of (document, term frequency) for `term`'''
+        i = self._find(term)
+        if i < self.term_count:
+            found, offset, doc_freq = self._term_entry(i)
+            if found == term:
+                return self._read_postings(offset, doc_freq)
+        return []
+
+    def terms_with_prefix(self, prefix):
+        i = self._find(prefix)
+        while i < self.term_count:
+            term, offset, doc_freq = self._term_entry(i)
+            if not term.startswith(prefix):
+                break
+            yield term
+            i += 1
+
+    def live_docs(self):
+        live = self.live
+        return [doc for doc in xrange(self.doc_count) if live[doc]]
+
+    def stored_docs(self):
+        '''Yield (document, (fullname, version, fields)) for every
+        document in the segment'''
+        with open(os.path.join(self.path, STORED)) as f:
+            for doc, line in enumerate(f):
+                yield doc, json.loads(line)
+
+
+### Queries ###
+_BQ_TOKEN = re.compile(r"""\s*(?:
+    (?P<open>\()
+  | (?P<close>\))
+  | (?:(?P<field>[\w.]+):)?
+    (?:'(?P<quoted>(?:[^'\\]|\\.)*)' | (?P<word>[^\s()']+))
+)""", re.UNICODE | re.VERBOSE)
+_BQ_ESCAPE = re.compile(r"\\(.)")
+
+
+def _tokenize_bq(bq):
+    tokens = []
+    pos = 0
+    bq = bq.rstrip()
+    while pos < len(bq):
+        match = _BQ_TOKEN.match(bq, pos)
+        if not match or match.end() == pos:
+            raise InvalidQuery("can't parse %r at %d" % (bq, pos))
+        pos = match.end()
+        if match.group("open"):
+            tokens.append(("(", None, None))
+        elif match.group("close"):
+            tokens.append((")", None, None))
+        elif match.group("quoted") is not None:
+            value = _BQ_ESCAPE.sub(r"\1", match.group("quoted"))
+            tokens.append(("quoted", match.group("field"), value))
+        else:
+            tokens.append(("word", match.group("field"),
+                           match.group("word")))
+    return tokens
+
+
+def _field_node(field_name, kind, value):
+    if kind == "word" and ".." in value:
+        lo, hi = value.split("..", 1)
+        try:
+            lo = float(lo) if lo else None
+            hi = float(hi) if hi else None
+        except ValueError:
+            raise InvalidQuery("bad range %r" % value)
+        return ("range", field_name, lo, hi)
+    return ("text", field_name, value)
+
+
+def parse_bq(bq):
+    '''Parse the subset of the CloudSearch boolean query language that
+    l2cs and the query classes generate into a tree of tuples:
+
+        ("and", [nodes])
+        ("or", [nodes])
+        ("not", node)
+        ("text", field name or None, words)
+        ("range", field name, low or None, high or None)
+
+    '''
+    tokens = _tokenize_bq(bq)
+    pos = [0]
+
+    def next_token():
+        if pos[0] >= len(tokens):
+            raise InvalidQuery("unexpected end of %r" % bq)
+        token = tokens[pos[0]]
+        pos[0] += 1
+        return token
+
+    def parse_expr():
+        kind, field_name, value = next_token()
+        if kind == "(":
+            kind, field_name, op = next_token()
+            if kind != "word" or field_name:
+                raise InvalidQuery("expected an operator in %r" % bq)
+            if op in ("and", "or"):
+                children = []
+                while tokens[pos[0]:pos[0] + 1] != [(")", None, None)]:
+                    children.append(parse_expr())
+                next_token()
+                return (op, children)
+            elif op == "not":
+                node = ("not", parse_expr())
+            elif op == "field":
+                kind, _, field_name = next_token()
+                if kind != "word":
+                    raise InvalidQuery("expected a field name in %r" % bq)
+                kind, _, value = next_token()
+                if kind not in ("word", "quoted"):
+                    raise InvalidQuery("expected a value in %r" % bq)
+                node = _field_node(field_name, kind, value)
+            else:
+                raise InvalidQuery("unknown operator %r" % op)
+            if next_token()[0] != ")":
+                raise InvalidQuery("expected ')' in %r" % bq)
+            return node
+        elif kind in ("word", "quoted"):
+            if field_name:
+                return _field_node(field_name, kind, value)
+            return ("text", None, value)
+        raise InvalidQuery("unexpected ')' in %r" % bq)
+
+    node = parse_expr()
+    if pos[0] != len(tokens):
+        raise InvalidQuery("trailing input in %r" % bq)
+    return node
+
+
+class _Searcher(object):
+    '''Evaluates one query tree against the segments of an index, using
+    corpus statistics from all of them for BM25'''
+
+    def __init__(self, index):
+        self.schema = index.schema
+        self.segments = index.segments
+        self.doc_count = sum(seg.doc_count for seg in self.segments) or 1
+        total_length = sum(seg.total_length for seg in self.segments)
+        self.avg_length = float(total_length) / self.doc_count or 1.0
+        self._idfs = {}
+
+    def idf(self, term):
+        try:
+            return self._idfs[term]
+        except KeyError:
+            df = sum(seg.doc_freq(term) for seg in self.segments)
+            idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+            self._idfs[term] = idf
+            return idf
+
+    def _check_field(self, field_name):
+        if field_name is not None and field_name not in self.schema.field_names:
+            raise InvalidQuery("unknown field %r" % field_name)
+
+    def evaluate(self, node, seg):
+        '''Return a dict of matching document to score'''
+        op = node[0]
+        if op == "and":
+            return self._and(node[1], seg)
+        elif op == "or":
+            matches = {}
+            for child in node[1]:
+                for doc, score in self.evaluate(child, seg).iteritems():
+                    matches[doc] = matches.get(doc, 0.0) + score
+            return matches
+        elif op == "not":
+            excluded = self.evaluate(node[1], seg)
+            return dict((doc, 0.0) for doc in seg.live_docs()
+                        if doc not in excluded)
+        elif op == "text":
+            return self._text(node[1], node[2], seg)
+        elif op == "range":
+            return self._range(node, seg, None)
+        raise InvalidQuery("unknown operator %r" % op)
+
+    def _and(self, children, seg):
+        # ranges are checked against whatever the other clauses match
+        # rather than scanning their columns
+        ranges = [child for child in children if child[0] == "range"]
+        matches = None
+        for child in children:
+            if child[0] == "range":
+                continue
+            child_matches = self.evaluate(child, seg)
+            if matches is None:
+                matches = child_matches
+            else:
+                matches = dict((doc, score + child_matches[doc])
+                               for doc, score in matches.iteritems()
+                               if doc in child_matches)
+            if not matches:
+                return {}
+        for node in ranges:
+            matches = self._range(node, seg, matches)
+        return matches or {}
+
+    def _range(self, node, seg, candidates):
+        op, field_name, lo, hi = node
+        self._check_field(field_name)
+        if field_name not in self.schema.numeric_fields:
+            raise InvalidQuery("%r isn't a numeric field" % field_name)
+        if candidates is None:
+            candidates = dict((doc, 0.0) for doc in seg.live_docs())
+        column = seg.columns[field_name]
+        matches = {}
+        for doc, score in candidates.iteritems():
+            value = column[doc]
+            if (lo is None or value >= lo) and (hi is None or value <= hi):
+                matches[doc] = score
+        return matches
+
+    def _text(self, field_name, text, seg):
+        self._check_field(field_name)
+        if field_name in self.schema.numeric_fields:
+            try:
+                term = _number_term(field_name, float(text))
+            except ValueError:
+                raise InvalidQuery("%r isn't a number" % text)
+            return dict((doc, 0.0) for doc, tf in seg.postings(term))
+
+        words = tokenize(text)
+        prefix = text.endswith("*")
+        matches = None
+        for i, word in enumerate(words):
+            term = _text_term(field_name, word)
+            if prefix and i == len(words) - 1:
+                terms = list(seg.terms_with_prefix(term))
+            else:
+                terms = [term]
+
+            word_matches = {}
+            for term in terms:
+                idf = self.idf(term)
+                for doc, tf in seg.postings(term):
+                    score = self._bm25(seg, doc, tf, idf, field_name)
+                    word_matches[doc] = word_matches.get(doc, 0.0) + score
+
+            if matches is None:
+                matches = word_matches
+            else:
+                matches = dict((doc, score + word_matches[doc])
+                               for doc, score in matches.iteritems()
+                               if doc in word_matches)
+            if not matches:
+                return {}
+        return matches or {}
+
+    def _bm25(self, seg, doc, tf, idf, field_name):
+        if field_name is None:
+            norm = 1 - B + B * seg.lengths[doc] / self.avg_length
+        else:
+            # only the default fields' lengths are kept
+            norm = 1.0
+        return idf * tf * (K1 + 1) / (tf + K1 * norm)
+
+
+class LocalIndex(object):
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.segments = []
+        self._manifest_stat = None
+
+    def _manifest_path(self):
+        return os.path.join(self.path, MANIFEST)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {"generation": 0, "segments": []}
+
+    def _write_manifest(self, generation, names):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".%s." % MANIFEST)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"generation": generation, "segments": names}, f)
+        os.rename(tmp, self._manifest_path())
+
+    def refresh(self, force=False):
+        '''Pick up any segments written since the last look'''
+        for attempt in xrange(3):
+            try:
+                st = os.stat(self._manifest_path())
+                stat = (st.st_ino, st.st_mtime, st.st_size)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                stat = None
+            if stat == self._manifest_stat and not force:
+                return
+
+            try:
+                self._load(self._read_manifest()["segments"])
+            except (IOError, OSError) as e:
+                # a writer merged segments away between our reading the
+                # manifest and opening them, so try again
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            self._manifest_stat = stat
+            return
+        raise IOError("segments in %s keep disappearing" % self.path)
+
+    def _load(self, names):
+        existing = dict((seg.name, seg) for seg in self.segments)
+        segments = []
+        for name in names:
+            seg = existing.pop(name, None)
+            if seg is None:
+                seg = Segment(os.path.join(self.path, name), self.schema)
+            segments.append(seg)
+        for seg in existing.itervalues():
+            seg.close()
+        self.segments = segments
+        self._resolve()
+
+    def _resolve(self):
+        '''Mark the highest versioned document for every fullname live,
+        unless it's been deleted with a version at least as high'''
+        latest = {}
+        for seg_i, seg in enumerate(self.segments):
+            for fullname, version in seg.deletes.iteritems():
+                prev = latest.get(fullname)
+                if prev is None or version >= prev[0]:
+                    latest[fullname] = (version, None, None)
+            for doc, fullname in enumerate(seg.fullnames):
+                version = seg.versions[doc]
+                prev = latest.get(fullname)
+                if prev is None or version >= prev[0]:
+                    latest[fullname] = (version, seg_i, doc)
+
+        for seg in self.segments:
+            seg.live = bytearray(seg.doc_count)
+        for version, seg_i, doc in latest.itervalues():
+            if seg_i is not None:
+                self.segments[seg_i].live[doc] = 1
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, LOCK), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _new_segment(self, generation, docs, deletes):
+        name = "seg_%08d" % generation
+        tmp = tempfile.mkdtemp(dir=self.path, prefix=".%s." % name)
+        try:
+            _write_segment(tmp, self.schema, docs, deletes)
+            os.rename(tmp, os.path.join(self.path, name))
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return name
+
+    def update(self, docs, deletes):
+        '''Add `docs`, a list of (fullname, version, fields), and delete
+        `deletes`, a dict of fullname to version'''
+        if not docs and not deletes:
+            return
+        with self._write_lock():
+            manifest = self._read_manifest()
+            generation = manifest["generation"] + 1
+            name = self._new_segment(generation, docs, deletes)
+            self._write_manifest(generation, manifest["segments"] + [name])
+            self.refresh()
+            self._maybe_merge()
+
+    def _merge_run(self):
+        '''Return the trailing segments that are no bigger than the last
+        one, by powers of MERGE_FACTOR. Merging them whenever there are
+        MERGE_FACTOR of them means each document is rewritten about
+        log(index size) times.'''
+        def tier(seg):
+            return int(math.log(max(seg.doc_count, 1), MERGE_FACTOR))
+
+        if not self.segments:
+            return []
+        last_tier = tier(self.segments[-1])
+        run = []
+        for seg in reversed(self.segments):
+            if tier(seg) > last_tier:
+                break
+            run.append(seg)
+        run.reverse()
+        return run
+
+    def _maybe_merge(self):
+        while True:
+            run = self._merge_run()
+            if len(run) < MERGE_FACTOR:
+                return
+            self._merge(run)
+
+    def optimize(self):
+        '''Merge every segment into one'''
+        with self._write_lock():
+            self.refresh()
+            if len(self.segments) > 1:
+                self._merge(self.segments)
+
+    def _merge(self, run):
+        '''Replace `run`, a contiguous tail of self.segments, with a single
+        segment holding their live documents. Must hold the write lock.'''
+        docs = []
+        deletes = {}
+        for seg in run:
+            live = seg.live
+            for doc, stored in seg.stored_docs():
+                if live[doc]:
+                    docs.append(tuple(stored))
+            for fullname, version in seg.deletes.iteritems():
+                deletes[fullname] = max(version, deletes.get(fullname, 0))
+
+        if len(run) == len(self.segments):
+            # the deletes are only needed to hide documents in older
+            # segments, and there aren't any
+            deletes = {}
+
+        manifest = self._read_manifest()
+        generation = manifest["generation"] + 1
+        names = [seg.name for seg in self.segments[:-len(run)]]
+        name = self._new_segment(generation, docs, deletes)
+        self._write_manifest(generation, names + [name])
+        self.refresh()
+        for seg in run:
+            shutil.rmtree(seg.path, ignore_errors=True)
+
+    def search(self, query=None, bq=None, rank="-relevance", faceting=None,
+               start=0, size=1000):
+        '''Run a query in the same form as cloudsearch.basic_query, and
+        return its Results'''
+        if isinstance(query, str):
+            query = query.decode("utf-8")
+        if isinstance(bq, str):
+            bq = bq.decode("utf-8")
+        if bq:
+            node = parse_bq(bq)
+        elif query:
+            node = ("text", None, query)
+        else:
+            raise ValueError("Need query or bq")
+
+        reverse = rank.startswith("-")
+        rank_name = rank.lstrip("-+")
+        if (rank_name not in RELEVANCE_RANKS and
+            rank_name not in self.schema.sort_fields):
+            raise InvalidQuery("unknown rank %r" % rank)
+
+        self.refresh()
+        searcher = _Searcher(self)
+        hits = []
+        facet_counts = dict((name, collections.Counter())
+                            for name in (faceting or {})
+                            if name in self.schema.facet_fields)
+        for seg_i, seg in enumerate(self.segments):
+            live = seg.live
+            matches = [(doc, score) for doc, score
+                       in searcher.evaluate(node, seg).iteritems()
+                       if live[doc]]
+
+            if rank_name in RELEVANCE_RANKS:
+                hits.extend((score, seg_i, doc) for doc, score in matches)
+            else:
+                column = seg.columns[rank_name]
+                hits.extend((column[doc], seg_i, doc) for doc, score in matches)
+
+            for name, counts in facet_counts.iteritems():
+                column, values = seg.facets[name]
+                for doc, score in matches:
+                    ordinal = column[doc]
+                    if ordinal >= 0:
+                        counts[values[ordinal]] += 1
+
+        # ties go to the more recently indexed document
+        best = heapq.nlargest if reverse else heapq.nsmallest
+        top = best(start + size, hits)[start:]
+        docs = [self.segments[seg_i].fullnames[doc]
+                for value, seg_i, doc in top]
+
+        facets = {}
+        for name, counts in facet_counts.iteritems():
+            count = faceting[name].get("count", 20)
+            top_values = sorted(counts.iteritems(),
+                                key=lambda (value, n): (-n, value))[:count]
+            facets[name] = [{"value": value, "count": n}
+                            for value, n in top_values]
+
+        return Results(docs, len(hits), facets)
+
+
+_indexes = {}
+
+
+def get_index(schema):
+    try:
+        return _indexes[schema.name]
+    except KeyError:
+        path = os.path.join(g.local_search_dir, schema.name)
+        index = _indexes[schema.name] = LocalIndex(path, schema)
+        return index
+
+
+### Uploaders ###
+class LocalUploaderMixin(object):
+    '''Send the documents a CloudSearchUploader builds to the LocalIndex
+    passed to it as its `doc_api`, rather than POSTing them'''
+
+    def add_xml(self, thing, version):
+        # cloudsearch takes multi-valued fields (like site) as repeated
+        # elements, so send them that way rather than as a stringified
+        # list
+        add = etree.Element("add", id=thing._fullname, version=str(version),
+                            lang="en")
+
+        for field_name, value in self.fields(thing).iteritems():
+            for item in _values(value):
+                field = etree.SubElement(add, "field", name=field_name)
+                field.text = _safe_xml_str(item)
+
+        return add
+
+    def send_documents(self, docs):
+        adds = []
+        deletes = {}
+        for node in docs:
+            fullname = unicode(node.get("id"))
+            version = int(node.get("version"))
+            if node.tag == "add":
+                fields = {}
+                for field in node:
+                    name = field.get("name")
+                    value = unicode(field.text or u"")
+                    if name in fields:
+                        fields[name] = _values(fields[name]) + [value]
+                    else:
+                        fields[name] = value
+                adds.append((fullname, version, fields))
+            elif node.tag == "delete":
+                deletes[fullname] = version
+        self.doc_api.update(adds, deletes)
+        return ["%d added, %d deleted" % (len(adds), len(deletes))]
+
+
+class LocalLinkUploader(LocalUploaderMixin, LinkUploader):
+    pass
+
+
+class LocalSubredditUploader(LocalUploaderMixin, SubredditUploader):
+    pass
+
+
+def _local_uploaders(things):
+    return [LocalLinkUploader(get_index(LINK_SCHEMA), things=things),
+            LocalSubredditUploader(get_index(SUBREDDIT_SCHEMA),
+                                   things=things)]
+
+
+def run_changed(drain=False, min_size=1, limit=1000, sleep_time=1,
+                use_safe_get=False, verbose=False):
+    '''Consume the cloudsearch_changes queue into the local indexes'''
+    cloudsearch.run_changed(drain=drain, min_size=min_size, limit=limit,
+                            sleep_time=sleep_time, use_safe_get=use_safe_get,
+                            verbose=verbose, make_uploaders=_local_uploaders)
+
+
+def rebuild_link_index(cls=Link, uploader=LocalLinkUploader,
+                       schema=LINK_SCHEMA, chunk_size=1000):
+    '''Index every `cls` from scratch, newest first'''
+    uploader = uploader(get_index(schema))
+    q = cls._scan(reverse=True, deleted=None, chunk_size=chunk_size)
+    q = r2utils.progress(q, verbosity=1000, persec=True)
+    for chunk in r2utils.in_chunks(q, size=chunk_size):
+        uploader.things = chunk
+        uploader.inject(quiet=True)
+    get_index(schema).optimize()
+
+
+rebuild_subreddit_index = functools.partial(rebuild_link_index,
+                                            cls=Subreddit,
+                                            uploader=LocalSubredditUploader,
+                                            schema=SUBREDDIT_SCHEMA)
+
+
+### Query Code ###
+class LocalSearchQueryMixin(object):
+    '''Answer a CloudSearchQuery from a LocalIndex'''
+    schema = None
+
+    @classmethod
+    def _run_cached(cls, query, bq, sort="relevance", faceting=None, start=0,
+                    num=1000, _update=False):
+        if not query and not bq:
+            return Results([], 0, {})
+        if faceting is None:
+            faceting = DEFAULT_FACETS
+        index = get_index(cls.schema)
+        return index.search(query=query, bq=bq, rank=sort, faceting=faceting,
+                            start=start, size=num)
+
+
+class LocalLinkSearchQuery(LocalSearchQueryMixin, LinkSearchQuery):
+    schema = LINK_SCHEMA
+
+
+class LocalSubredditSearchQuery(LocalSearchQueryMixin, SubredditSearchQuery):
+    schema = SUBREDDIT_SCHEMA
@@ -121,6 +121,13 @@ class db_manager:
     def get_engine(self, name):
         return self._engines[name]
 
+    def dispose(self):
+        """Close every engine's pooled connections. Do this before
+        fork()ing so that the children open their own connections rather
+        than sharing the parent's sockets."""
+        for engine in self._engines.itervalues():
+            engine.dispose()
+
     def get_engines(self, names):
         return [self._engines[name] for name in names if name in self._engines]
 
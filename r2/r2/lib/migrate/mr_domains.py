@@ -151,6 +151,6 @@ def store_keys(key, maxes):
 
 
 def write_permacache(fd = sys.stdin):
-    mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
+    mr_tools.mr_reduce_max_per_key(mr_tools.float_key, num=1000,
                                    post=store_keys,
                                    fd = fd)
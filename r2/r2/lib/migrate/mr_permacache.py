@@ -253,11 +253,11 @@ def top1k_writefiles(dirname):
                 f.write('\t'.join(item))
                 f.write('\n')
         
-    mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
+    mr_tools.mr_reduce_max_per_key(mr_tools.float_key, num=1000,
                                    post=post)
 
 def top1k_writepermacache(fd = sys.stdin):
-    mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
+    mr_tools.mr_reduce_max_per_key(mr_tools.float_key, num=1000,
                                    post=store_keys,
                                    fd = fd)
 
@@ -66,6 +66,11 @@ time psql -F"\t" -A -t -d newreddit -U $USER -h $LINKDBHOST \
 cat $GOLD $DTHING | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_account.py -c "join_authors()" >> $THING
 cat $THING |  sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_account.py -c "join_links()" | paster --plugin=r2 run $INI r2/lib/mr_account.py -c "time_listings($TIMES)" | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_account.py -c "write_permacache()"
 
+# or, to do the map, sort and reduce steps after join_links across every
+# core of this machine without the shell pipeline:
+cat $THING | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_account.py -c "join_links()" > $THING.joined
+paster --plugin=r2 run $INI r2/lib/mr_account.py -c "time_listings_joined_local('$THING.joined', $TIMES)"
+
 """
 import sys
 
@@ -78,8 +83,8 @@ from r2.lib.jsontemplates import make_fullname # what a strange place
                                                # for this function
 import datetime
 
-def join_links():
-    mr_tools.join_things(('author_id',))
+def join_links(fd = sys.stdin):
+    mr_tools.join_things(('author_id',), fd=fd)
 
 def year_listings():
     """
@@ -108,7 +113,7 @@ def year_listings():
 
 
 
-def time_listings(times = ('year','month','week','day','hour', 'all')):
+def time_listings_mapper(times = ('year','month','week','day','hour', 'all')):
     oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
                    for t in times if t != 'all')
     if 'all' in times:
@@ -143,8 +148,10 @@ def time_listings(times = ('year','month','week','day','hour', 'all')):
                         yield ('%s-hot-%s-%d' % (link.thing_type, tkey, author_id),
                                h, timestamp, fname)
 
+    return process
 
-    mr_tools.mr_map(process)
+def time_listings(times = ('year','month','week','day','hour', 'all')):
+    mr_tools.mr_map(time_listings_mapper(times))
 
 def store_keys(key, maxes):
     # we're building queries using queries.py, but we could make the
@@ -172,7 +179,17 @@ def store_keys(key, maxes):
                     for item in maxes])
 
 def write_permacache(fd = sys.stdin):
-    mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
+    mr_tools.mr_reduce_max_per_key(mr_tools.float_key, num=1000,
                                    post=store_keys,
                                    fd = fd)
 
+def time_listings_joined_local(joined_dump,
+                               times = ('year','month','week','day','hour',
+                                        'all'),
+                               **local_opts):
+    """Run time_listings and write_permacache with mr_tools.mr_local over
+       joined_dump, the output of join_links in the usage notes above, on
+       this machine in place of the sort pipes that follow join_links.
+       Unlike mr_top.time_listings_local it doesn't do the join itself."""
+    mr_tools.mr_local(time_listings_mapper(times), write_permacache,
+                      [joined_dump], **local_opts)
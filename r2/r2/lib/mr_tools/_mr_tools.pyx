@@ -21,6 +21,7 @@
 ###############################################################################
 
 import sys
+from heapq import heapreplace, heappush
 from itertools import imap, groupby
 
 stdin = sys.stdin
@@ -153,22 +154,69 @@ cpdef mr_foldl(process, init, emit = False, fd = stdin):
 
     return acc
 
+cdef class TopN(object):
+    """A bounded min-heap that keeps the `num` largest items added to it.
+
+       Items with equal keys are kept in arrival order, so `results()`
+       is identical to a stable `sorted(items, key=key, reverse=True)[:num]`
+       over everything that was added, without ever sorting more than
+       `num` items at a time."""
+    cdef list heap
+    cdef object key
+    cdef Py_ssize_t num
+    cdef long seq
+
+    def __init__(self, long num, key=None):
+        self.heap = []
+        self.num = num
+        self.key = key
+        self.seq = 0
+
+    cpdef add(self, item):
+        cdef tuple entry
+
+        if self.num <= 0:
+            return
+
+        # the negated sequence number makes later arrivals compare as
+        # smaller, so that ties are evicted newest-first and the items
+        # themselves are never compared
+        self.seq += 1
+        if self.key is None:
+            entry = (item, -self.seq, item)
+        else:
+            entry = (self.key(item), -self.seq, item)
+
+        if len(self.heap) < self.num:
+            heappush(self.heap, entry)
+        elif entry > self.heap[0]:
+            heapreplace(self.heap, entry)
+
+    def extend(self, items):
+        for item in items:
+            self.add(item)
+
+    cpdef list results(self):
+        return [entry[2] for entry in sorted(self.heap, reverse=True)]
+
+    def __len__(self):
+        return len(self.heap)
+
 cpdef mr_max(process, int idx = 0, int num = 10, emit = False, fd = stdin):
     """a reducer that, in the process of reduction, only returns the
        top N results"""
-    cdef list maxes = []
+    # results are ordered on the whole value, as they always have
+    # been; `idx` is kept for compatibility with existing callers
+    cdef TopN maxes = TopN(num)
     for key, vals in keyiter(fd):
-        for newvals in in_chunks(process(key, vals)):
-            for val in newvals:
-                if len(maxes) < num or val[idx] > maxes[-1][idx]:
-                    maxes.append(val)
-            maxes.sort(reverse=True)
-            maxes = maxes[:num]
+        maxes.extend(process(key, vals))
+
+    cdef list ret = maxes.results()
 
     if emit:
-        emit_all(maxes)
+        emit_all(ret)
 
-    return maxes
+    return ret
 
 cpdef _sbool(str x):
     return x == 't'
@@ -192,16 +240,24 @@ def dataspec_m_thing(*fields):
                          ('timestamp', float))
                         + fields))
 
+cpdef list float_key(list item):
+    """The sort key used for listing rows of the form
+       `[sortval, ..., fullname]`: every column but the last, as floats.
+       Orders identically to `lambda x: map(float, x[:-1])`."""
+    cdef Py_ssize_t i, n = len(item) - 1
+    cdef list ret = []
+    cdef double val
+
+    for i in range(n):
+        val = float(item[i])
+        ret.append(val)
+    return ret
+
 def mr_reduce_max_per_key(sort_key, post = None, num = 10, fd = sys.stdin):
     def process(key, vals):
-        cdef list maxes = []
-
-        # pull items out in chunks (of the total number that we want),
-        # sorting and slicing after each batch
-        for val_chunk in in_chunks(vals, num):
-            maxes.extend(val_chunk)
-            maxes.sort(reverse=True, key=sort_key)
-            maxes = maxes[:num]
+        cdef TopN top = TopN(num, sort_key)
+        top.extend(vals)
+        cdef list maxes = top.results()
 
         if post:
             # if we were passed a "post" function, he takes
@@ -0,0 +1,272 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""Binary columnar dumps of thing tables for offline listing rebuilds.
+
+The text dumps consumed by `join_things` and `dataspec_m_thing` have to
+be split and type-coerced a line at a time. A columnar dump is instead a
+directory holding one fixed-width little-endian array per column, which
+NumPy can map straight into memory:
+
+    thing_id.bin   int64
+    ups.bin        int32
+    downs.bin      int32
+    timestamp.bin  float64 (seconds since the epoch)
+    sr_id.bin      int64, -1 if the thing has no sr_id
+    flags.bin      uint8, FLAG_DELETED | FLAG_SPAM
+    domain.bin     int32 index into domain.dict, -1 if there is no url
+
+plus `domain.dict`, the newline-separated url hostnames referenced by the
+domain column, and `meta.json` describing the dump.
+
+To write one straight from the thing tables and build the time listings
+from it:
+
+paster --plugin=r2 run $INI r2/lib/mr_tools/columnar.py -c "dump_things('links.col', 'link', '1 year')"
+paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings_columnar('links.col')" | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "write_permacache()"
+"""
+
+import array
+import json
+import os
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FORMAT_VERSION = 1
+
+FLAG_DELETED = 1
+FLAG_SPAM = 2
+
+# (name, numpy dtype, itemsize, signed)
+COLUMNS = (('thing_id', '<i8', 8, True),
+           ('ups', '<i4', 4, True),
+           ('downs', '<i4', 4, True),
+           ('timestamp', '<f8', 8, None),
+           ('sr_id', '<i8', 8, True),
+           ('flags', 'u1', 1, False),
+           ('domain', '<i4', 4, True))
+
+DOMAIN_DICT = 'domain.dict'
+META = 'meta.json'
+
+def _array_typecode(itemsize, signed):
+    if signed is None:
+        return 'd'
+    codes = 'bhilq' if signed else 'BHILQ'
+    for code in codes:
+        try:
+            if array.array(code).itemsize == itemsize:
+                return code
+        except ValueError:
+            # 'q' only exists on some builds
+            pass
+    raise ValueError("no array type with itemsize %d" % itemsize)
+
+def _column_path(path, name):
+    return os.path.join(path, '%s.bin' % name)
+
+class ColumnarWriter(object):
+    """Append things to a new columnar dump at `path`. Rows are buffered
+       in `array`s and flushed to the column files every `flush_every`
+       rows, so this doesn't need NumPy."""
+
+    def __init__(self, path, thing_type, flush_every=100000):
+        self.path = path
+        self.thing_type = thing_type
+        self.flush_every = flush_every
+        self.count = 0
+        self.domains = {}
+        self.domain_list = []
+
+        os.makedirs(path)
+        self.files = {}
+        self.buffers = {}
+        for name, dtype, itemsize, signed in COLUMNS:
+            self.files[name] = open(_column_path(path, name), 'wb')
+            self.buffers[name] = array.array(_array_typecode(itemsize,
+                                                             signed))
+
+    def _domain_index(self, url):
+        if url is None:
+            return -1
+
+        from r2.lib.utils import UrlParser
+        hostname = (UrlParser(url).hostname or '') if url else ''
+        try:
+            return self.domains[hostname]
+        except KeyError:
+            index = self.domains[hostname] = len(self.domain_list)
+            self.domain_list.append(hostname)
+            return index
+
+    def append(self, thing_id, ups, downs, timestamp, sr_id=None,
+               deleted=False, spam=False, url=None):
+        buffers = self.buffers
+        buffers['thing_id'].append(thing_id)
+        buffers['ups'].append(ups)
+        buffers['downs'].append(downs)
+        buffers['timestamp'].append(timestamp)
+        buffers['sr_id'].append(-1 if sr_id is None else sr_id)
+        buffers['flags'].append((FLAG_DELETED if deleted else 0) |
+                                (FLAG_SPAM if spam else 0))
+        buffers['domain'].append(self._domain_index(url))
+
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.flush()
+
+    def flush(self):
+        for name, buf in self.buffers.iteritems():
+            if sys.byteorder != 'little':
+                buf.byteswap()
+            buf.tofile(self.files[name])
+            del buf[:]
+
+    def close(self):
+        self.flush()
+        for f in self.files.itervalues():
+            f.close()
+
+        with open(os.path.join(self.path, DOMAIN_DICT), 'w') as f:
+            for hostname in self.domain_list:
+                if isinstance(hostname, unicode):
+                    hostname = hostname.encode('utf8')
+                f.write(hostname + '\n')
+
+        meta = dict(version=FORMAT_VERSION,
+                    thing_type=self.thing_type,
+                    count=self.count,
+                    columns=[(name, dtype) for name, dtype, _, _ in COLUMNS])
+        with open(os.path.join(self.path, META), 'w') as f:
+            json.dump(meta, f)
+
+def dump_things(path, thing_type='link', max_age=None, chunk_size=10000):
+    """Write a columnar dump of every thing of `thing_type` (newer than
+       `max_age`, e.g. '1 year', if given) straight from the thing and
+       data tables, joining in the sr_id and url data in postgres."""
+    import sqlalchemy as sa
+
+    from r2.lib.db import tdb_sql
+    from r2.lib.mr_tools import status
+    from r2.lib.utils import timeago
+
+    type_id = tdb_sql.get_type_id(thing_type)
+    thing_table, data_table = tdb_sql.get_thing_table(type_id)
+
+    sr_data = data_table.alias('sr_data')
+    url_data = data_table.alias('url_data')
+    join = thing_table.outerjoin(
+        sr_data, sa.and_(sr_data.c.thing_id == thing_table.c.thing_id,
+                         sr_data.c.key == 'sr_id'))
+    join = join.outerjoin(
+        url_data, sa.and_(url_data.c.thing_id == thing_table.c.thing_id,
+                          url_data.c.key == 'url'))
+
+    q = sa.select([thing_table.c.thing_id,
+                   thing_table.c.ups,
+                   thing_table.c.downs,
+                   sa.extract('epoch', thing_table.c.date),
+                   thing_table.c.deleted,
+                   thing_table.c.spam,
+                   sr_data.c.value,
+                   url_data.c.value],
+                  from_obj=[join])
+    if max_age:
+        q = q.where(thing_table.c.date > timeago(max_age))
+    q = q.order_by(thing_table.c.thing_id)
+    q = q.execution_options(stream_results=True)
+
+    writer = ColumnarWriter(path, thing_type)
+    rows = q.execute()
+    while True:
+        chunk = rows.fetchmany(chunk_size)
+        if not chunk:
+            break
+        for (thing_id, ups, downs, timestamp, deleted, spam,
+             sr_id, url) in chunk:
+            writer.append(thing_id, ups, downs, float(timestamp),
+                          sr_id=int(sr_id) if sr_id is not None else None,
+                          deleted=deleted, spam=spam, url=url)
+        status('%(count)d %(thing_type)ss dumped', count=writer.count,
+               thing_type=thing_type)
+    writer.close()
+
+class ThingColumns(object):
+    """A columnar dump loaded as NumPy arrays, memory-mapped by default.
+       Each column is available as an attribute of the same name."""
+
+    def __init__(self, path, mmap=True):
+        if numpy is None:
+            raise ImportError("reading columnar dumps requires numpy")
+
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        if meta['version'] != FORMAT_VERSION:
+            raise ValueError("unknown columnar dump version %r"
+                             % meta['version'])
+
+        self.path = path
+        self.thing_type = meta['thing_type']
+        self.count = meta['count']
+
+        for name, dtype in meta['columns']:
+            filename = _column_path(path, name)
+            if not self.count:
+                column = numpy.zeros(0, dtype=dtype)
+            elif mmap:
+                column = numpy.memmap(filename, dtype=dtype, mode='r',
+                                      shape=(self.count,))
+            else:
+                column = numpy.fromfile(filename, dtype=dtype,
+                                        count=self.count)
+            setattr(self, name, column)
+
+        with open(os.path.join(path, DOMAIN_DICT)) as f:
+            self.domains = [line.rstrip('\n') for line in f]
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def deleted(self):
+        return (self.flags & FLAG_DELETED) != 0
+
+    @property
+    def spam(self):
+        return (self.flags & FLAG_SPAM) != 0
+
+    def live(self):
+        return (self.flags & (FLAG_DELETED | FLAG_SPAM)) == 0
+
+    def score(self):
+        """The vectorized equivalent of `sorts.score`"""
+        return self.ups.astype(numpy.int64) - self.downs
+
+    def controversy(self):
+        """The vectorized equivalent of `sorts.controversy`"""
+        total = self.ups.astype(numpy.float64) + self.downs
+        return total / numpy.maximum(numpy.abs(self.score()), 1)
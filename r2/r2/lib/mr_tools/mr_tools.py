@@ -20,13 +20,21 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+import os
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
+import time
 import multiprocessing
+import zlib
 
 from r2.lib.mr_tools._mr_tools import mr_map, mr_reduce, format_dataspec
-from r2.lib.mr_tools._mr_tools import stdin, emit
+from r2.lib.mr_tools._mr_tools import stdin, emit, keyiter, in_chunks
+from r2.lib.mr_tools._mr_tools import float_key, status, TopN
 
-def join_things(fields, deleted=False, spam=True):
+def join_things(fields, deleted=False, spam=True, fd=stdin):
     """A reducer that joins thing table dumps and data table dumps"""
     def process(thing_id, vals):
         data = {}
@@ -67,7 +75,7 @@ def join_things(fields, deleted=False, spam=True):
                     thing.deleted, thing.spam, thing.timestamp)
                    + tuple(data[field] for field in fields))
 
-    mr_reduce(process)
+    mr_reduce(process, fd=fd)
 
 class Mapper(object):
     def __init__(self):
@@ -99,6 +107,163 @@ def mr_map_parallel(processor, fd = stdin,
         for subres in res:
             emit(subres)
 
+# the mapper and reducer of the mr_local job that is currently running.
+# Pool workers are fork()ed after this is set, so they inherit it
+# without the functions (usually closures) needing to be pickled
+_local_job = {}
+
+def _shard_inputs(inputs, shard_size):
+    shards = []
+    for path in inputs:
+        size = os.path.getsize(path)
+        for start in xrange(0, max(size, 1), shard_size):
+            shards.append((path, start, min(start + shard_size, size)))
+    return shards
+
+def _read_shard(path, start, end):
+    """Yield the lines of `path` that begin in the byte range
+       [start, end). A line straddling a boundary belongs to the shard
+       it starts in."""
+    with open(path) as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line
+
+def _partition_for(key, partitions):
+    return (zlib.crc32(key) & 0xffffffff) % partitions
+
+def _local_map_shard(args):
+    shard_num, (path, start, end), tmpdir, partitions = args
+    mapper = _local_job['mapper']
+
+    names = [os.path.join(tmpdir, 'map-%05d-%05d' % (shard_num, part))
+             for part in xrange(partitions)]
+    outs = [open(name, 'w') for name in names]
+    try:
+        for line in _read_shard(path, start, end):
+            if mapper is None:
+                # identity map, as when the input is already in
+                # key-value form and only needs sorting and reducing
+                line = line if line.endswith('\n') else line + '\n'
+                key = line.split('\t', 1)[0].rstrip('\n')
+                outs[_partition_for(key, partitions)].write(line)
+                continue
+
+            vals = line.strip('\n').split('\t')
+            for res in mapper(vals):
+                res = map(str, res)
+                outs[_partition_for(res[0], partitions)].write(
+                    '\t'.join(res) + '\n')
+    finally:
+        for out in outs:
+            out.close()
+    return names
+
+def _local_sort_partition(args):
+    part, spills, tmpdir, sort_mem = args
+    sorted_name = os.path.join(tmpdir, 'sorted-%05d' % part)
+
+    if not spills:
+        open(sorted_name, 'w').close()
+        return part, sorted_name
+
+    # byte-order sorting is both faster than the locale-aware default
+    # and guarantees that all lines with the same key are adjacent
+    env = dict(os.environ, LC_ALL='C')
+    subprocess.check_call(['sort', '-T', tmpdir, '-S', sort_mem,
+                           '-o', sorted_name] + spills,
+                          env=env)
+    for spill in spills:
+        os.unlink(spill)
+    return part, sorted_name
+
+def _local_reduce_partition(args):
+    part, sorted_name, tmpdir = args
+    reducer = _local_job['reducer']
+    out_name = os.path.join(tmpdir, 'reduced-%05d' % part)
+
+    # reducers emit() with print, so point stdout at this partition's
+    # output file for the duration
+    real_stdout = sys.stdout
+    with open(sorted_name) as fd:
+        with open(out_name, 'w') as out:
+            sys.stdout = out
+            try:
+                reducer(fd=fd)
+            finally:
+                sys.stdout = real_stdout
+    os.unlink(sorted_name)
+    return part, out_name
+
+def mr_local(mapper, reducer, inputs, output=None,
+             workers=multiprocessing.cpu_count(), partitions=None,
+             shard_size=64 * 1024 * 1024, sort_mem='200M', tmpdir=None):
+    """Run a whole map, sort, reduce job on this machine using every core.
+
+       `mapper` is a function taking a list of tab-separated values and
+       yielding tuples whose first value is the key, like the `process`
+       functions handed to `mr_map`, or None to pass input lines through
+       unchanged. `reducer` is called as `reducer(fd=...)` once per
+       partition, like `write_permacache`. As with `mr_map_parallel`,
+       both must be safe to execute in a fork()d process.
+
+       The input files are split into shards that are mapped in
+       parallel, with each emitted key hash-partitioned into its own
+       spill file. Each partition is then sorted with sort(1) and
+       reduced, again in parallel, and anything the reducers emit is
+       written to `output` (stdout by default) one partition at a time.
+       Every key lands in exactly one partition, so reducers see the
+       same groups that a single sort | reduce pipeline would."""
+
+    output = output or sys.stdout
+    partitions = partitions or workers
+    tmpdir = tempfile.mkdtemp(prefix='mr_local.', dir=tmpdir)
+    shards = _shard_inputs(inputs, shard_size)
+
+    _local_job['mapper'] = mapper
+    _local_job['reducer'] = reducer
+    pool = multiprocessing.Pool(workers)
+    try:
+        start = time.time()
+        spills = [[] for x in xrange(partitions)]
+        map_args = [(num, shard, tmpdir, partitions)
+                    for num, shard in enumerate(shards)]
+        for names in pool.imap_unordered(_local_map_shard, map_args):
+            for part, name in enumerate(names):
+                spills[part].append(name)
+        status('mapped %(shards)d shards in %(secs).1fs',
+               shards=len(shards), secs=time.time() - start)
+
+        start = time.time()
+        sort_args = [(part, spills[part], tmpdir, sort_mem)
+                     for part in xrange(partitions)]
+        sorted_names = dict(pool.imap_unordered(_local_sort_partition,
+                                                sort_args))
+        status('sorted %(partitions)d partitions in %(secs).1fs',
+               partitions=partitions, secs=time.time() - start)
+
+        start = time.time()
+        reduce_args = [(part, sorted_names[part], tmpdir)
+                       for part in xrange(partitions)]
+        reduced = dict(pool.imap_unordered(_local_reduce_partition,
+                                           reduce_args))
+        status('reduced %(partitions)d partitions in %(secs).1fs',
+               partitions=partitions, secs=time.time() - start)
+
+        for part in xrange(partitions):
+            with open(reduced[part]) as f:
+                shutil.copyfileobj(f, output)
+        output.flush()
+    finally:
+        pool.terminate()
+        _local_job.clear()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
 def test():
     from r2.lib.mr_tools._mr_tools import keyiter
 
@@ -113,3 +278,50 @@ class UpperMapper(Mapper):
 
 def test_parallel():
     return mr_map_parallel(UpperMapper())
+
+def _sorted_max_per_key(vals, sort_key, num):
+    # the chunked sort-and-slice reducer that TopN replaced, kept only
+    # so that benchmark_max_per_key has something to compare against
+    maxes = []
+    for val_chunk in in_chunks(vals, num):
+        maxes.extend(val_chunk)
+        maxes.sort(reverse=True, key=sort_key)
+        maxes = maxes[:num]
+    return maxes
+
+def benchmark_max_per_key(rows=10000000, keys=1000, num=1000):
+    """Compare the heap-based top-N reducer with the old sorting one
+       over a generated, key-sorted dump in the format written by the
+       listing mappers (`key, sortval, timestamp, fullname`)."""
+    fd, path = tempfile.mkstemp(prefix='mr_max_per_key.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            per_key = rows // keys
+            for k in xrange(keys):
+                for i in xrange(per_key):
+                    f.write('sr-top-all-%d\t%d\t%.2f\tt3_%x\n'
+                            % (k, random.randint(-50, 5000),
+                               random.uniform(1.1e9, 1.4e9),
+                               k * per_key + i))
+        status('wrote %(rows)d rows to %(path)s', rows=rows, path=path)
+
+        def heap_reduce(vals):
+            top = TopN(num, float_key)
+            top.extend(vals)
+            return top.results()
+
+        def sort_reduce(vals):
+            return _sorted_max_per_key(vals, float_key, num)
+
+        results = {}
+        for name, reducer in (('sort', sort_reduce), ('heap', heap_reduce)):
+            start = time.time()
+            with open(path) as f:
+                results[name] = [(key, reducer(vals))
+                                 for key, vals in keyiter(f)]
+            status('%(name)s: %(secs).2fs', name=name,
+                   secs=time.time() - start)
+
+        assert results['sort'] == results['heap'], 'outputs differ'
+    finally:
+        os.unlink(path)
@@ -53,6 +53,10 @@ time psql -F"\t" -A -t -d newreddit -U $USER -h $LINKDBHOST \
                   to 'reddit_data_link.dump'"
 cat reddit_data_link.dump reddit_thing_link.dump | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "join_links()" > links.joined
 cat links.joined | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings()" | sort -T. -S200m | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "write_permacache()"
+
+# or, to do the join, map, sort and reduce steps across every core of
+# this machine without the shell pipeline:
+paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listings_local('reddit_thing_link.dump', 'reddit_data_link.dump')"
 """
 ## """
 ## psql -F"\t" -A -t -d newreddit -U ri -h $LINKDBHOST \
@@ -89,7 +93,9 @@ cat links.joined | paster --plugin=r2 run $INI r2/lib/mr_top.py -c "time_listing
 # a submission in the last year), we won't write out an empty
 # list. I'll call it a feature.
 
+import os
 import sys
+import tempfile
 
 from r2.models import Account, Subreddit, Link
 from r2.lib.db.sorts import epoch_seconds, score, controversy
@@ -99,11 +105,11 @@ from r2.lib.utils import timeago, UrlParser
 from r2.lib.jsontemplates import make_fullname # what a strange place
                                                # for this function
 
-def join_links():
-    mr_tools.join_things(('url', 'sr_id'))
+def join_links(fd = sys.stdin):
+    mr_tools.join_things(('url', 'sr_id'), fd=fd)
 
 
-def time_listings(times = ('year','month','week','day','hour')):
+def time_listings_mapper(times = ('year','month','week','day','hour')):
     oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
                    for t in times)
 
@@ -136,7 +142,51 @@ def time_listings(times = ('year','month','week','day','hour')):
                         yield ('domain/controversial/%s/%s' % (tkey, domain),
                                contr, timestamp, fname)
 
-    mr_tools.mr_map(process)
+    return process
+
+def time_listings(times = ('year','month','week','day','hour')):
+    mr_tools.mr_map(time_listings_mapper(times))
+
+def time_listings_columnar(path, times = ('year','month','week','day','hour')):
+    """Emit the same rows as time_listings, but from a columnar dump
+       written by mr_tools.columnar.dump_things, so that the filtering
+       and the score/controversy computations are whole-array operations"""
+    from r2.lib.mr_tools.columnar import ThingColumns
+
+    links = ThingColumns(path)
+    assert links.thing_type == 'link'
+
+    oldests = dict((t, epoch_seconds(timeago('1 %s' % t)))
+                   for t in times)
+
+    # join_links drops links without both a url and an sr_id
+    usable = links.live() & (links.sr_id >= 0) & (links.domain >= 0)
+    scores = links.score()
+    controversies = links.controversy()
+    domains = [UrlParser('http://%s/' % hostname).domain_permutations()
+               if hostname else []
+               for hostname in links.domains]
+
+    for tkey, oldest in oldests.iteritems():
+        idx = (usable & (links.timestamp > oldest)).nonzero()[0]
+        rows = zip(links.thing_id[idx].tolist(),
+                   links.sr_id[idx].tolist(),
+                   links.domain[idx].tolist(),
+                   links.timestamp[idx].tolist(),
+                   scores[idx].tolist(),
+                   controversies[idx].tolist())
+
+        for thing_id, sr_id, domain, timestamp, sc, contr in rows:
+            fname = make_fullname(Link, thing_id)
+            mr_tools.emit(('sr-top-%s-%d' % (tkey, sr_id),
+                           sc, timestamp, fname))
+            mr_tools.emit(('sr-controversial-%s-%d' % (tkey, sr_id),
+                           contr, timestamp, fname))
+            for domain in domains[domain]:
+                mr_tools.emit(('domain/top/%s/%s' % (tkey, domain),
+                               sc, timestamp, fname))
+                mr_tools.emit(('domain/controversial/%s/%s' % (tkey, domain),
+                               contr, timestamp, fname))
 
 def store_keys(key, maxes):
     # we're building queries using queries.py, but we could make the
@@ -189,6 +239,25 @@ def store_keys(key, maxes):
                     for item in maxes])
 
 def write_permacache(fd = sys.stdin):
-    mr_tools.mr_reduce_max_per_key(lambda x: map(float, x[:-1]), num=1000,
+    mr_tools.mr_reduce_max_per_key(mr_tools.float_key, num=1000,
                                    post=store_keys,
                                    fd = fd)
+
+def time_listings_local(thing_dump, data_dump,
+                        times = ('year','month','week','day','hour'),
+                        **local_opts):
+    """Run the whole join_links, time_listings, write_permacache pipeline
+       with mr_tools.mr_local over thing_dump and data_dump, the raw
+       reddit_thing_link and reddit_data_link dumps from the usage notes
+       above, on this machine in place of their sort pipes. Unlike
+       mr_account.time_listings_joined_local it does the join itself."""
+    joined_fd, joined_name = tempfile.mkstemp(prefix='links.joined.',
+                                              dir=local_opts.get('tmpdir'))
+    try:
+        with os.fdopen(joined_fd, 'w') as joined:
+            mr_tools.mr_local(None, join_links, [thing_dump, data_dump],
+                              output=joined, **local_opts)
+        mr_tools.mr_local(time_listings_mapper(times), write_permacache,
+                          [joined_name], **local_opts)
+    finally:
+        os.unlink(joined_name)
@@ -27,11 +27,17 @@ from r2.lib.utils import UniqueIterator, timeago
 
 from pylons import c
 
+import heapq
 import random
 from time import time
 
 organic_max_length= 50
 
+# how long each process keeps its organic_index before rebuilding it
+# from the (memoized) link counts
+organic_index_lifetime = 60
+_organic_index = (0, {})
+
 def keep_fresh_links(item):
     if c.user_is_loggedin and c.user._id == item.author_id:
         return True
@@ -45,11 +51,28 @@ def keep_fresh_links(item):
 
     return item.fresh
 
+def organic_index():
+    """Return the link counts as {sr_id: [(count, fullname), ...]}, with
+    each list sorted by count"""
+    global _organic_index
+    built, index = _organic_index
+    if time() - built < organic_index_lifetime:
+        return index
+
+    index = {}
+    for name, (link_count, sr_id) in count.get_link_counts().iteritems():
+        index.setdefault(sr_id, []).append((link_count, name))
+    for links in index.itervalues():
+        links.sort()
+    _organic_index = (time(), index)
+    return index
+
 def cached_organic_links(*sr_ids):
-    sr_count = count.get_link_counts()
+    index = organic_index()
     #only use links from reddits that you're subscribed to
-    link_names = filter(lambda n: sr_count[n][1] in sr_ids, sr_count.keys())
-    link_names.sort(key = lambda n: sr_count[n][0])
+    by_count = heapq.merge(*[index[sr_id] for sr_id in set(sr_ids)
+                             if sr_id in index])
+    link_names = [name for link_count, name in by_count]
 
     if not link_names and g.debug:
         q = All.get_links('new', 'all')
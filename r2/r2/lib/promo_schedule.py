@@ -0,0 +1,484 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""An in-memory index of the promotion schedule.
+
+PromotionWeights keeps a row for every day of every campaign, so "which
+campaigns are live on this date" and "how much of this subreddit is sold
+over the next two months" meant scanning those rows for each date in
+question. CampaignSchedule holds each campaign as an interval of dates
+instead, in a centered interval tree per subreddit, and answers both in
+O(log n + k) for the k campaigns involved.
+
+Each app process builds its own schedule from PromotionWeights when it's
+first needed. Campaign edits go through update_promos_q, whose consumer
+records the edited campaign ids in a numbered log in memcache (see
+record_changes); processes that see the log has moved on reload just
+those campaigns. A process that has fallen too far behind, or whose
+schedule is more than REBUILD_INTERVAL old, rebuilds it from scratch.
+
+The process's schedule is read by every request thread without a lock,
+so it's never changed once it's been published: changes are made to a
+copy (see CampaignSchedule.with_changes) that then replaces it.
+"""
+
+import bisect
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+import threading
+import time
+
+from pylons import g
+
+from r2.lib.utils import to_date
+from r2.models import PromotionWeights
+
+
+REBUILD_INTERVAL = 60 * 60
+VERSION_KEY = 'promo_schedule_version'
+CHANGE_KEY = 'promo_schedule_change_%d'
+CHANGE_LOG_TIME = 24 * 60 * 60
+MAX_CHANGES_BEHIND = 500
+
+# a run of days [start, end) on which a campaign has the same daily weight
+CampaignInterval = namedtuple('CampaignInterval',
+                              ['campaign_id', 'link', 'sr_name',
+                               'start', 'end', 'weight'])
+
+
+class _Node(object):
+    __slots__ = ('center', 'by_start', 'by_end', 'left', 'right')
+
+    def __init__(self, center):
+        self.center = center
+        # the intervals containing center, as (start, end, item) and
+        # (end, start, item)
+        self.by_start = []
+        self.by_end = []
+        self.left = None
+        self.right = None
+
+    def add(self, start, end, item):
+        bisect.insort(self.by_start, (start, end, item))
+        bisect.insort(self.by_end, (end, start, item))
+
+    def remove(self, start, end, item):
+        self.by_start.remove((start, end, item))
+        self.by_end.remove((end, start, item))
+
+
+class IntervalTree(object):
+    """A centered interval tree of items over half-open [start, end)
+    intervals of ints.
+
+    Each node keeps the intervals that contain its center and leaves those
+    entirely before or after it to its children. Inserts and removes are
+    done in place, and the tree is rebuilt balanced once there have been
+    as many of them as it has intervals.
+    """
+
+    def __init__(self, entries=()):
+        self._build(list(entries))
+
+    def _build(self, entries):
+        self.root = self._build_node(entries)
+        self.size = len(entries)
+        self.changes = 0
+
+    def _build_node(self, entries):
+        if not entries:
+            return None
+
+        # the lower median endpoint is always inside at least one of the
+        # intervals, so every node holds something
+        points = sorted(p for start, end, item in entries for p in (start, end))
+        node = _Node(points[(len(points) - 1) / 2])
+
+        before, after = [], []
+        for entry in entries:
+            start, end, item = entry
+            if end <= node.center:
+                before.append(entry)
+            elif start > node.center:
+                after.append(entry)
+            else:
+                node.add(start, end, item)
+
+        node.left = self._build_node(before)
+        node.right = self._build_node(after)
+        return node
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if node:
+                for entry in node.by_start:
+                    yield entry
+                nodes.extend((node.left, node.right))
+
+    def _changed(self):
+        self.changes += 1
+        if self.changes > max(self.size, 32):
+            self._build(list(self))
+
+    def insert(self, start, end, item):
+        if start >= end:
+            raise ValueError("empty interval [%r, %r)" % (start, end))
+
+        if not self.root:
+            self.root = self._build_node([(start, end, item)])
+        else:
+            node = self.root
+            while True:
+                if end <= node.center:
+                    if not node.left:
+                        node.left = self._build_node([(start, end, item)])
+                        break
+                    node = node.left
+                elif start > node.center:
+                    if not node.right:
+                        node.right = self._build_node([(start, end, item)])
+                        break
+                    node = node.right
+                else:
+                    node.add(start, end, item)
+                    break
+
+        self.size += 1
+        self._changed()
+
+    def remove(self, start, end, item):
+        node = self.root
+        while node:
+            if end <= node.center:
+                node = node.left
+            elif start > node.center:
+                node = node.right
+            else:
+                node.remove(start, end, item)
+                self.size -= 1
+                self._changed()
+                return
+        raise ValueError("%r isn't in the tree" % (item,))
+
+    def overlapping(self, start, end):
+        """Return the items whose intervals overlap [start, end)."""
+        found = []
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            if not node:
+                continue
+
+            if end <= node.center:
+                # everything here contains center, so overlaps if it
+                # starts before the end
+                for s, e, item in node.by_start:
+                    if s >= end:
+                        break
+                    found.append(item)
+                nodes.append(node.left)
+            elif start > node.center:
+                for e, s, item in reversed(node.by_end):
+                    if e <= start:
+                        break
+                    found.append(item)
+                nodes.append(node.right)
+            else:
+                found.extend(item for s, e, item in node.by_start)
+                nodes.extend((node.left, node.right))
+        return found
+
+    def at(self, point):
+        return self.overlapping(point, point + 1)
+
+
+class CampaignSchedule(object):
+    """The CampaignIntervals of the scheduled campaigns, by subreddit.
+
+    Subreddit names are compared case-insensitively, and '' is the
+    frontpage, as in PromotionWeights.
+    """
+
+    def __init__(self, intervals=(), since=None):
+        self.since = since
+        self.version = 0
+        self.built = time.time()
+        self.trees = {}
+        self.campaigns = {}
+        self.by_link = {}
+        for interval in intervals:
+            self.add(interval)
+
+    def add(self, interval):
+        tree = self.trees.setdefault(interval.sr_name.lower(), IntervalTree())
+        tree.insert(interval.start.toordinal(), interval.end.toordinal(),
+                    interval)
+        self.campaigns.setdefault(interval.campaign_id, []).append(interval)
+        self.by_link.setdefault(interval.link, set()).add(
+            interval.campaign_id)
+
+    def discard(self, campaign_id):
+        for interval in self.campaigns.pop(campaign_id, ()):
+            tree = self.trees[interval.sr_name.lower()]
+            tree.remove(interval.start.toordinal(), interval.end.toordinal(),
+                        interval)
+            self.by_link[interval.link].discard(campaign_id)
+            if not self.by_link[interval.link]:
+                del self.by_link[interval.link]
+
+    def with_changes(self, campaign_ids, intervals):
+        """Return a copy of this schedule in which the intervals of
+        campaign_ids are replaced by intervals. This schedule is left as
+        it is for anyone still reading it."""
+        campaign_ids = set(campaign_ids)
+        kept = [interval
+                for campaign_id, campaign_intervals
+                in self.campaigns.iteritems()
+                if campaign_id not in campaign_ids
+                for interval in campaign_intervals]
+        schedule = CampaignSchedule(kept + list(intervals), since=self.since)
+        schedule.version = self.version
+        schedule.built = self.built
+        return schedule
+
+    def covers(self, start):
+        return self.since is None or to_date(start) >= self.since
+
+    def live(self, date, sr_name=None):
+        """Return the intervals of the campaigns live on date in sr_name, or
+        in every subreddit if it's None."""
+        point = to_date(date).toordinal()
+        if sr_name is None:
+            trees = self.trees.values()
+        else:
+            trees = filter(None, [self.trees.get(sr_name.lower())])
+        return [interval for tree in trees for interval in tree.at(point)]
+
+    def live_by_link(self, link, date):
+        """Return the ids of link's campaigns that are live on date."""
+        date = to_date(date)
+        return [campaign_id
+                for campaign_id in self.by_link.get(link, ())
+                if any(interval.start <= date < interval.end
+                       for interval in self.campaigns[campaign_id])]
+
+    def sold(self, sr_name, start, end):
+        """Return an OrderedDict of each date in [start, end) to the total
+        daily weight of sr_name's campaigns on it."""
+        start, end = to_date(start), to_date(end)
+        ndays = (end - start).days
+        changes = [0.] * (ndays + 1)
+
+        tree = self.trees.get(sr_name.lower())
+        if tree:
+            for interval in tree.overlapping(start.toordinal(),
+                                             end.toordinal()):
+                first = max((interval.start - start).days, 0)
+                last = min((interval.end - start).days, ndays)
+                changes[first] += interval.weight
+                changes[last] -= interval.weight
+
+        sold = OrderedDict()
+        total = 0.
+        for i in xrange(ndays):
+            total += changes[i]
+            sold[start + timedelta(i)] = total
+        return sold
+
+
+def load_intervals(since, until=None, campaign_ids=None):
+    """Read the CampaignIntervals from PromotionWeights' rows dated on or
+    after since (and before until), optionally only for campaign_ids."""
+    q = PromotionWeights.query().filter(PromotionWeights.date >= since)
+    if until:
+        q = q.filter(PromotionWeights.date < until)
+    if campaign_ids is not None:
+        if not campaign_ids:
+            return []
+        q = q.filter(PromotionWeights.promo_idx.in_(list(campaign_ids)))
+
+    days = sorted((pw.promo_idx, pw.thing_name, pw.sr_name or '', pw.date,
+                   pw.weight) for pw in q)
+
+    # merge each campaign's consecutive days with the same weight
+    intervals = []
+    run = None
+    for campaign_id, link, sr_name, date, weight in days:
+        if (run and tuple(run[:3]) == (campaign_id, link, sr_name) and
+                run[4] == date and run[5] == weight):
+            run[4] = date + timedelta(1)
+        else:
+            if run:
+                intervals.append(CampaignInterval(*run))
+            run = [campaign_id, link, sr_name, date, date + timedelta(1),
+                   weight]
+    if run:
+        intervals.append(CampaignInterval(*run))
+    return intervals
+
+
+def record_changes(campaign_ids):
+    """Log that campaign_ids were edited, for every process's schedule to
+    pick up. Called by the update_promos_q consumer."""
+    g.memcache.add(VERSION_KEY, 0)
+    version = g.memcache.incr(VERSION_KEY)
+    if version is not None:
+        g.memcache.set(CHANGE_KEY % version, list(campaign_ids),
+                       time=CHANGE_LOG_TIME)
+
+
+def _logged_changes(since_version, version):
+    """Return the campaign ids logged after since_version up to version,
+    or None if they can't all be found."""
+    if version - since_version > MAX_CHANGES_BEHIND:
+        return None
+    keys = [CHANGE_KEY % v for v in xrange(since_version + 1, version + 1)]
+    logged = g.memcache.get_multi(keys)
+    if len(logged) != len(keys):
+        return None
+    return set(campaign_id for ids in logged.itervalues()
+               for campaign_id in ids)
+
+
+def _floor_date():
+    # a day back, to be safe around the promotion day's offset from g.tz
+    return datetime.now(g.tz).date() - timedelta(1)
+
+
+_schedule = None
+_schedule_lock = threading.Lock()
+
+
+def get_schedule():
+    """Return this process's CampaignSchedule, brought up to date."""
+    global _schedule
+
+    with _schedule_lock:
+        version = g.memcache.get(VERSION_KEY) or 0
+        schedule = _schedule
+
+        if (schedule and schedule.since == _floor_date() and
+                time.time() - schedule.built < REBUILD_INTERVAL):
+            if version == schedule.version:
+                return schedule
+            changed = _logged_changes(schedule.version, version)
+            if changed is not None:
+                intervals = load_intervals(schedule.since,
+                                           campaign_ids=changed)
+                schedule = schedule.with_changes(changed, intervals)
+                schedule.version = version
+                _schedule = schedule
+                return schedule
+
+        since = _floor_date()
+        schedule = CampaignSchedule(load_intervals(since), since=since)
+        schedule.version = version
+        _schedule = schedule
+        return schedule
+
+
+def reload_campaigns(campaign_ids):
+    """Apply edits to campaign_ids to this process's schedule right away,
+    rather than waiting for them to come back through the change log."""
+    global _schedule
+
+    with _schedule_lock:
+        schedule = _schedule
+        if schedule:
+            intervals = load_intervals(schedule.since,
+                                       campaign_ids=campaign_ids)
+            _schedule = schedule.with_changes(campaign_ids, intervals)
+
+
+def _schedule_for(start, end=None):
+    schedule = get_schedule()
+    if schedule.covers(start):
+        return schedule
+    # older dates aren't indexed, so index just the ones asked about
+    start = to_date(start)
+    end = to_date(end) if end else start + timedelta(1)
+    return CampaignSchedule(load_intervals(start, end), since=start)
+
+
+def live_campaigns(date, sr_name=None):
+    """Return the intervals of the campaigns scheduled on date, in sr_name
+    or in every subreddit if it's None."""
+    return _schedule_for(date).live(date, sr_name)
+
+
+def live_campaigns_by_link(link, date):
+    """Return the ids of the campaigns of link (a fullname) scheduled on
+    date."""
+    return _schedule_for(date).live_by_link(link, date)
+
+
+def sold_by_date(sr_name, start, end):
+    """Return an OrderedDict of each date in [start, end) to the total
+    daily weight of the campaigns scheduled on it in sr_name."""
+    return _schedule_for(start, end).sold(sr_name, start, end)
+
+
+def _sold_by_scanning(sr_name, start, end):
+    """sold_by_date the way it was done before the index, for comparison:
+    by reading each date's PromotionWeights."""
+    start, end = to_date(start), to_date(end)
+    sold = OrderedDict()
+    for i in xrange((end - start).days):
+        date = start + timedelta(i)
+        sold[date] = sum(pw.weight
+                         for pw in PromotionWeights.get_campaigns(date)
+                         if (pw.sr_name or '').lower() == sr_name.lower())
+    return sold
+
+
+def benchmark(sr_name='', days=60, iterations=10):
+    """Time the inventory page's sold-weight lookup over the next `days`
+    days for sr_name, by scanning PromotionWeights and from the index."""
+    start = datetime.now(g.tz).date()
+    end = start + timedelta(days)
+
+    began = time.time()
+    schedule = get_schedule()
+    build_time = time.time() - began
+
+    began = time.time()
+    for i in xrange(iterations):
+        scanned = _sold_by_scanning(sr_name, start, end)
+    scan_time = (time.time() - began) / iterations
+
+    began = time.time()
+    for i in xrange(iterations):
+        indexed = sold_by_date(sr_name, start, end)
+    index_time = (time.time() - began) / iterations
+
+    assert all(abs(scanned[d] - indexed[d]) < 1e-6 for d in scanned)
+    print "%d campaign intervals, index built in %.2fs" % (
+        sum(len(tree) for tree in schedule.trees.itervalues()), build_time)
+    print "scanning PromotionWeights: %.2fms" % (scan_time * 1000)
+    print "interval index:            %.2fms" % (index_time * 1000)
+    return scan_time, index_time
@@ -39,13 +39,14 @@ from r2.lib import (
     authorize,
     emailer,
     inventory,
+    promo_schedule,
 )
 from r2.lib.db.queries import set_promote_status
 from r2.lib.memoize import memoize
 from r2.lib.organic import keep_fresh_links
 from r2.lib.strings import strings
 from r2.lib.template_helpers import get_domain
-from r2.lib.utils import UniqueIterator, tup, to_date, weighted_lottery
+from r2.lib.utils import AliasSampler, UniqueIterator, tup, to_date
 from r2.models import (
     Account,
     AdWeight,
@@ -74,6 +75,11 @@ QUEUE_ALL = 'all'
 
 PROMO_HEALTH_KEY = 'promotions_last_updated'
 
+# changed whenever the live promotions are, so that the samplers built
+# from them are rebuilt
+PROMOTIONS_VERSION_KEY = 'promotions_version'
+PROMOTION_SAMPLER_CACHE_TIME = 60 * 60
+
 
 def _mark_promos_updated():
     NamedGlobals.set(PROMO_HEALTH_KEY, time.time())
@@ -379,6 +385,7 @@ def new_campaign(link, dates, bid, sr):
     sr_name = sr.name if sr else ""
     campaign = PromoCampaign._new(link, sr_name, bid, dates[0], dates[1])
     PromotionWeights.add(link, campaign._id, sr_name, dates[0], dates[1], bid)
+    queue_changed_campaign(link, campaign, "created")
     PromotionLog.add(link, 'campaign %s created' % campaign._id)
     author = Account._byID(link.author_id, True)
     if getattr(author, "complimentary_promos", False):
@@ -401,6 +408,7 @@ def edit_campaign(link, campaign, dates, bid, sr):
 
         # update values in the db
         campaign.update(dates[0], dates[1], bid, sr_name, campaign.trans_id, commit=True)
+        queue_changed_campaign(link, campaign, "edited")
 
         # record the transaction
         text = 'updated campaign %s. (bid: %0.2f)' % (campaign._id, bid)
@@ -430,6 +438,7 @@ def complimentary(username, value=True):
 
 def delete_campaign(link, campaign):
     PromotionWeights.delete_unfinished(link, campaign._id)
+    queue_changed_campaign(link, campaign, "deleted")
     void_campaign(link, campaign)
     campaign.delete()
     PromotionLog.add(link, 'deleted campaign %s' % campaign._id)
@@ -515,8 +524,7 @@ def accept_promotion(link):
 
     set_promote_status(link, PROMOTE_STATUS.accepted)
     now = promo_datetime_now(0)
-    if link._fullname in set(l.thing_name for l in
-                             PromotionWeights.get_campaigns(now)):
+    if promo_schedule.live_campaigns_by_link(link._fullname, now):
         PromotionLog.add(link, 'Marked promotion for acceptance')
         charge_pending(0) # campaign must be charged before it will go live
         queue_changed_promo(link, "accepted")
@@ -606,25 +614,22 @@ def fuzz_impressions(imps):
         return 0
 
 def get_scheduled_impressions(sr_name, start_date, end_date):
-    # FIXME: mock function for development
-    start_date = to_date(start_date)
-    end_date = to_date(end_date)
-    ndays = (end_date - start_date).days
-    scheduled = OrderedDict()
-    for i in range(ndays):
-        date = (start_date + timedelta(i))
-        scheduled[date] = random.randint(0, 100) # FIXME: fakedata
-    return scheduled
+    """Return an OrderedDict of each date in [start_date, end_date) to the
+    impressions sold on sr_name, from the campaigns' daily bids."""
+    sr_name = getattr(sr_name, 'name', sr_name) or ''
+    if sr_name.lower() == DefaultSR.name.lower():
+        sr_name = ''
+    sold = promo_schedule.sold_by_date(sr_name, start_date, end_date)
+    return OrderedDict((date, int(bid * 1000 / g.cpm_selfserve))
+                       for date, bid in sold.iteritems())
 
 def get_available_impressions(sr_name, start_date, end_date, fuzzed=False):
-    # FIXME: mock function for development
     start_date = to_date(start_date)
     end_date = to_date(end_date)
     available = inventory.get_predicted_by_date(sr_name, start_date, end_date)
     scheduled = get_scheduled_impressions(sr_name, start_date, end_date)
     for date in scheduled:
-        available[date] = int(available[date] - (available[date] * scheduled[date] / 100.)) # DELETEME
-        #available[date] = max(0, available[date] - scheduled[date]) # UNCOMMENTME
+        available[date] = max(0, available[date] - scheduled[date])
         if fuzzed:
             available[date] = fuzz_impressions(available[date])
     return available
@@ -659,8 +664,7 @@ def scheduled_campaigns_by_link(l, date=None):
     if not is_accepted(l):
         return []
 
-    scheduled = PromotionWeights.get_campaigns(date)
-    campaigns = [c.promo_idx for c in scheduled if c.thing_name == l._fullname]
+    campaigns = promo_schedule.live_campaigns_by_link(l._fullname, date)
 
     # Check authorize
     accepted = []
@@ -678,10 +682,10 @@ def scheduled_campaigns_by_link(l, date=None):
 def promotion_key():
     return "current_promotions:1"
 
-def get_live_promotions(srids):
+def get_live_promotions(srids, stale=True):
     timer = g.stats.get_timer("promote.get_live")
     timer.start()
-    weights = LiveAdWeights.get(srids)
+    weights = LiveAdWeights.get(srids, stale=stale)
     timer.stop()
     return weights
 
@@ -704,6 +708,7 @@ def set_live_promotions(weights):
         all_weights[LiveAdWeights.FRONT_PAGE] = all_weights.pop('')
 
     LiveAdWeights.set_all_from_weights(all_weights)
+    g.cache.set(PROMOTIONS_VERSION_KEY, start)
     end = time.time()
     g.log.info("promote.set_live_promotions completed in %s seconds",
                end - start)
@@ -790,22 +795,24 @@ def make_daily_promotions(offset=0, test=False):
 PromoTuple = namedtuple('PromoTuple', ['link', 'weight', 'campaign'])
 
 
-def get_promotion_list(user, site):
+def get_promotion_srids(user, site):
     if not isinstance(site, FakeSubreddit):
-        srids = set([site._id])
+        return set([site._id])
     elif isinstance(site, MultiReddit):
-        srids = set(site.sr_ids)
+        return set(site.sr_ids)
     elif user and not isinstance(user, FakeAccount):
-        srids = set(Subreddit.reverse_subscriber_ids(user) + [""])
+        return set(Subreddit.reverse_subscriber_ids(user) + [""])
     else:
-        srids = set(Subreddit.user_subreddits(None, ids=True) + [""])
+        return set(Subreddit.user_subreddits(None, ids=True) + [""])
+
 
-    tuples = get_promotion_list_cached(srids)
+def get_promotion_list(user, site):
+    tuples = get_promotion_list_cached(get_promotion_srids(user, site))
     return [PromoTuple(*t) for t in tuples]
 
 
-def get_promotion_list_cached(sites):
-    weights = get_live_promotions(sites)
+def get_promotion_list_cached(sites, stale=True):
+    weights = get_live_promotions(sites, stale=stale)
     if not weights:
         return []
 
@@ -822,16 +829,26 @@ def get_promotion_list_cached(sites):
             for link, weight, campaign in promos]
 
 
+@memoize('promote.promotion_sampler', time=PROMOTION_SAMPLER_CACHE_TIME)
+def _get_promotion_sampler(srids, version):
+    # the sampler is kept for as long as this version is current, so it
+    # mustn't be built from weights in the stalecache that predate it
+    tuples = get_promotion_list_cached(set(srids), stale=False)
+    return AliasSampler({PromoTuple(*t): t[1] for t in tuples})
+
+
+def get_promotion_sampler(user, site):
+    """Return an AliasSampler over the promotion list, weighted by the
+    promotions' weights. It's built once for each set of subreddits each
+    time the live promotions change."""
+    srids = tuple(sorted(get_promotion_srids(user, site)))
+    version = g.cache.get(PROMOTIONS_VERSION_KEY) or 0
+    return _get_promotion_sampler(srids, version)
+
+
 def lottery_promoted_links(user, site, n=10):
-    """Run weighted_lottery to order and choose a subset of promoted links."""
-    promo_tuples = get_promotion_list(user, site)
-    weights = {p: p.weight for p in promo_tuples if p.weight}
-    selected = []
-    while weights and len(selected) < n:
-        s = weighted_lottery(weights)
-        del weights[s]
-        selected.append(s)
-    return selected
+    """Choose and order a subset of promoted links by lottery."""
+    return get_promotion_sampler(user, site).sample(n)
 
 
 def sample_promoted_links(user, site, n=10):
@@ -908,6 +925,17 @@ def run_changed(drain=False, limit=100, sleep_time=10, verbose=True):
     @g.stats.amqp_processor(UPDATE_QUEUE)
     def _run(msgs, chan):
         items = [json.loads(msg.body) for msg in msgs]
+
+        # campaign edits only need to reach the schedule index
+        campaign_items = [i for i in items
+                          if isinstance(i, dict) and 'campaign' in i]
+        if campaign_items:
+            promo_schedule.record_changes(set(i['campaign']
+                                              for i in campaign_items))
+            items = [i for i in items if i not in campaign_items]
+            if not items:
+                return
+
         if QUEUE_ALL in items:
             # QUEUE_ALL is just an indicator to run make_daily_promotions.
             # There's no promotion log to update in this case.
@@ -927,3 +955,12 @@ def queue_changed_promo(link, message):
     msg = {"link": link._fullname, "message": message}
     amqp.add_item(UPDATE_QUEUE, json.dumps(msg),
                   delivery_mode=amqp.DELIVERY_TRANSIENT)
+
+
+def queue_changed_campaign(link, campaign, message):
+    """Let every process's promo_schedule know campaign was changed."""
+    promo_schedule.reload_campaigns([campaign._id])
+    msg = {"link": link._fullname, "campaign": campaign._id,
+           "message": message}
+    amqp.add_item(UPDATE_QUEUE, json.dumps(msg),
+                  delivery_mode=amqp.DELIVERY_TRANSIENT)
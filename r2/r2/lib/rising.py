@@ -20,7 +20,9 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from collections import defaultdict
 from datetime import datetime
+import heapq
 
 from pylons import g
 
@@ -29,41 +31,66 @@ from r2.models.link import Link
 
 
 CACHE_KEY = "rising"
+# {sr_id: [(-score, fullname), ...]}, each list best first
+SR_INDEX_KEY = "rising_by_sr"
 
+MAX_RISING = 1000
+MAX_RISING_PER_SR = 100
 
-def calc_rising():
+
+def score_rising():
+    """Return [(score, fullname, sr_id)] for the rising candidates, with
+    each link's score computed once"""
     sr_count = count.get_link_counts()
     link_count = dict((k, v[0]) for k,v in sr_count.iteritems())
     link_names = Link._by_fullname(sr_count.keys(), data=True)
 
     #max is half the average of the top 10 counts
-    counts = link_count.values()
-    counts.sort(reverse=True)
-    maxcount = sum(counts[:10]) / 20
-
-    #prune the list
-    rising = [(n, link_names[n].sr_id)
-              for n in link_names.keys() if link_count[n] < maxcount]
+    counts = heapq.nlargest(10, link_count.itervalues())
+    maxcount = sum(counts) / 20
 
     cur_time = datetime.now(g.tz)
 
-    def score(pair):
-        name = pair[0]
-        link = link_names[name]
-        hours = (cur_time - link._date).seconds / 3600 + 1
-        return float(link._ups) / (max(link_count[name], 1) * hours)
+    scored = []
+    for name, link in link_names.iteritems():
+        views = link_count[name]
+        #prune the list
+        if views >= maxcount:
+            continue
+        age = (cur_time - link._date).total_seconds()
+        hours = int(age // 3600) + 1
+        score = float(link._ups) / (max(views, 1) * hours)
+        scored.append((score, name, link.sr_id))
+    return scored
+
+
+def calc_rising(scored=None):
+    if scored is None:
+        scored = score_rising()
+    return [(name, sr_id) for score, name, sr_id
+            in heapq.nlargest(MAX_RISING, scored)]
 
-    def r(x):
-        return 1 if x > 0 else -1 if x < 0 else 0
 
-    rising.sort(lambda x, y: r(score(y) - score(x)))
-    return rising
+def calc_rising_by_sr(scored):
+    by_sr = defaultdict(list)
+    for score, name, sr_id in scored:
+        by_sr[sr_id].append((-score, name))
+    return dict((sr_id, heapq.nsmallest(MAX_RISING_PER_SR, links))
+                for sr_id, links in by_sr.iteritems())
 
 
 def set_rising():
-    g.cache.set(CACHE_KEY, calc_rising())
+    scored = score_rising()
+    g.cache.set_multi({CACHE_KEY: calc_rising(scored),
+                       SR_INDEX_KEY: calc_rising_by_sr(scored)})
 
 
 def get_rising(sr):
-    rising = g.cache.get(CACHE_KEY, [])
-    return [link for link, sr_id in rising if sr.keep_for_rising(sr_id)]
+    sr_ids = sr.rising_sr_ids()
+    if sr_ids is None:
+        rising = g.cache.get(CACHE_KEY, [])
+        return [link for link, sr_id in rising if sr.keep_for_rising(sr_id)]
+
+    by_sr = g.cache.get(SR_INDEX_KEY, {})
+    ranked = heapq.merge(*[by_sr.get(sr_id, ()) for sr_id in sr_ids])
+    return [link for neg_score, link in ranked]
@@ -20,13 +20,20 @@
 # Inc. All Rights Reserved.
 ###############################################################################
 
+from pylons import g
+
 import r2.lib.cloudsearch as cloudsearch
 
 
 InvalidQuery = (cloudsearch.InvalidQuery,)
 SearchException = (cloudsearch.CloudSearchHTTPError,)
 
-SearchQuery = cloudsearch.LinkSearchQuery
-SubredditSearchQuery = cloudsearch.SubredditSearchQuery
+if g.config.get('search_provider', 'cloudsearch') == 'local':
+    import r2.lib.localsearch as localsearch
+    SearchQuery = localsearch.LocalLinkSearchQuery
+    SubredditSearchQuery = localsearch.LocalSubredditSearchQuery
+else:
+    SearchQuery = cloudsearch.LinkSearchQuery
+    SubredditSearchQuery = cloudsearch.SubredditSearchQuery
 
 sorts = cloudsearch.LinkSearchQuery.sorts_menu_mapping
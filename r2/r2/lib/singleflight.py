@@ -0,0 +1,73 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""Coalesce concurrent requests for the same work within a process.
+
+The first caller for a key becomes its leader and does the work, the callers
+that join while it's in flight wait for the leader to land with its result
+rather than repeating the work themselves.
+
+"""
+
+import time
+from threading import Event, Lock
+
+
+class Flight(object):
+    def __init__(self):
+        self.started = time.time()
+        self.done = Event()
+        self.result = None
+
+    def wait(self, timeout):
+        """Wait for the leader and return its result, None if it didn't land
+        in time or landed without one."""
+        self.done.wait(timeout)
+        return self.result
+
+
+class SingleFlight(object):
+    def __init__(self, timeout):
+        # a leader that hasn't landed after `timeout` seconds is presumed
+        # lost (its request died before landing), and the next caller
+        # becomes the new leader.
+        self.timeout = timeout
+        self.lock = Lock()
+        self.flights = {}
+
+    def join(self, key):
+        """Return (flight, is_leader) for key."""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight and time.time() - flight.started < self.timeout:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def land(self, key, flight, result=None):
+        """Finish the leader's flight, handing result to its followers."""
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.result = result
+        flight.done.set()
@@ -0,0 +1,246 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+"""Send mail through a pool of SMTP sessions.
+
+A DeliveryPipeline sends Deliveries (one message to one recipient each) from
+a pool of worker threads, each with its own SMTP session, so that one slow
+recipient doesn't hold up the rest. The workers only talk SMTP: the caller's
+thread produces the deliveries (rendering them as they're asked for) and
+records how each one went as it's handed back. A delivery that's still
+getting transient errors when it runs out of attempts is handed back as
+DEFERRED, so that the caller can leave it queued for the next run rather
+than give up on it.
+
+"""
+
+import heapq
+import Queue
+import smtplib
+import socket
+import sys
+import threading
+import time
+import traceback
+
+
+# errors after which the session is reconnected and the message retried
+DISCONNECTED_ERRORS = (smtplib.SMTPServerDisconnected,
+                       smtplib.SMTPConnectError,
+                       socket.error)
+
+SENT, FAILED, RETRY, BUSY = "sent", "failed", "retry", "busy"
+DEFERRED = "deferred"
+
+
+def is_transient(code):
+    return 400 <= code < 500
+
+
+class Delivery(object):
+    def __init__(self, key, fr_addr, to_addr, message):
+        # key is whatever the caller needs to tell which message this is
+        self.key = key
+        self.fr_addr = fr_addr
+        self.to_addr = to_addr
+        self.message = message
+        self.attempts = 0
+
+    @property
+    def domain(self):
+        return self.to_addr.rpartition('@')[2].lower()
+
+    def __repr__(self):
+        return "<Delivery to %s>" % self.to_addr
+
+
+class DeliveryPipeline(object):
+    def __init__(self, smtp_server, sessions=4, per_domain=2, max_attempts=4,
+                 retry_delay=1., timeout=30):
+        self.smtp_server = smtp_server
+        self.sessions = sessions
+        self.per_domain = per_domain
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+        self.jobs = Queue.Queue()
+        self.results = Queue.Queue()
+        self.domain_lock = threading.Lock()
+        self.domain_slots = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+        self.retried = 0
+        self.elapsed = 0.
+
+    def _connect(self):
+        return smtplib.SMTP(self.smtp_server, timeout=self.timeout)
+
+    def _domain_slot(self, domain):
+        with self.domain_lock:
+            slot = self.domain_slots.get(domain)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_domain)
+                self.domain_slots[domain] = slot
+            return slot
+
+    def _send(self, session, delivery):
+        """Try delivery on session, returning the outcome and the session to
+        use for the next one."""
+        try:
+            if session is None:
+                session = self._connect()
+            session.sendmail(delivery.fr_addr, delivery.to_addr,
+                             delivery.message)
+            return SENT, session
+        except DISCONNECTED_ERRORS:
+            if session is not None:
+                try:
+                    session.close()
+                except Exception:
+                    pass
+            return RETRY, None
+        except smtplib.SMTPRecipientsRefused as e:
+            codes = [code for code, msg in e.recipients.itervalues()]
+            if codes and all(is_transient(code) for code in codes):
+                return RETRY, session
+            return FAILED, session
+        except smtplib.SMTPResponseException as e:
+            if is_transient(e.smtp_code):
+                return RETRY, session
+            return FAILED, session
+        except Exception:
+            print "Handled error sending mail (traceback to follow)"
+            traceback.print_exc(file = sys.stdout)
+            return FAILED, session
+
+    def _work(self):
+        session = None
+        while True:
+            delivery = self.jobs.get()
+            if delivery is None:
+                break
+
+            slot = self._domain_slot(delivery.domain)
+            if not slot.acquire(False):
+                # that domain has as many deliveries going as it's allowed
+                self.results.put((BUSY, delivery))
+                continue
+
+            try:
+                delivery.attempts += 1
+                outcome, session = self._send(session, delivery)
+            finally:
+                slot.release()
+            self.results.put((outcome, delivery))
+
+        if session is not None:
+            try:
+                session.quit()
+            except Exception:
+                pass
+
+    def deliver(self, deliveries):
+        """Send deliveries, yielding (delivery, outcome) as each one
+        finishes, where outcome is SENT, FAILED or DEFERRED.
+
+        deliveries is only read as the workers are ready for more, so it
+        may produce them lazily.
+        """
+        start = time.time()
+        workers = [threading.Thread(target=self._work)
+                   for i in xrange(self.sessions)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        pending = iter(deliveries)
+        in_flight = 0
+        waiting = [] # heap of (when, seq, delivery) to retry
+        seq = 0
+
+        try:
+            while True:
+                while pending is not None and in_flight < 2 * self.sessions:
+                    try:
+                        delivery = next(pending)
+                    except StopIteration:
+                        pending = None
+                        break
+                    self.jobs.put(delivery)
+                    in_flight += 1
+
+                now = time.time()
+                while waiting and waiting[0][0] <= now:
+                    self.jobs.put(heapq.heappop(waiting)[2])
+
+                if pending is None and not in_flight:
+                    break
+
+                timeout = waiting[0][0] - now if waiting else 1.
+                try:
+                    outcome, delivery = self.results.get(
+                        timeout=max(timeout, .01))
+                except Queue.Empty:
+                    continue
+
+                if outcome == BUSY:
+                    delay = .05
+                elif (outcome == RETRY and
+                      delivery.attempts < self.max_attempts):
+                    delay = self.retry_delay * 2 ** (delivery.attempts - 1)
+                    self.retried += 1
+                else:
+                    delay = None
+
+                if delay is not None:
+                    seq += 1
+                    heapq.heappush(waiting, (time.time() + delay, seq,
+                                             delivery))
+                    continue
+
+                in_flight -= 1
+                if outcome == SENT:
+                    self.sent += 1
+                elif outcome == RETRY:
+                    outcome = DEFERRED
+                    self.deferred += 1
+                else:
+                    self.failed += 1
+                yield delivery, outcome
+        finally:
+            for worker in workers:
+                self.jobs.put(None)
+            for worker in workers:
+                worker.join(self.timeout)
+            self.elapsed += time.time() - start
+
+    def summary(self):
+        done = self.sent + self.failed + self.deferred
+        rate = done / self.elapsed if self.elapsed else 0
+        return ("sent %d, failed %d, deferred %d, retried %d in %.2fs "
+                "(%.1f messages/s)" %
+                (self.sent, self.failed, self.deferred, self.retried,
+                 self.elapsed, rate))
@@ -238,6 +238,7 @@ class Timer:
         self._last = None
         self._stop = None
         self._timings = []
+        self._steps = []
 
     def flush(self):
         for timing in self._timings:
@@ -251,6 +252,11 @@ class Timer:
             raise AssertionError("timer hasn't been stopped")
         return self._stop - self._start
 
+    def breakdown(self):
+        """Return a list of (subname, seconds) for each intermediate step,
+        including those that have already been flushed."""
+        return list(self._steps)
+
     def send(self, subname, start, end):
         name = _get_stat_name(self.name, subname)
         self.client.timing_stats.record(name, start, end,
@@ -266,6 +272,7 @@ class Timer:
             raise AssertionError("timer is stopped")
         last, self._last = self._last, self._time()
         self._timings.append((subname, last, self._last))
+        self._steps.append((subname, self._last - last))
 
     def stop(self, subname='total'):
         if self._start is None:
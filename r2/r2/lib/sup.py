@@ -21,9 +21,9 @@
 ###############################################################################
 
 from datetime import datetime
-from itertools import ifilter
 import time
 import hashlib
+import struct
 
 import simplejson
 
@@ -36,14 +36,27 @@ PERIODS = [600, 300, 60]
 MIN_PERIOD = min(PERIODS)
 MAX_PERIOD = max(PERIODS)
 
+# updates are kept in a ring of BUCKETS buckets of MIN_PERIOD seconds, each
+# split into SLOTS keys of up to SLOT_RECORDS packed (sup_id, time) records
+# (9 bytes each, so a slot stays well under memcache's item size limit).
+# the slots of a bucket are a ring too: in a minute with more than
+# SLOTS * SLOT_RECORDS updates, the oldest are overwritten.
+RECORD = struct.Struct('>5sI')
+SLOT_RECORDS = 8192
+SLOTS = 16
+BUCKETS = MAX_PERIOD / MIN_PERIOD + 2
+
 def sup_url():
     return 'http://%s/sup.json' % get_domain(subreddit = False)
 
 def period_urls():
     return dict((p, sup_url() + "?seconds=" + str(p)) for p in PERIODS)
 
-def cache_key(ts):
-    return 'sup_' + str(ts)
+def slot_key(bucket_time, slot, prefix='sup_'):
+    return '%s%d_%d' % (prefix, bucket_time / MIN_PERIOD % BUCKETS, slot)
+
+def counter_key(bucket_time, prefix='sup_'):
+    return '%sn_%d' % (prefix, bucket_time)
 
 def make_cur_time(period):
     t = int(time.time())
@@ -57,14 +70,52 @@ def make_sup_id(user, action):
     #cause cool kids only use part of the hash
     return sup_id[:10]
 
-def add_update(user, action):
-    update_time = int(time.time())
-    sup_id = make_sup_id(user, action)
-    supdate = ',%s:%s' % (sup_id, update_time)
+def store_update(cache, sup_id, update_time, prefix='sup_'):
+    bucket_time = update_time - update_time % MIN_PERIOD
+    expire = BUCKETS * MIN_PERIOD
+
+    counter = counter_key(bucket_time, prefix)
+    # incr raises on a missing key with pylibmc, so create the counter first
+    cache.add(counter, 0, time=expire)
+    n = cache.incr(counter)
+    if n is None:
+        return
+    n -= 1
+
+    key = slot_key(bucket_time, n / SLOT_RECORDS % SLOTS, prefix)
+    record = RECORD.pack(sup_id.decode('hex'), update_time)
+    if n % SLOT_RECORDS == 0:
+        # the first record in this slot for this lap of the ring replaces
+        # what was left in it by an older bucket or lap. (appends racing
+        # ahead of this set are lost, which is fine for sup.)
+        cache.set(key, record, time=expire)
+    elif not cache.append(key, record):
+        cache.add(key, record, time=expire)
+
+def read_updates(cache, since, until, prefix='sup_'):
+    """Return [(sup_id, time)] of the latest update of each sup_id between
+    since and until, oldest first, from a single get_multi."""
+    keys = [slot_key(bucket_time, slot, prefix)
+            for bucket_time in xrange(since - since % MIN_PERIOD, until,
+                                      MIN_PERIOD)
+            for slot in xrange(SLOTS)]
+
+    latest = {}
+    unpack = RECORD.unpack_from
+    size = RECORD.size
+    for blob in cache.get_multi(keys).itervalues():
+        for pos in xrange(0, len(blob) - size + 1, size):
+            sup_id, update_time = unpack(blob, pos)
+            # records left by older laps of the ring fail this check
+            if (since <= update_time < until and
+                update_time > latest.get(sup_id, 0)):
+                latest[sup_id] = update_time
+
+    by_time = sorted((t, raw_id) for raw_id, t in latest.iteritems())
+    return [(raw_id.encode('hex'), t) for t, raw_id in by_time]
 
-    key = cache_key(make_cur_time(MIN_PERIOD))
-    g.cache.add(key, '')
-    g.cache.append(key, supdate)
+def add_update(user, action):
+    store_update(g.cache, make_sup_id(user, action), int(time.time()))
 
 @memoize('set_json', time = MAX_PERIOD)
 def sup_json_cached(period, last_time):
@@ -72,20 +123,10 @@ def sup_json_cached(period, last_time):
     #the call to make_last_time
     target_time = last_time + MIN_PERIOD - period
 
-    updates = ''
-    #loop backwards adding MIN_PERIOD chunks until last_time is as old
-    #as target time
-    while last_time >= target_time:
-        updates += g.cache.get(cache_key(last_time)) or ''
-        last_time -= MIN_PERIOD
-
-    supdates = []
-    if updates:
-        for u in ifilter(None, updates.split(',')):
-            sup_id, time = u.split(':')
-            time = int(time)
-            if time >= target_time:
-                supdates.append([sup_id, to36(time)])
+    supdates = [[sup_id, to36(update_time)]
+                for sup_id, update_time
+                in read_updates(g.cache, target_time,
+                                last_time + MIN_PERIOD)]
 
     update_time = datetime.utcnow()
     since_time = datetime.utcfromtimestamp(target_time)
@@ -111,3 +152,32 @@ def set_expires_header():
     expire_time = datetime.fromtimestamp(seconds, g.tz)
     response.headers['expires'] = http_date_str(expire_time)
 
+
+def benchmark(updates=100000, users=20000, cache=None):
+    """Time storing a busy minute's updates and reading them back.
+
+    Runs against g.memcache unless another cache is given, with keys apart
+    from the real feed's.
+    """
+    cache = cache or g.memcache
+    prefix = 'sup_benchmark_'
+    bucket_time = make_cur_time(MIN_PERIOD)
+    cache.delete(counter_key(bucket_time, prefix))
+
+    sup_ids = [hashlib.md5('user%d' % i).hexdigest()[:10]
+               for i in xrange(users)]
+
+    start = time.time()
+    for i in xrange(updates):
+        update_time = bucket_time + i * MIN_PERIOD / updates
+        store_update(cache, sup_ids[i % users], update_time, prefix)
+    stored = time.time() - start
+
+    start = time.time()
+    read = read_updates(cache, bucket_time, bucket_time + MIN_PERIOD, prefix)
+    read_time = time.time() - start
+
+    print "stored %d updates in %.2fs (%.0f/s)" % (updates, stored,
+                                                  updates / stored)
+    print "read %d sup_ids back in %.3fs" % (len(read), read_time)
+    return stored, read_time
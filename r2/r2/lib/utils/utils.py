@@ -32,6 +32,7 @@ from urlparse import urlparse, urlunparse
 import signal
 from copy import deepcopy
 import cPickle as pickle
+import heapq
 import re, math, random
 import boto
 from decimal import Decimal
@@ -1488,6 +1489,85 @@ def weighted_lottery(weights, _random=random.random):
         "weighted_lottery messed up: r=%r, t=%r, total=%r" % (r, t, total))
 
 
+class AliasSampler(object):
+    """Weighted random choices from a fixed dict of weights.
+
+    This is weighted_lottery for weights that are reused across many
+    lotteries. The weights are preprocessed once into Vose's alias tables,
+    so that draw() takes constant time however many keys there are, and
+    sample() picks several distinct keys in one pass over them rather than
+    running a lottery per key. Keys with zero weight are never chosen.
+
+    Raises ValueError if weights contains a negative weight.
+    """
+
+    def __init__(self, weights):
+        self.keys = []
+        self.weights = []
+        for key, weight in weights.iteritems():
+            if weight < 0:
+                raise ValueError("weight for %r must be non-negative" % key)
+            if weight > 0:
+                self.keys.append(key)
+                self.weights.append(weight)
+
+        n = len(self.keys)
+        total = float(sum(self.weights))
+        self.probabilities = [1.] * n
+        self.aliases = range(n)
+
+        # each column i of the table is split between key i, with
+        # probability probabilities[i], and key aliases[i]. columns are
+        # filled by topping up an underfull key with part of an overfull
+        # one until none are left
+        scaled = [weight * n / total for weight in self.weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+        # anything still in small or large is only off 1 by rounding error,
+        # so it keeps the whole column it started with
+
+    def __len__(self):
+        return len(self.keys)
+
+    def draw(self, _random=random.random):
+        """Choose a key with probability proportional to its weight."""
+        if not self.keys:
+            raise ValueError("total weight must be positive")
+
+        r = _random() * len(self.keys)
+        column = int(r)
+        if r - column < self.probabilities[column]:
+            return self.keys[column]
+        else:
+            return self.keys[self.aliases[column]]
+
+    def sample(self, n, _random=random.random):
+        """Choose up to n distinct keys without replacement.
+
+        The keys come out in the order, and with the probabilities, that
+        repeatedly running weighted_lottery and removing the winner would
+        give. Each key gets the priority log(u) / weight for a uniform u,
+        and the n highest priorities win (Efraimidis and Spirakis's
+        weighted reservoir sampling).
+        """
+        def priority(item):
+            key, weight = item
+            return math.log(1. - _random()) / weight
+
+        chosen = heapq.nlargest(n, zip(self.keys, self.weights), key=priority)
+        return [key for key, weight in chosen]
+
+
 def read_static_file_config(config_file):
     parser = ConfigParser.RawConfigParser()
     with open(config_file, "r") as cf:
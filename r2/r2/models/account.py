@@ -28,7 +28,7 @@ from r2.lib.memoize      import memoize
 from r2.lib.utils        import modhash, valid_hash, randstr, timefromnow
 from r2.lib.utils        import UrlParser
 from r2.lib.utils        import constant_time_compare, canonicalize_email
-from r2.lib.cache        import sgm
+from r2.lib.cache        import sgm, make_key, NoneResult
 from r2.lib import filters
 from r2.lib.log import log_text
 from r2.lib.zookeeper import LiveDict
@@ -292,6 +292,39 @@ class Account(Thing):
         else:
             raise NotFound, 'Account %s' % name
 
+    @classmethod
+    def _by_names(cls, names, allow_deleted = False, _update = False):
+        """_by_name for many names at once. Returns a dict of the given
+           names to their Accounts, leaving out those that don't exist.
+
+           The name to id mappings share their cache with _by_name_cache
+           and are fetched with a single multi-get, and any misses with a
+           single query."""
+        lowered = dict((name, name.lower()) for name in names)
+        keys = dict((make_key('account._by_name', cls, name, allow_deleted),
+                     name)
+                    for name in set(lowered.itervalues()))
+
+        def _lookup_names(missing_keys):
+            missing = dict((keys[key], key) for key in missing_keys)
+            deleted = (True, False) if allow_deleted else False
+            q = cls._query(lower(Account.c.name).in_(missing.keys()),
+                           Account.c._spam == (True, False),
+                           Account.c._deleted == deleted,
+                           data = True)
+            found = dict((a.name.lower(), a._id) for a in q)
+            return dict((key, found.get(name, NoneResult))
+                        for name, key in missing.iteritems())
+
+        ids = sgm(g.memoizecache, keys, _lookup_names, _update = _update)
+        ids = dict((keys[key], uid) for key, uid in ids.iteritems()
+                   if uid != NoneResult)
+
+        accounts = cls._byID(ids.values(), data = True) if ids else {}
+        return dict((name, accounts[ids[low]])
+                    for name, low in lowered.iteritems()
+                    if low in ids)
+
     # Admins only, since it's not memoized
     @classmethod
     def _by_name_multiple(cls, name):
@@ -46,6 +46,36 @@ class Flair(Relation(Subreddit, Account)):
         setattr(account, 'flair_%s_css_class' % sr._id, css_class)
         account._commit()
 
+    @classmethod
+    def store_multi(cls, sr, flair_by_account):
+        """Set the flair of many accounts in sr at once.
+
+        flair_by_account maps Accounts to (text, css_class) tuples; where
+        both are empty the account's flair is removed. The flair relations
+        are looked up, created and deleted in bulk and the accounts are
+        committed together with Account._commit_multi.
+
+        """
+        accounts = flair_by_account.keys()
+        rels = cls._fast_query(sr, accounts, 'flair')
+
+        to_add = []
+        to_remove = []
+        for account, (text, css_class) in flair_by_account.iteritems():
+            rel = rels.get((sr, account, 'flair'))
+            if text or css_class:
+                if not rel:
+                    to_add.append((sr, account))
+            elif rel:
+                to_remove.append(rel)
+
+            setattr(account, 'flair_%s_text' % sr._id, text)
+            setattr(account, 'flair_%s_css_class' % sr._id, css_class)
+
+        cls._create_multi(to_add, 'flair')
+        cls._delete_multi(to_remove)
+        Account._commit_multi(accounts)
+
     @classmethod
     @memoize('flair.all_flair_by_sr')
     def all_flair_by_sr_cache(cls, sr_id):
@@ -21,6 +21,7 @@
 ###############################################################################
 
 import datetime
+import time
 
 from pylons import g
 from pycassa.system_manager import ASCII_TYPE, DATE_TYPE
@@ -29,6 +30,46 @@ from r2.lib.db import tdb_cassandra
 from r2.lib.utils import tup
 
 
+MEMCACHE_PREFIX = "lastmod:"
+MEMCACHE_TIME = 6 * 60 * 60
+
+# timestamps can also be kept in a small per-process cache in front of
+# memcache. a timestamp from there may be a few seconds behind a touch
+# made by another process, which is fine for deciding whether to send a
+# 304 but not for much else, so callers have to ask for it.
+LOCAL_CACHE_TIME = 5
+LOCAL_CACHE_SIZE = 10000
+
+# memcache can't store None, so timestamps that were never set are
+# cached as this instead
+NOT_SET = False
+
+_local_cache = {}
+
+
+def _memcache_key(fullname, name):
+    return "%s/%s" % (fullname, name)
+
+
+def _cache_locally(values):
+    if len(_local_cache) + len(values) > LOCAL_CACHE_SIZE:
+        _local_cache.clear()
+
+    expires = time.time() + LOCAL_CACHE_TIME
+    for pair, value in values.iteritems():
+        _local_cache[pair] = (expires, value)
+
+
+def _get_locally(pairs):
+    now = time.time()
+    ret = {}
+    for pair in pairs:
+        cached = _local_cache.get(pair)
+        if cached and cached[0] > now:
+            ret[pair] = cached[1]
+    return ret
+
+
 class LastModified(tdb_cassandra.View):
     _use_db = True
     _value_type = "date"
@@ -39,28 +80,115 @@ class LastModified(tdb_cassandra.View):
 
     @classmethod
     def touch(cls, fullname, names):
-        names = tup(names)
+        return cls.touch_multi({fullname: names})
+
+    @classmethod
+    @tdb_cassandra.will_write
+    def touch_multi(cls, names_by_fullname):
+        """Set timestamps on many rows to now in one batch of mutations.
+
+        `names_by_fullname` maps each fullname to the name or names to
+        touch on it. The new timestamps are written through to memcache
+        (and this process's cache) so that readers see them immediately.
+
+        """
         now = datetime.datetime.now(g.tz)
-        values = dict.fromkeys(names, now)
-        cls._set_values(fullname, values)
+        pairs = [(fullname, name)
+                 for fullname, names in names_by_fullname.iteritems()
+                 for name in tup(names)]
+        if not pairs:
+            return now
+
+        wcl = cls._wcl(None)
+        with cls._cf.batch(write_consistency_level=wcl) as b:
+            for fullname, name in pairs:
+                b.insert(fullname, {name: cls._serialize_column(name, now)},
+                         ttl=cls._default_ttls.get(name, cls._ttl))
+
+        tdb_cassandra.thing_cache.delete_multi(
+            [cls._cache_key_id(fullname) for fullname in names_by_fullname])
+        g.memcache.set_multi(
+            dict((_memcache_key(*pair), now) for pair in pairs),
+            prefix=MEMCACHE_PREFIX, time=MEMCACHE_TIME)
+        _cache_locally(dict.fromkeys(pairs, now))
         return now
 
     @classmethod
-    def get(cls, fullname, name, touch_if_not_set=False):
-        try:
-            obj = cls._byID(fullname)
-        except tdb_cassandra.NotFound:
-            if touch_if_not_set:
-                time = cls.touch(fullname, name)
-                return time
+    def _fetch_multi(cls, pairs):
+        # one multiget for every row, sliced to just the names we're after.
+        # a name asked for on one row is fetched for all of them, but there
+        # are only ever a few names in play at a time.
+        fullnames = sorted(set(fullname for fullname, name in pairs))
+        names = sorted(set(name for fullname, name in pairs))
+        rows = cls._cf.multiget(fullnames, columns=names)
+
+        ret = {}
+        for fullname, name in pairs:
+            value = rows.get(fullname, {}).get(name)
+            if value is None:
+                ret[(fullname, name)] = NOT_SET
             else:
-                return None
+                ret[(fullname, name)] = cls._deserialize_column(name, value)
+        return ret
+
+    @classmethod
+    def get_many(cls, pairs, touch_if_not_set=False, local=False):
+        """Return the timestamps for many (fullname, name) pairs at once.
+
+        The result maps each pair to its timestamp, or None if it was never
+        touched. Anything not in memcache is fetched with a single
+        Cassandra multiget. With `local`, this process's short-lived cache
+        is consulted first (see LOCAL_CACHE_TIME).
+
+        """
+        pairs = set(pairs)
+        ret = _get_locally(pairs) if local else {}
+
+        still_need = pairs - set(ret)
+        if still_need:
+            keys = dict((_memcache_key(*pair), pair) for pair in still_need)
+            cached = g.memcache.get_multi(keys.keys(), prefix=MEMCACHE_PREFIX)
+            found = dict((keys[key], value)
+                         for key, value in cached.iteritems())
 
-        return getattr(obj, name, None)
+            missing = still_need - set(found)
+            if missing:
+                fetched = cls._fetch_multi(missing)
+                # add rather than set so that a touch racing with this
+                # lookup isn't clobbered by the value we read before it
+                g.memcache.add_multi(
+                    dict((_memcache_key(*pair), value)
+                         for pair, value in fetched.iteritems()),
+                    prefix=MEMCACHE_PREFIX, time=MEMCACHE_TIME)
+                found.update(fetched)
+
+            if local:
+                _cache_locally(found)
+            ret.update(found)
+
+        ret = dict((pair, value or None) for pair, value in ret.iteritems())
+
+        if touch_if_not_set:
+            unset = {}
+            for (fullname, name), value in ret.iteritems():
+                if value is None:
+                    unset.setdefault(fullname, []).append(name)
+            if unset:
+                now = cls.touch_multi(unset)
+                for fullname, names in unset.iteritems():
+                    for name in names:
+                        ret[(fullname, name)] = now
+
+        return ret
 
     @classmethod
-    def get_multi(cls, fullnames, name):
-        res = cls._byID(fullnames, return_dict=True)
+    def get(cls, fullname, name, touch_if_not_set=False):
+        pair = (fullname, name)
+        res = cls.get_many([pair], touch_if_not_set=touch_if_not_set)
+        return res[pair]
 
-        return dict((k, getattr(v, name, None))
-                    for k, v in res.iteritems())
+    @classmethod
+    def get_multi(cls, fullnames, name):
+        res = cls.get_many((fullname, name) for fullname in fullnames)
+        return dict((fullname, value)
+                    for (fullname, name), value in res.iteritems())
@@ -1454,8 +1454,11 @@ class Message(Thing, Printable):
     def keep_item(self, wrapped):
         return True
 
-class SaveHide(Relation(Account, Link)): pass
-class Click(Relation(Account, Link)): pass
+class SaveHide(Relation(Account, Link)):
+    _fast_index_side = 1
+
+class Click(Relation(Account, Link)):
+    _fast_index_side = 1
 
 
 class GildedCommentsByAccount(tdb_cassandra.DenormalizedRelation):
@@ -277,7 +277,7 @@ class EmailHandler(object):
                  msg_hash, fr_addr, reply_to) in res:
                 yield (accts.get(acct), things.get(fulln), addr,
                        fname, date, ip, ips[ip], kind, msg_hash, body,
-                       fr_addr, reply_to)
+                       fr_addr, reply_to, uid)
 
     def clear_queue(self, max_date, kind = None):
         s = self.queue_table
@@ -286,6 +286,12 @@ class EmailHandler(object):
             where.append([s.c.kind == kind])
         sa.delete(s, sa.and_(*where)).execute()
 
+    def remove_from_queue(self, uids):
+        """Delete particular messages from the queue by their uid."""
+        if uids:
+            s = self.queue_table
+            sa.delete(s, s.c.uid.in_(uids)).execute()
+
 
 class Email(object):
     handler = EmailHandler()
@@ -328,7 +334,7 @@ class Email(object):
 
     def __init__(self, user, thing, email, from_name, date, ip, banned_ip,
                  kind, msg_hash, body = '', from_addr = '',
-                 reply_to = ''):
+                 reply_to = '', uid = None):
         self.user = user
         self.thing = thing
         self.to_addr = email
@@ -342,6 +348,8 @@ class Email(object):
         self.body = body
         self.msg_hash = msg_hash
         self.reply_to = reply_to
+        # the message's row in the queue, if it came from there
+        self.uid = uid
         self.subject = self.subjects.get(kind, "")
         try:
             self.subject = self.subject % dict(user = self.from_name())
@@ -372,28 +380,61 @@ class Email(object):
                (self.kind == self.Kind.OPTOUT or
                 not has_opted_out(self.to_addr))
 
+    def _sent_row(self):
+        return dict(account_id = self.user._id if self.user else 0,
+                    to_addr = self.to_addr,
+                    fr_addr = self.fr_addr,
+                    reply_to = self.reply_to,
+                    ip = self.ip,
+                    fullname = self.thing._fullname if self.thing else "",
+                    date = self.date,
+                    kind = self.kind,
+                    msg_hash = self.msg_hash)
+
     def set_sent(self, date = None, rejected = False):
         if not self.sent:
             self.date = date or datetime.datetime.now(g.tz)
             t = self.handler.reject_table if rejected else self.handler.track_table
             try:
-                t.insert().values({t.c.account_id:
-                                       self.user._id if self.user else 0,
-                                   t.c.to_addr :   self.to_addr,
-                                   t.c.fr_addr :   self.fr_addr,
-                                   t.c.reply_to :  self.reply_to,
-                                   t.c.ip :        self.ip,
-                                   t.c.fullname:
-                                       self.thing._fullname if self.thing else "",
-                                   t.c.date:       self.date,
-                                   t.c.kind :      self.kind,
-                                   t.c.msg_hash :  self.msg_hash,
-                                   }).execute()
+                t.insert().execute(self._sent_row())
             except:
                 print "failed to send message"
 
             self.sent = True
 
+    @classmethod
+    def set_sent_multi(cls, emails, date = None, rejected = False):
+        """set_sent() for a batch of emails, with a single multi-row
+        INSERT ... VALUES statement."""
+        emails = [e for e in emails if not e.sent]
+        if not emails:
+            return
+
+        date = date or datetime.datetime.now(g.tz)
+        for email in emails:
+            email.date = date
+
+        t = cls.handler.reject_table if rejected else cls.handler.track_table
+        columns = sorted(emails[0]._sent_row())
+        params = {}
+        values = []
+        for i, email in enumerate(emails):
+            row = email._sent_row()
+            values.append('(%s)' % ', '.join(':%s_%d' % (col, i)
+                                             for col in columns))
+            for col in columns:
+                params['%s_%d' % (col, i)] = row[col]
+
+        ins = sa.text('INSERT INTO %s (%s) VALUES %s'
+                      % (t.name, ', '.join(columns), ', '.join(values)))
+        try:
+            t.bind.execute(ins, **params)
+        except:
+            print "failed to send %d messages" % len(emails)
+
+        for email in emails:
+            email.sent = True
+
     def to_MIMEText(self):
         def utf8(s):
             return s.encode('utf8') if isinstance(s, unicode) else s
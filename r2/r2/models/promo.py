@@ -194,12 +194,12 @@ class LiveAdWeights(object):
         return res
 
     @classmethod
-    def get(cls, sr_ids):
+    def get(cls, sr_ids, stale=True):
         """Return a dictionary of sr_id -> list of ads for each of sr_ids"""
         # Mangling: Caller convention is to use empty string for FRONT_PAGE
         sr_ids = [(sr_id or cls.FRONT_PAGE) for sr_id in sr_ids]
         adweights = sgm(cls.cache, sr_ids, cls._load_multi,
-                        prefix=cls.cache_prefix, stale=True)
+                        prefix=cls.cache_prefix, stale=stale)
         results = {sr_id: cls.from_columns(adweights[sr_id])
                    for sr_id in adweights}
         if cls.FRONT_PAGE in results:
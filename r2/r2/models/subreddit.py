@@ -507,6 +507,11 @@ class Subreddit(Thing, Printable):
         """Return whether or not to keep a thing in rising for this SR."""
         return sr_id == self._id
 
+    def rising_sr_ids(self):
+        """Return the ids of the SRs whose rising links are kept for this
+        SR, or None if keep_for_rising has to be asked about each one."""
+        return [self._id]
+
     def get_links(self, sort, time):
         from r2.lib.db import queries
         return queries.get_links(self, sort, time)
@@ -913,6 +918,9 @@ class FakeSubreddit(Subreddit):
     def keep_for_rising(self, sr_id):
         return False
 
+    def rising_sr_ids(self):
+        return []
+
     @property
     def _should_wiki(self):
         return False
@@ -1025,6 +1033,9 @@ class AllSR(FakeSubreddit):
     def keep_for_rising(self, sr_id):
         return True
 
+    def rising_sr_ids(self):
+        return None
+
     def get_links(self, sort, time):
         from r2.models import Link
         from r2.lib.db import queries
@@ -1091,6 +1102,9 @@ class _DefaultSR(FakeSubreddit):
     def keep_for_rising(self, sr_id):
         return sr_id in self._get_sr_ids()
 
+    def rising_sr_ids(self):
+        return self._get_sr_ids()
+
     def is_moderator(self, user):
         return False
 
@@ -1207,6 +1221,9 @@ class MultiReddit(_DefaultSR):
     def keep_for_rising(self, sr_id):
         return sr_id in self.kept_sr_ids
 
+    def rising_sr_ids(self):
+        return self.kept_sr_ids
+
     def is_moderator(self, user):
         if not user:
             return False
@@ -1349,6 +1366,8 @@ Subreddit._specials.update(dict(friends = Friends,
 class SRMember(Relation(Subreddit, Account)):
     _defaults = dict(encoded_permissions=None)
     _permission_class = None
+    # listings look up the current user's memberships of many subreddits
+    _fast_index_side = 2
 
     def has_permission(self, perm):
         """Returns whether this member has explicitly been granted a permission.
@@ -0,0 +1,169 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import cPickle as pickle
+import sys
+import unittest
+from datetime import datetime
+
+import pytz
+
+from r2.lib.cache import CodecError, NoneResult, ValueCodec
+
+
+class Point(object):
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def _codec_getstate(self):
+        return dict(x=self.x, y=self.y)
+
+    def _codec_setstate(self, state):
+        self.__dict__.update(state)
+
+
+class PointCodec(ValueCodec):
+    _types = ()
+
+PointCodec.register_type(Point)
+
+
+class ValueCodecTest(unittest.TestCase):
+    values = [
+        None, True, False, NoneResult,
+        0, 1, 255, 256, -1, 2 ** 31 - 1, 2 ** 31, -2 ** 31 - 1, sys.maxint,
+        2 ** 70, 1.5, -0.0,
+        '', 'abc', 'x' * 255, 'x' * 256, '\x00rc\x01', u'', u'caf\xe9',
+        u'\u2603' * 200,
+        [], (), [1, 2, 3], (1, 2, 3), [1, 'a', None], (u'a', (1.5, [2])),
+        range(100), [2 ** 40, -5], [0.5] * 40, ['a'] * 40,
+        [('t3_1', 10, 1.5), ('t3_2', 20, 2.5)], [('a', 1), ('b', 2)],
+        {}, {1: 2, 3: 4}, {None: [1, 2], 1: [3]},
+        {'_ups': 5, '_date': datetime(2013, 6, 1, 12, 30, 15, 20, pytz.utc),
+         '_t': {'title': u'kitten', 'url': 'http://example.com/',
+                'sr_id': 12345, 'over_18': False, 'flair': None}},
+        dict(('key%d' % i, i) for i in xrange(300)),
+        datetime(2013, 6, 1), datetime(2013, 6, 1, tzinfo=pytz.utc),
+        datetime(2013, 6, 1, tzinfo=pytz.timezone('US/Pacific')),
+        set([1, 2]),
+    ]
+
+    def test_round_trip(self):
+        codec = ValueCodec()
+        for val in self.values:
+            decoded = codec.decode(codec.encode(val))
+            self.assertEqual(decoded, val)
+            self.assertEqual(type(decoded), type(val))
+
+    def test_compression(self):
+        for compression in ('zlib', 'snappy'):
+            codec = ValueCodec(compress_threshold=100, compression=compression)
+            if compression == 'snappy':
+                try:
+                    import snappy
+                except ImportError:
+                    continue
+            val = ['kitten %d' % (i % 10) for i in xrange(1000)]
+            encoded = codec.encode(val)
+            self.assertNotEqual(encoded[4], ValueCodec.COMPRESS_NONE)
+            self.assertEqual(codec.decode(encoded), val)
+
+    def test_registered_type(self):
+        codec = PointCodec()
+        val = [Point(1, 'a'), Point(2, None)]
+        decoded = codec.decode(codec.encode(val))
+        self.assertEqual([(p.x, p.y) for p in decoded], [(1, 'a'), (2, None)])
+        self.assertTrue(isinstance(decoded[0], Point))
+
+    def test_smaller_than_pickle(self):
+        codec = ValueCodec()
+        props = {'_ups': 5, '_downs': 0, '_id': 123456, '_deleted': False,
+                 '_spam': False, '_loaded': True, '_created': True,
+                 '_dirties': {},
+                 '_date': datetime(2013, 6, 1, tzinfo=pytz.utc),
+                 '_t': {'title': u'kitten', 'url': 'http://example.com/',
+                        'sr_id': 12345, 'author_id': 54321,
+                        'over_18': False, 'num_comments': 12}}
+        self.assertTrue(len(codec.encode(props)) <
+                        len(pickle.dumps(props, pickle.HIGHEST_PROTOCOL)))
+
+    def test_plain_pickle(self):
+        codec = ValueCodec()
+        val = {'a': [1, 2]}
+        self.assertEqual(codec.decode(pickle.dumps(val)), val)
+
+    def test_unknown(self):
+        codec = ValueCodec()
+        encoded = codec.encode([1, 2])
+        self.assertRaises(CodecError, codec.decode,
+                          encoded[:3] + chr(ValueCodec.VERSION + 1) +
+                          encoded[4:])
+        self.assertRaises(CodecError, codec.decode,
+                          encoded[:4] + '\x09' + encoded[5:])
+        self.assertRaises(CodecError, codec.decode, encoded[:5] + '?')
+
+
+class MemcacheValueTest(unittest.TestCase):
+    """How values are stored in memcache, where appends and incrs go
+    straight to memcached."""
+
+    def setUp(self):
+        self.codec = ValueCodec()
+
+    def stored(self, val):
+        return self.codec.to_memcache(val)
+
+    def test_round_trip(self):
+        for val in ValueCodecTest.values:
+            self.assertEqual(self.codec.from_memcache(self.stored(val)), val)
+
+    def test_raw(self):
+        self.assertEqual(self.stored(5), 5)
+        self.assertEqual(self.stored(2 ** 40), 2 ** 40)
+        self.assertEqual(self.stored('abc'), 'abc')
+        self.assertEqual(self.codec.from_memcache('abc'), 'abc')
+        self.assertEqual(self.codec.from_memcache(5), 5)
+
+    def test_escaped(self):
+        for val in ('', ValueCodec.MAGIC, ValueCodec.MAGIC + 'abc',
+                    '\x00', '\x01', '\x01abc', self.codec.encode([1])):
+            stored = self.stored(val)
+            self.assertEqual(stored, ValueCodec.ESCAPE + val)
+            self.assertEqual(self.codec.from_memcache(stored), val)
+
+    def test_append(self):
+        # the way count and sup build up values, with binary appends
+        record = ValueCodec.MAGIC + chr(ValueCodec.VERSION) + '\x00P'
+        stored = self.stored('')
+        stored += record
+        stored += 'abc'
+        self.assertEqual(self.codec.from_memcache(stored), record + 'abc')
+
+        stored = self.stored('\x01')
+        stored += record
+        self.assertEqual(self.codec.from_memcache(stored), '\x01' + record)
+
+        stored = self.stored('abc')
+        stored += record
+        self.assertEqual(self.codec.from_memcache(stored), 'abc' + record)
@@ -0,0 +1,146 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+
+from pylons import g
+
+from r2.lib import count
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeMemcache(dict):
+    """Enough of pylibmc for count, with its return values and errors."""
+
+    def add(self, key, val, time=0):
+        if key in self:
+            return False
+        self[key] = val
+        return True
+
+    def add_multi(self, vals, time=0):
+        return [key for key, val in vals.iteritems()
+                if not self.add(key, val)]
+
+    def incr(self, key, delta=1):
+        if key not in self:
+            raise NotFound(key)
+        self[key] += delta
+        return self[key]
+
+    def incr_multi(self, keys, delta=1):
+        for key in keys:
+            self.incr(key, delta)
+
+    def append(self, key, val, time=0):
+        if key not in self:
+            return False
+        self[key] += val
+        return True
+
+    def get_multi(self, keys, prefix=''):
+        return dict((key, self[prefix + key])
+                    for key in keys if prefix + key in self)
+
+
+class CountMinSketchTest(unittest.TestCase):
+    def test_estimate(self):
+        sketch = count.CountMinSketch(width=64, depth=4)
+        for i in xrange(200):
+            sketch.add('member%d' % (i % 20), i % 3 + 1)
+        exact = dict(('member%d' % m, 0) for m in xrange(20))
+        for i in xrange(200):
+            exact['member%d' % (i % 20)] += i % 3 + 1
+        for member, n in exact.iteritems():
+            self.assertTrue(sketch.estimate(member) >= n)
+        self.assertEqual(sketch.estimate('never'), 0)
+
+    def test_merge(self):
+        a = count.CountMinSketch(width=16, depth=2)
+        b = count.CountMinSketch(width=16, depth=2)
+        a.add('x', 2)
+        b.add('x', 3)
+        a.merge(b)
+        self.assertEqual(a.estimate('x'), 5)
+        self.assertRaises(ValueError, a.merge, count.CountMinSketch(8, 2))
+
+
+class PendingCountsTest(unittest.TestCase):
+    def setUp(self):
+        self.memcache = g.memcache
+        g.memcache = FakeMemcache()
+
+    def tearDown(self):
+        g.memcache = self.memcache
+
+    def indexes(self):
+        return [val for key, val in g.memcache.iteritems()
+                if '-index-' in key and not key.endswith('-bytes')]
+
+    def test_rollup(self):
+        # two processes counting the same members
+        first = count.PendingCounts('test', '1 hour')
+        second = count.PendingCounts('test', '1 hour')
+        first.incr(['a', 'b', 'a'])
+        second.incr(['a', 'c'])
+        first.flush()
+        second.flush()
+        first.incr(['b'])
+        first.flush()
+
+        self.assertEqual(count.rollup('test', '1 hour'),
+                         {'a': 3, 'b': 2, 'c': 1})
+        members = ''.join(self.indexes()).split(',')
+        self.assertEqual(sorted(m for m in members if m), ['a', 'b', 'c'])
+
+    def test_evicted_counter(self):
+        pending = count.PendingCounts('test', '1 hour')
+        pending.incr(['a'] * 4 + ['b'])
+        pending.flush()
+        bucket = count._bucket(pending.last_flush)
+        del g.memcache[count._prefix('test', bucket) + 'a']
+
+        totals = count.rollup('test', '1 hour')
+        self.assertTrue(totals['a'] >= 4)
+        self.assertEqual(totals['b'], 1)
+
+    def test_index_limit(self):
+        saved = count.MAX_INDEX_BYTES
+        count.MAX_INDEX_BYTES = 20
+        try:
+            pending = count.PendingCounts('test', '1 hour')
+            for i in xrange(200):
+                pending.incr(['member%03d' % i])
+                pending.flush()
+        finally:
+            count.MAX_INDEX_BYTES = saved
+
+        for index in self.indexes():
+            self.assertTrue(len(index) <= 20)
+        totals = count.rollup('test', '1 hour')
+        self.assertTrue(totals)
+        self.assertTrue(len(totals) < 200)
+        self.assertTrue(all(n == 1 for n in totals.itervalues()))
@@ -0,0 +1,149 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+from hashlib import md5
+
+from r2.lib.exception_aggregator import (
+    ExceptionAggregator,
+    fingerprint,
+    legacy_fingerprint,
+)
+
+
+TRACEBACK = [
+    ("/usr/lib/python2.7/dist-packages/r2/controllers/api.py", 100,
+     "POST_vote", "thing = Thing._by_fullname(id)"),
+    ("/usr/lib/python2.7/dist-packages/r2/lib/db/thing.py", 200,
+     "_by_fullname", "raise NotFound(name)"),
+]
+OTHER_TRACEBACK = [
+    ("/usr/lib/python2.7/dist-packages/r2/controllers/api.py", 300,
+     "POST_comment", "item = Thing._by_fullname(id)"),
+]
+
+
+class FingerprintTest(unittest.TestCase):
+    def test_ignores_values(self):
+        moved = [("/home/reddit/reddit/r2/r2/controllers/api.py", 100,
+                  "POST_vote", "something else"),
+                 ("/home/reddit/reddit/r2/r2/lib/db/thing.py", 200,
+                  "_by_fullname", None)]
+        self.assertEqual(fingerprint("NotFound", "t3_a", TRACEBACK),
+                         fingerprint("NotFound", "t3_b", moved))
+
+    def test_code_path(self):
+        fp = fingerprint("NotFound", "t3_a", TRACEBACK)
+        self.assertNotEqual(fp, fingerprint("KeyError", "t3_a", TRACEBACK))
+        self.assertNotEqual(fp, fingerprint("NotFound", "t3_a",
+                                            OTHER_TRACEBACK))
+
+    def test_known(self):
+        self.assertEqual(fingerprint("OperationalError",
+                                     "QueuePool limit of size 5", TRACEBACK),
+                         "QueuePool_overflow")
+        self.assertEqual(legacy_fingerprint("OperationalError",
+                                            "QueuePool limit of size 5",
+                                            TRACEBACK),
+                         "QueuePool_overflow")
+
+    def test_legacy(self):
+        key_material = "NotFound"
+        for filename, lineno, funcname, text in TRACEBACK:
+            key_material += "%s %s " % (filename, funcname)
+        self.assertEqual(legacy_fingerprint("NotFound", "t3_a", TRACEBACK),
+                         md5(key_material).hexdigest())
+
+
+class ExceptionAggregatorTest(unittest.TestCase):
+    now = 1371000000.
+
+    def setUp(self):
+        self.aggregator = ExceptionAggregator(":memory:",
+                                              digest_interval=3600)
+        self.aggregator._set_state("last_digest", self.now - 3600)
+
+    def tearDown(self):
+        self.aggregator.close()
+
+    def record(self, ago, traceback=TRACEBACK, nickname=None):
+        return self.aggregator.record("NotFound", "t3_a", traceback,
+                                      when=self.now - ago,
+                                      occurrence="<app-01:8001>",
+                                      nickname=nickname)
+
+    def test_record(self):
+        fp, is_new = self.record(120, nickname='"Foo" Exception')
+        self.assertTrue(is_new)
+        self.assertEqual(self.record(60, nickname="ignored"), (fp, False))
+
+        info = self.aggregator.get(fp)
+        self.assertEqual(info["nickname"], '"Foo" Exception')
+        self.assertEqual(info["exc_type"], "NotFound")
+        self.assertEqual(info["total"], 2)
+        self.assertEqual(info["first_seen"], self.now - 120)
+        self.assertEqual(info["last_seen"], self.now - 60)
+        self.assertEqual(info["sample"]["exception"], "NotFound: t3_a")
+        self.assertEqual(info["sample"]["occurrence"], "<app-01:8001>")
+
+        self.assertEqual(self.aggregator.get("missing"), None)
+
+    def test_window_counts(self):
+        fp, is_new = self.record(30)
+        self.record(40)
+        self.record(20 * 60)
+        self.record(5 * 3600)
+        other, is_new = self.record(2 * 86400, traceback=OTHER_TRACEBACK)
+
+        counts = self.aggregator.window_counts(self.now)
+        self.assertEqual(counts, {
+            fp: {"5 minutes": 2, "hour": 3, "day": 4},
+        })
+
+        self.aggregator.prune(self.now)
+        self.assertEqual(self.aggregator.count_since(0), {fp: 4})
+
+    def test_digest(self):
+        self.assertFalse(self.aggregator.digest_due(self.now - 1))
+        self.assertTrue(self.aggregator.digest_due(self.now))
+        self.assertEqual(self.aggregator.digest(self.now), None)
+
+        fp, is_new = self.record(-30, nickname='"Foo" Exception')
+        self.record(-20)
+        other, is_new = self.record(-10, traceback=OTHER_TRACEBACK)
+        later = self.now + 3600
+        self.assertTrue(self.aggregator.digest_due(later))
+
+        digest = self.aggregator.digest(later, limit=1)
+        lines = digest.splitlines()
+        self.assertTrue(lines[0].startswith(
+            "2 kinds of exception happened 3 times since"))
+        self.assertEqual(lines[2], '"Foo" Exception (%s): 2 since the last '
+                                   'digest, 2 ever' % fp)
+        self.assertTrue("NotFound: t3_a" in digest)
+        self.assertFalse(other in digest)
+        self.assertEqual(lines[-1], "...and 1 more.")
+
+        # the next digest starts from this one
+        self.assertFalse(self.aggregator.digest_due(later))
+        self.assertEqual(self.aggregator.digest(later + 3600), None)
@@ -0,0 +1,168 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import datetime
+import json
+
+import pytz
+from pylons import c
+
+from r2.lib.jsontemplates import (
+    AccountJsonTemplate,
+    CommentJsonTemplate,
+    ExtractedData,
+    LinkJsonTemplate,
+    PromotedLinkJsonTemplate,
+    SubredditJsonTemplate,
+    extract_thing,
+)
+from r2.tests import RedditTestCase
+
+
+class FakeThing(object):
+    _type_id = 3
+
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class FakeSubreddit(FakeThing):
+    _type_id = 5
+
+    def is_moderator(self, user):
+        return self.moderator
+
+
+class FakeAuthor(FakeThing):
+    def flair_enabled_in_sr(self, sr_id):
+        return self.flair_enabled
+
+
+def fake_link(**attrs):
+    sr = FakeSubreddit(_id=1, name="pics", _fullname="t5_1", moderator=False)
+    author = FakeAuthor(name="spez", _deleted=False, flair_enabled=True,
+                        flair_1_text="flair", flair_1_css_class="css")
+    link = dict(
+        _id36="abc", _fullname="t3_abc",
+        _date=datetime.datetime(2013, 4, 5, 6, 7, 8, 9, tzinfo=pytz.UTC),
+        upvotes=10, downvotes=2, score=8, saved=False, clicked=False,
+        hidden=False, over_18=False, likes=None, domain="self.pics",
+        title=u"a title \u2603", url="/r/pics/comments/abc/a_title/",
+        author=author, flair_text=None, flair_css_class=None,
+        thumbnail="", media_object=None, selftext="*hello*",
+        expunged=False, num_comments=3, reported=1, _spam=False,
+        ban_info={}, subreddit=sr, is_self=True,
+        permalink="/r/pics/comments/abc/a_title/", editted=False,
+        promoted=None,
+    )
+    link.update(attrs)
+    return FakeThing(**link)
+
+
+def fake_subreddit(**attrs):
+    sr = dict(
+        _id=1, _id36="1", _fullname="t5_1", name="pics", title="Pics",
+        path="/r/pics/", over_18=False, description="**pics**",
+        public_description="pictures", header=None, header_size=None,
+        header_title="", accounts_active=12, _ups=1000,
+        hide_subscribers=False, moderator=False,
+        _date=datetime.datetime(2008, 1, 25, 1, 2, 3, tzinfo=pytz.UTC),
+    )
+    sr.update(attrs)
+    return FakeSubreddit(**sr)
+
+
+class TestCompiledExtractor(RedditTestCase):
+    def setUp(self):
+        c.render_style = "api"
+        c.user_is_loggedin = False
+        c.user = FakeThing(name="someone")
+        c.site = None
+
+    def assertSameJson(self, template, thing, moderator=False):
+        rendered = template.render(thing).finalize()
+        extract = template.extractor(moderator)
+        self.assertTrue(extract)
+        extracted = dict(kind=template.kind(thing),
+                         data=extract(template, thing))
+        self.assertEquals(json.dumps(rendered, sort_keys=True),
+                          json.dumps(extracted, sort_keys=True))
+
+    def test_link(self):
+        self.assertSameJson(LinkJsonTemplate(), fake_link())
+
+    def test_link_variants(self):
+        edited = datetime.datetime(2013, 4, 6, tzinfo=pytz.UTC)
+        deleted = FakeAuthor(name="gone", _deleted=True, flair_enabled=True)
+        no_flair = FakeAuthor(name="kn0thing", _deleted=False,
+                              flair_enabled=False)
+        variants = [
+            dict(editted=edited),
+            dict(author=deleted),
+            dict(author=no_flair),
+            dict(distinguished="admin"),
+            dict(distinguished="no"),
+            dict(expunged=True),
+            dict(is_self=False, selftext="", domain="example.com",
+                 url="http://example.com/"),
+            dict(title="plain str title", likes=True),
+        ]
+        for attrs in variants:
+            self.assertSameJson(LinkJsonTemplate(), fake_link(**attrs))
+
+    def test_promoted_link(self):
+        link = fake_link(promoted=True)
+        self.assertSameJson(PromotedLinkJsonTemplate(), link)
+
+    def test_moderator(self):
+        c.user_is_loggedin = True
+        for spam in (False, True):
+            for ban_info in ({}, dict(banner="mod", unbanner="othermod",
+                                      moderator_banned=True)):
+                link = fake_link(_spam=spam, ban_info=ban_info)
+                self.assertSameJson(LinkJsonTemplate(), link)
+                link.subreddit.moderator = True
+                self.assertSameJson(LinkJsonTemplate(), link, moderator=True)
+
+    def test_subreddit(self):
+        self.assertSameJson(SubredditJsonTemplate(), fake_subreddit())
+        self.assertSameJson(SubredditJsonTemplate(),
+                            fake_subreddit(hide_subscribers=True))
+
+    def test_not_compiled(self):
+        self.assertEquals(CommentJsonTemplate.extractor(), None)
+        self.assertEquals(AccountJsonTemplate.extractor(), None)
+        c.render_style = "api-html"
+        self.assertEquals(LinkJsonTemplate.extractor(), None)
+
+    def test_extract_thing(self):
+        from r2.models import Link
+        link = fake_link(render_class=Link)
+        extracted = extract_thing(link, {})
+        self.assertTrue(isinstance(extracted, ExtractedData))
+        self.assertEquals(extracted["data"]["title"], link.title)
+
+    def test_template_variables_are_rendered(self):
+        from r2.models import Link
+        link = fake_link(render_class=Link, title="<$>timesince</$> ago")
+        self.assertEquals(extract_thing(link, {}), None)
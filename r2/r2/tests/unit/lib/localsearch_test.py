@@ -0,0 +1,270 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import l2cs
+
+from r2.lib import localsearch
+from r2.lib.cloudsearch import InvalidQuery, LinkSearchQuery
+from r2.lib.localsearch import LocalIndex, Schema, parse_bq
+
+
+class TestFields(object):
+    @classmethod
+    def cloudsearch_fieldnames(cls, type_=None):
+        return ["title", "body", "reddit", "ups", "timestamp"]
+
+
+TEST_SCHEMA = Schema(
+    "test",
+    fields=TestFields,
+    numeric_fields=("ups", "timestamp"),
+    default_fields=("title", "body"),
+    facet_fields=("reddit",),
+    ranks={"top": lambda n: n["ups"] * 2},
+)
+
+
+def doc(fullname, title, body=u"", reddit=u"pics", ups=0, timestamp=0,
+        version=1):
+    return (fullname, version, dict(title=title, body=body, reddit=reddit,
+                                    ups=unicode(ups),
+                                    timestamp=unicode(timestamp)))
+
+
+class ParseBqTest(unittest.TestCase):
+    def test_terms(self):
+        self.assertEqual(parse_bq(u"kitten"), ("text", None, u"kitten"))
+        self.assertEqual(parse_bq(u"'kitten mittens'"),
+                         ("text", None, u"kitten mittens"))
+        self.assertEqual(parse_bq(u"title:kitten"),
+                         ("text", u"title", u"kitten"))
+        self.assertEqual(parse_bq(u"title:'it\\'s a \\\\ kitten'"),
+                         ("text", u"title", u"it's a \\ kitten"))
+        self.assertEqual(parse_bq(u"(field title 'kitten mittens')"),
+                         ("text", u"title", u"kitten mittens"))
+
+    def test_ranges(self):
+        self.assertEqual(parse_bq(u"ups:10..20"), ("range", u"ups", 10, 20))
+        self.assertEqual(parse_bq(u"ups:10.."), ("range", u"ups", 10, None))
+        self.assertEqual(parse_bq(u"(field timestamp ..5)"),
+                         ("range", u"timestamp", None, 5))
+        self.assertRaises(InvalidQuery, parse_bq, u"ups:a..b")
+
+    def test_operators(self):
+        self.assertEqual(
+            parse_bq(u"(and kitten (or title:cat reddit:'aww') "
+                     u"(not ups:..0))"),
+            ("and", [("text", None, u"kitten"),
+                     ("or", [("text", u"title", u"cat"),
+                             ("text", u"reddit", u"aww")]),
+                     ("not", ("range", u"ups", None, 0))]))
+        self.assertEqual(parse_bq(u" (or) "), ("or", []))
+
+    def test_invalid(self):
+        for bq in (u"(and kitten", u"(xor kitten)", u")", u"kitten cat",
+                   u"(not a b)", u"(field title)", u"'unterminated", u"("):
+            self.assertRaises(InvalidQuery, parse_bq, bq)
+
+
+class LocalIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = LocalIndex(self.path, TEST_SCHEMA)
+
+    def tearDown(self):
+        for seg in self.index.segments:
+            seg.close()
+        shutil.rmtree(self.path)
+
+    def search(self, bq, rank="-relevance", **kw):
+        return self.index.search(bq=bq, rank=rank, **kw).docs
+
+    def test_bm25(self):
+        self.index.update([doc(u"t3_1", u"kitten"),
+                           doc(u"t3_2", u"kitten kitten puppy puppy"),
+                           doc(u"t3_3", u"puppy")], {})
+        # 3 documents, 6 default-field words
+        avg_length = 6 / 3.
+        idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+
+        def bm25(tf, length):
+            norm = 1 - localsearch.B + localsearch.B * length / avg_length
+            return (idf * tf * (localsearch.K1 + 1) /
+                    (tf + localsearch.K1 * norm))
+
+        searcher = localsearch._Searcher(self.index)
+        seg = self.index.segments[0]
+        scores = searcher.evaluate(("text", None, u"kitten"), seg)
+        self.assertEqual(sorted(scores), [0, 1])
+        self.assertAlmostEqual(scores[0], bm25(1, 1))
+        self.assertAlmostEqual(scores[1], bm25(2, 4))
+
+    def test_relevance_order(self):
+        self.index.update([doc(u"t3_1", u"kitten", u"a b c d e f"),
+                           doc(u"t3_2", u"kitten kitten"),
+                           doc(u"t3_3", u"puppy"),
+                           doc(u"t3_4", u"kitten")], {})
+        self.assertEqual(self.search(u"kitten"),
+                         [u"t3_2", u"t3_4", u"t3_1"])
+        self.assertEqual(self.search(u"kitten", rank="relevance"),
+                         [u"t3_1", u"t3_4", u"t3_2"])
+        self.assertEqual(self.search(u"'kitten kitten'"),
+                         [u"t3_2", u"t3_4", u"t3_1"])
+        self.assertEqual(self.search(u"title:kitten", start=1, size=1),
+                         [u"t3_4"])
+
+    def test_sorts_and_ranges(self):
+        self.index.update([doc(u"t3_1", u"kitten", ups=5, timestamp=30),
+                           doc(u"t3_2", u"kitten", ups=10, timestamp=20),
+                           doc(u"t3_3", u"kitten", ups=1, timestamp=10),
+                           doc(u"t3_4", u"puppy", ups=50, timestamp=40)], {})
+        self.assertEqual(self.search(u"kitten", rank="-ups"),
+                         [u"t3_2", u"t3_1", u"t3_3"])
+        self.assertEqual(self.search(u"kitten", rank="timestamp"),
+                         [u"t3_3", u"t3_2", u"t3_1"])
+        self.assertEqual(self.search(u"kitten", rank="-top"),
+                         [u"t3_2", u"t3_1", u"t3_3"])
+        self.assertEqual(self.search(u"(and kitten ups:5..)", rank="-ups"),
+                         [u"t3_2", u"t3_1"])
+        self.assertEqual(self.search(u"timestamp:..20", rank="timestamp"),
+                         [u"t3_3", u"t3_2"])
+        self.assertEqual(self.search(u"ups:50"), [u"t3_4"])
+        self.assertEqual(self.search(u"(not kitten)"), [u"t3_4"])
+        self.assertEqual(self.search(u"(or puppy ups:10)", rank="-ups"),
+                         [u"t3_4", u"t3_2"])
+        self.assertEqual(self.search(u"kitt*", rank="-ups"),
+                         [u"t3_2", u"t3_1", u"t3_3"])
+
+        self.assertRaises(InvalidQuery, self.search, u"kitten", rank="-foo")
+        self.assertRaises(InvalidQuery, self.search, u"foo:kitten")
+        self.assertRaises(InvalidQuery, self.search, u"title:1..2")
+
+    def test_facets(self):
+        self.index.update([doc(u"t3_1", u"kitten", reddit=u"aww"),
+                           doc(u"t3_2", u"kitten", reddit=u"pics"),
+                           doc(u"t3_3", u"kitten", reddit=u"aww"),
+                           doc(u"t3_4", u"puppy", reddit=u"dogs")], {})
+        results = self.index.search(bq=u"kitten",
+                                    faceting={"reddit": {"count": 5}})
+        self.assertEqual(results.hits, 3)
+        self.assertEqual(results._facets["reddit"],
+                         [{"value": u"aww", "count": 2},
+                          {"value": u"pics", "count": 1}])
+
+    def test_versions_and_deletes(self):
+        self.index.update([doc(u"t3_1", u"kitten", version=2),
+                           doc(u"t3_2", u"kitten")], {})
+        # an older version doesn't replace a newer one
+        self.index.update([doc(u"t3_1", u"puppy", version=1)], {})
+        self.assertEqual(self.search(u"puppy"), [])
+        self.index.update([doc(u"t3_1", u"puppy", version=3)], {})
+        self.assertEqual(self.search(u"puppy"), [u"t3_1"])
+        self.assertEqual(self.search(u"kitten"), [u"t3_2"])
+
+        self.index.update([], {u"t3_2": 1})
+        self.assertEqual(self.search(u"kitten"), [])
+        self.index.update([doc(u"t3_2", u"kitten", version=2)], {})
+        self.assertEqual(self.search(u"kitten"), [u"t3_2"])
+
+        # another reader of the same directory sees all of it
+        other = LocalIndex(self.path, TEST_SCHEMA)
+        self.assertEqual(other.search(bq=u"kitten").docs, [u"t3_2"])
+        self.assertEqual(other.search(bq=u"puppy").docs, [u"t3_1"])
+        for seg in other.segments:
+            seg.close()
+
+    def test_merge(self):
+        for i in xrange(localsearch.MERGE_FACTOR - 1):
+            self.index.update([doc(u"t3_%d" % i, u"kitten", ups=i)], {})
+        self.assertEqual(len(self.index.segments),
+                         localsearch.MERGE_FACTOR - 1)
+        self.index.update([doc(u"t3_0", u"puppy", ups=100, version=2)],
+                          {u"t3_1": 5})
+
+        # the run of small segments was merged into one
+        self.assertEqual(len(self.index.segments), 1)
+        self.assertEqual(self.index.segments[0].doc_count,
+                         localsearch.MERGE_FACTOR - 2)
+        self.assertEqual(self.search(u"kitten", rank="ups"),
+                         [u"t3_%d" % i
+                          for i in xrange(2, localsearch.MERGE_FACTOR - 1)])
+        self.assertEqual(self.search(u"puppy"), [u"t3_0"])
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         sorted([localsearch.LOCK, localsearch.MANIFEST,
+                                 self.index.segments[0].name]))
+
+    def test_merge_keeps_deletes(self):
+        self.index.update([doc(u"t3_%d" % i, u"kitten")
+                           for i in xrange(localsearch.MERGE_FACTOR * 2)],
+                          {})
+        # merging the small segments that follow mustn't forget that they
+        # delete a document in the big one
+        self.index.update([], {u"t3_0": 1})
+        for i in xrange(localsearch.MERGE_FACTOR - 1):
+            self.index.update([doc(u"t3_new%d" % i, u"puppy")], {})
+        self.assertEqual(len(self.index.segments), 2)
+        hits = self.index.search(bq=u"kitten").docs
+        self.assertFalse(u"t3_0" in hits)
+        self.assertEqual(len(hits), localsearch.MERGE_FACTOR * 2 - 1)
+
+        self.index.optimize()
+        self.assertEqual(len(self.index.segments), 1)
+        self.assertEqual(self.index.segments[0].deletes, {})
+        self.assertEqual(len(self.search(u"kitten")),
+                         localsearch.MERGE_FACTOR * 2 - 1)
+        self.assertEqual(len(self.search(u"puppy")),
+                         localsearch.MERGE_FACTOR - 1)
+
+
+class LuceneTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.index = LocalIndex(self.path, localsearch.LINK_SCHEMA)
+        self.index.update([
+            (u"t3_1", 1, dict(title=u"kitten", ups=u"5")),
+            (u"t3_2", 1, dict(title=u"kitten dog", ups=u"3")),
+            (u"t3_3", 1, dict(title=u"dog", selftext=u"kitten", ups=u"1")),
+        ], {})
+
+    def tearDown(self):
+        for seg in self.index.segments:
+            seg.close()
+        shutil.rmtree(self.path)
+
+    def search(self, query):
+        bq = l2cs.convert(query, LinkSearchQuery.lucene_parser)
+        return self.index.search(bq=bq, rank="-ups").docs
+
+    def test_lucene(self):
+        self.assertEqual(self.search(u"kitten"), [u"t3_1", u"t3_2", u"t3_3"])
+        self.assertEqual(self.search(u"title:kitten"), [u"t3_1", u"t3_2"])
+        self.assertEqual(self.search(u"kitten AND NOT title:dog"),
+                         [u"t3_1"])
+        self.assertEqual(self.search(u"selftext:kitten OR title:dog"),
+                         [u"t3_2", u"t3_3"])
@@ -0,0 +1,160 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import random
+import unittest
+from datetime import date, timedelta
+
+from r2.lib.promo_schedule import (
+    CampaignInterval,
+    CampaignSchedule,
+    IntervalTree,
+)
+
+
+class IntervalTreeTest(unittest.TestCase):
+    def brute_overlapping(self, entries, start, end):
+        return sorted(item for s, e, item in entries if s < end and start < e)
+
+    def test_empty(self):
+        tree = IntervalTree()
+        self.assertEqual(len(tree), 0)
+        self.assertEqual(tree.overlapping(0, 100), [])
+        self.assertEqual(tree.at(5), [])
+
+    def test_empty_interval(self):
+        tree = IntervalTree()
+        self.assertRaises(ValueError, tree.insert, 3, 3, 'x')
+        self.assertRaises(ValueError, tree.insert, 4, 3, 'x')
+
+    def test_remove_missing(self):
+        tree = IntervalTree([(0, 10, 'a')])
+        self.assertRaises(ValueError, tree.remove, 0, 10, 'b')
+        self.assertRaises(ValueError, tree.remove, 20, 30, 'a')
+
+    def test_half_open(self):
+        tree = IntervalTree([(0, 10, 'a'), (10, 20, 'b')])
+        self.assertEqual(tree.at(9), ['a'])
+        self.assertEqual(tree.at(10), ['b'])
+        self.assertEqual(tree.at(20), [])
+        self.assertEqual(sorted(tree.overlapping(9, 11)), ['a', 'b'])
+        self.assertEqual(tree.overlapping(20, 30), [])
+
+    def test_built(self):
+        rng = random.Random(48)
+        entries = []
+        for i in xrange(500):
+            start = rng.randrange(1000)
+            entries.append((start, start + rng.randrange(1, 100), i))
+        tree = IntervalTree(entries)
+
+        self.assertEqual(len(tree), len(entries))
+        self.assertEqual(sorted(tree), sorted(entries))
+        for i in xrange(200):
+            start = rng.randrange(-10, 1110)
+            end = start + rng.randrange(1, 50)
+            self.assertEqual(sorted(tree.overlapping(start, end)),
+                             self.brute_overlapping(entries, start, end))
+
+    def test_changes(self):
+        # enough inserts and removes to go through several rebuilds
+        rng = random.Random(480)
+        tree = IntervalTree()
+        entries = []
+        for i in xrange(3000):
+            if entries and rng.random() < 0.4:
+                entry = entries.pop(rng.randrange(len(entries)))
+                tree.remove(*entry)
+            else:
+                start = rng.randrange(500)
+                entry = (start, start + rng.randrange(1, 60), i)
+                tree.insert(*entry)
+                entries.append(entry)
+
+            if i % 50 == 0:
+                self.assertEqual(len(tree), len(entries))
+                point = rng.randrange(-5, 565)
+                self.assertEqual(sorted(tree.at(point)),
+                                 self.brute_overlapping(entries, point,
+                                                        point + 1))
+
+        self.assertEqual(sorted(tree), sorted(entries))
+        for start in xrange(-5, 565, 7):
+            self.assertEqual(sorted(tree.overlapping(start, start + 9)),
+                             self.brute_overlapping(entries, start,
+                                                    start + 9))
+
+
+class CampaignScheduleTest(unittest.TestCase):
+    day = date(2013, 6, 1)
+
+    def interval(self, campaign_id, link, sr_name, start, days, weight):
+        start = self.day + timedelta(start)
+        return CampaignInterval(campaign_id, link, sr_name, start,
+                                start + timedelta(days), weight)
+
+    def setUp(self):
+        self.a = self.interval(1, 't3_a', 'pics', 0, 5, 100.)
+        self.b = self.interval(2, 't3_b', 'Pics', 3, 5, 50.)
+        self.c = self.interval(3, 't3_a', '', 2, 2, 10.)
+        self.schedule = CampaignSchedule([self.a, self.b, self.c])
+
+    def test_live(self):
+        live = self.schedule.live(self.day + timedelta(3), 'PICS')
+        self.assertEqual(sorted(live), [self.a, self.b])
+        self.assertEqual(self.schedule.live(self.day + timedelta(3), ''),
+                         [self.c])
+        self.assertEqual(len(self.schedule.live(self.day + timedelta(3))), 3)
+        self.assertEqual(self.schedule.live(self.day + timedelta(8)), [])
+
+    def test_live_by_link(self):
+        self.assertEqual(sorted(self.schedule.live_by_link('t3_a', self.day)),
+                         [1])
+        self.assertEqual(sorted(self.schedule.live_by_link(
+            't3_a', self.day + timedelta(2))), [1, 3])
+        self.assertEqual(self.schedule.live_by_link('t3_c', self.day), [])
+
+    def test_sold(self):
+        sold = self.schedule.sold('pics', self.day - timedelta(1),
+                                  self.day + timedelta(9))
+        self.assertEqual(sold.values(),
+                         [0., 100., 100., 100., 150., 150., 50., 50., 50.,
+                          0.])
+        self.assertEqual(sold.keys()[0], self.day - timedelta(1))
+
+    def test_with_changes(self):
+        moved = self.interval(1, 't3_a', 'funny', 0, 5, 100.)
+        changed = self.schedule.with_changes([1, 3], [moved])
+
+        self.assertEqual(changed.live(self.day, 'funny'), [moved])
+        self.assertEqual(changed.live(self.day, 'pics'), [])
+        self.assertEqual(changed.live_by_link('t3_a', self.day), [1])
+        self.assertEqual(changed.live(self.day + timedelta(2), ''), [])
+
+        # the original is untouched for anyone still reading it
+        self.assertEqual(self.schedule.live(self.day, 'pics'), [self.a])
+        self.assertEqual(self.schedule.live(self.day, 'funny'), [])
+        self.assertEqual(
+            sorted(self.schedule.live_by_link('t3_a',
+                                              self.day + timedelta(2))),
+            [1, 3])
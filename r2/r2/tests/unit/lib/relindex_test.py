@@ -0,0 +1,179 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import contextlib
+import unittest
+
+from r2.lib.db import relindex
+
+
+class FakeCache(dict):
+    def __init__(self):
+        self.times = {}
+
+    def get(self, key, default=None, allow_local=True):
+        return dict.get(self, key, default)
+
+    def set(self, key, val, time=0):
+        self[key] = val
+        self.times[key] = time
+
+    def get_multi(self, keys, prefix=''):
+        return dict((key, self[prefix + key])
+                    for key in keys if prefix + key in self)
+
+    def set_multi(self, vals, prefix='', time=0):
+        for key, val in vals.iteritems():
+            self.set(prefix + key, val, time=time)
+
+
+class FakeGlobals(object):
+    @contextlib.contextmanager
+    def make_lock(self, group, name):
+        yield
+
+
+class FakeTdb(object):
+    """The rels in the db, as (thing1_id, thing2_id, name) triples."""
+
+    def __init__(self):
+        self.rels = set()
+        self.loads = 0
+
+    def get_rel_partners(self, rel_type_id, side, thing_id, name, limit):
+        self.loads += 1
+        if side == 1:
+            ids = [t2 for t1, t2, n in self.rels
+                   if t1 == thing_id and n == name]
+        else:
+            ids = [t1 for t1, t2, n in self.rels
+                   if t2 == thing_id and n == name]
+        return ids[:limit]
+
+
+class FastQueryIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = relindex.cache, relindex.g, relindex.tdb
+        relindex.cache = self.cache = FakeCache()
+        relindex.g = FakeGlobals()
+        relindex.tdb = self.tdb = FakeTdb()
+        self.index = relindex.FastQueryIndex('rel_index_', 1, 1)
+
+    def tearDown(self):
+        relindex.cache, relindex.g, relindex.tdb = self.saved
+
+    def assertMatchesDb(self, triples):
+        """The index may only rule out triples that aren't rels, the way
+        the per-triple keys of _fast_query would find them."""
+        missing, candidates = self.index.lookup(triples)
+        self.assertEqual(sorted(missing + candidates), sorted(triples))
+        for triple in missing:
+            self.assertFalse(triple in self.tdb.rels)
+        for triple in triples:
+            if triple in self.tdb.rels:
+                self.assertTrue(triple in candidates)
+        return missing, candidates
+
+    def test_pack(self):
+        ids = [5, 1, 3]
+        self.assertEqual(list(relindex.unpack(relindex.pack(ids))),
+                         [1, 3, 5])
+        self.assertNotEqual(len(relindex.OVERFLOW) %
+                            relindex.unpack('').itemsize, 0)
+
+    def test_lookup(self):
+        self.tdb.rels.update([(1, 10, 'save'), (1, 12, 'save'),
+                              (1, 11, 'hide'), (2, 10, 'save')])
+        triples = [(t1, t2, name)
+                   for t1 in (1, 2, 3)
+                   for t2 in (10, 11, 12)
+                   for name in ('save', 'hide')]
+
+        missing, candidates = self.assertMatchesDb(triples)
+        self.assertEqual(sorted(candidates), sorted(self.tdb.rels))
+        self.assertEqual(self.tdb.loads, 6)
+        self.assertEqual(set(self.cache.times.values()),
+                         set([relindex.INDEX_TTL]))
+
+        # the second lookup is answered from the cache
+        self.assertMatchesDb(triples)
+        self.assertEqual(self.tdb.loads, 6)
+
+    def test_update(self):
+        self.tdb.rels.update([(1, 10, 'save'), (1, 11, 'save')])
+        triples = [(1, t2, 'save') for t2 in xrange(10, 15)]
+        self.assertMatchesDb(triples)
+
+        self.tdb.rels.add((1, 14, 'save'))
+        self.tdb.rels.discard((1, 10, 'save'))
+        self.index.update(added=[(1, 14, 'save')],
+                          removed=[(1, 10, 'save')])
+
+        missing, candidates = self.assertMatchesDb(triples)
+        self.assertEqual(sorted(candidates), [(1, 11, 'save'),
+                                              (1, 14, 'save')])
+        self.assertEqual(self.tdb.loads, 1)
+
+    def test_update_uncached(self):
+        # an index that isn't cached is left to be built from the db
+        self.index.update(added=[(1, 10, 'save')])
+        self.assertEqual(len(self.cache), 0)
+
+        self.tdb.rels.add((1, 10, 'save'))
+        missing, candidates = self.assertMatchesDb([(1, 10, 'save'),
+                                                    (1, 11, 'save')])
+        self.assertEqual(candidates, [(1, 10, 'save')])
+
+    def test_overflow(self):
+        self.tdb.rels.update((1, t2, 'save')
+                             for t2 in xrange(relindex.INDEX_LIMIT + 1))
+        triples = [(1, -1, 'save'), (1, 0, 'save')]
+        missing, candidates = self.assertMatchesDb(triples)
+        self.assertEqual(missing, [])
+
+        self.index.update(removed=[(1, 0, 'save')])
+        self.assertEqual(self.cache['rel_index_' + str((1, 'save'))],
+                         relindex.OVERFLOW)
+
+    def test_overflow_on_update(self):
+        self.tdb.rels.update((1, t2, 'save')
+                             for t2 in xrange(relindex.INDEX_LIMIT))
+        self.assertMatchesDb([(1, -1, 'save')])
+
+        self.tdb.rels.add((1, -1, 'save'))
+        self.index.update(added=[(1, -1, 'save')])
+        self.assertEqual(self.cache['rel_index_' + str((1, 'save'))],
+                         relindex.OVERFLOW)
+        self.assertMatchesDb([(1, -1, 'save'), (1, -2, 'save')])
+
+    def test_side_2(self):
+        self.index = relindex.FastQueryIndex('rel_index2_', 1, 2)
+        self.tdb.rels.update([(1, 10, 'moderator'), (2, 10, 'contributor')])
+        triples = [(t1, 10, name)
+                   for t1 in (1, 2, 3)
+                   for name in ('moderator', 'contributor')]
+        missing, candidates = self.assertMatchesDb(triples)
+        self.assertEqual(sorted(candidates), sorted(self.tdb.rels))
+        self.assertEqual(self.index.keys_needed(triples),
+                         set([(10, 'moderator'), (10, 'contributor')]))
+        self.assertTrue(self.index.worthwhile(triples))
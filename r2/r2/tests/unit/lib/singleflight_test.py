@@ -0,0 +1,109 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import threading
+import time
+import unittest
+
+from r2.lib.singleflight import SingleFlight
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight(timeout=10)
+
+    def wait_in_thread(self, flight, results):
+        thread = threading.Thread(
+            target=lambda: results.append(flight.wait(5)))
+        thread.start()
+        return thread
+
+    def test_leader_and_followers(self):
+        flight, is_leader = self.flights.join("key")
+        self.assertTrue(is_leader)
+        follower_flight, is_leader = self.flights.join("key")
+        self.assertFalse(is_leader)
+        self.assertTrue(follower_flight is flight)
+
+        other, is_leader = self.flights.join("other key")
+        self.assertTrue(is_leader)
+        self.assertFalse(other is flight)
+
+    def test_land(self):
+        flight, is_leader = self.flights.join("key")
+        results = []
+
+        followers = []
+        for i in xrange(3):
+            follower_flight, is_leader = self.flights.join("key")
+            self.assertFalse(is_leader)
+            followers.append(self.wait_in_thread(follower_flight, results))
+
+        self.flights.land("key", flight, "result")
+        for follower in followers:
+            follower.join()
+        self.assertEquals(["result"] * 3, results)
+
+        # the next caller starts a new flight
+        flight, is_leader = self.flights.join("key")
+        self.assertTrue(is_leader)
+
+    def test_leader_raises(self):
+        flight, is_leader = self.flights.join("key")
+        results = []
+
+        follower_flight, is_leader = self.flights.join("key")
+        follower = self.wait_in_thread(follower_flight, results)
+
+        def lead():
+            try:
+                raise ValueError("the render failed")
+            finally:
+                self.flights.land("key", flight)
+
+        start = time.time()
+        self.assertRaises(ValueError, lead)
+        follower.join()
+
+        # the follower is let go straight away, with nothing to serve
+        self.assertEquals([None], results)
+        self.assertTrue(time.time() - start < 5)
+        flight, is_leader = self.flights.join("key")
+        self.assertTrue(is_leader)
+
+    def test_lost_leader(self):
+        flights = SingleFlight(timeout=0)
+        lost, is_leader = flights.join("key")
+        flight, is_leader = flights.join("key")
+        self.assertTrue(is_leader)
+        self.assertFalse(flight is lost)
+
+        # the lost leader landing late mustn't end the new flight
+        flights.land("key", lost, "late")
+        self.assertTrue(flights.flights["key"] is flight)
+        self.assertFalse(flight.done.is_set())
+
+    def test_wait_timeout(self):
+        flight, is_leader = self.flights.join("key")
+        follower_flight, is_leader = self.flights.join("key")
+        self.assertEquals(None, follower_flight.wait(0.01))
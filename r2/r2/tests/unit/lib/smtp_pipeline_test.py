@@ -0,0 +1,150 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import asyncore
+import smtpd
+import threading
+import unittest
+
+from r2.lib.smtp_pipeline import (
+    DEFERRED,
+    Delivery,
+    DeliveryPipeline,
+    FAILED,
+    SENT,
+)
+
+
+class LocalSMTPServer(smtpd.SMTPServer):
+    """An smtpd on a free local port that accepts everything except mail to
+    addresses starting with "reject" (refused for good) and "flaky" (refused
+    for now, the first `flaky_failures` times)."""
+
+    flaky_failures = 1
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.address = "127.0.0.1:%d" % self.socket.getsockname()[1]
+        self.received = []
+        self.attempts = {}
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=.05, count=1)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        asyncore.close_all()
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        rcpt = rcpttos[0]
+        self.attempts[rcpt] = self.attempts.get(rcpt, 0) + 1
+        if rcpt.startswith("reject"):
+            return "550 no such user"
+        if (rcpt.startswith("flaky") and
+            self.attempts[rcpt] <= self.flaky_failures):
+            return "451 try again later"
+        self.received.append((mailfrom, rcpt, data))
+
+
+def make_deliveries(*to_addrs):
+    return [Delivery(i, "sender@example.com", to_addr,
+                     "Subject: test %d\n\nmessage %d" % (i, i))
+            for i, to_addr in enumerate(to_addrs)]
+
+
+class DeliveryPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalSMTPServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def deliver(self, deliveries, **kw):
+        kw.setdefault("retry_delay", .01)
+        pipeline = DeliveryPipeline(self.server.address, timeout=5, **kw)
+        outcomes = dict((delivery.key, outcome) for delivery, outcome
+                        in pipeline.deliver(deliveries))
+        return pipeline, outcomes
+
+    def test_send(self):
+        to_addrs = ["user%d@domain%d.com" % (i, i % 3) for i in xrange(20)]
+        pipeline, outcomes = self.deliver(make_deliveries(*to_addrs))
+
+        self.assertEquals(dict.fromkeys(range(20), SENT), outcomes)
+        self.assertEquals(sorted(to_addrs),
+                          sorted(rcpt for fr, rcpt, data
+                                 in self.server.received))
+        self.assertEquals((20, 0, 0, 0), (pipeline.sent, pipeline.failed,
+                                          pipeline.deferred,
+                                          pipeline.retried))
+
+    def test_lazy_deliveries(self):
+        to_addrs = ["user%d@example.com" % i for i in xrange(10)]
+        deliveries = iter(make_deliveries(*to_addrs))
+        pipeline, outcomes = self.deliver(deliveries, sessions=2)
+        self.assertEquals(dict.fromkeys(range(10), SENT), outcomes)
+
+    def test_permanent_failure(self):
+        pipeline, outcomes = self.deliver(make_deliveries(
+            "user@example.com", "reject@example.com"))
+
+        self.assertEquals({0: SENT, 1: FAILED}, outcomes)
+        self.assertEquals(1, self.server.attempts["reject@example.com"])
+        self.assertEquals((1, 1, 0), (pipeline.sent, pipeline.failed,
+                                      pipeline.retried))
+
+    def test_transient_failure_retried(self):
+        pipeline, outcomes = self.deliver(make_deliveries(
+            "user@example.com", "flaky@example.com"))
+
+        self.assertEquals({0: SENT, 1: SENT}, outcomes)
+        self.assertEquals(2, self.server.attempts["flaky@example.com"])
+        self.assertEquals(1, pipeline.retried)
+
+    def test_transient_failure_deferred(self):
+        self.server.flaky_failures = 10
+        pipeline, outcomes = self.deliver(make_deliveries(
+            "user@example.com", "flaky@example.com"), max_attempts=3)
+
+        self.assertEquals({0: SENT, 1: DEFERRED}, outcomes)
+        self.assertEquals(3, self.server.attempts["flaky@example.com"])
+        self.assertEquals((1, 0, 1, 2), (pipeline.sent, pipeline.failed,
+                                         pipeline.deferred,
+                                         pipeline.retried))
+
+    def test_server_down(self):
+        address = self.server.address
+        self.server.stop()
+        pipeline = DeliveryPipeline(address, max_attempts=2,
+                                    retry_delay=.01, timeout=5)
+        outcomes = dict((delivery.key, outcome) for delivery, outcome
+                        in pipeline.deliver(make_deliveries(
+                            "user@example.com")))
+        self.assertEquals({0: DEFERRED}, outcomes)
+        self.server = LocalSMTPServer()
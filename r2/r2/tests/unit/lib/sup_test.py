@@ -0,0 +1,88 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+
+from r2.lib import sup
+
+
+class NotFound(Exception):
+    pass
+
+
+class FakeMemcache(dict):
+    """Enough of pylibmc's behaviour for sup: incr raises on missing keys."""
+
+    def add(self, key, val, time=0):
+        if key in self:
+            return False
+        self[key] = val
+        return True
+
+    def set(self, key, val, time=0):
+        self[key] = val
+        return True
+
+    def incr(self, key, delta=1):
+        if key not in self:
+            raise NotFound(key)
+        self[key] += delta
+        return self[key]
+
+    def append(self, key, val):
+        if key not in self:
+            return False
+        self[key] += val
+        return True
+
+    def get_multi(self, keys):
+        return dict((key, self[key]) for key in keys if key in self)
+
+
+class SupTest(unittest.TestCase):
+    now = 1371000000 - 1371000000 % sup.MIN_PERIOD
+
+    def setUp(self):
+        self.cache = FakeMemcache()
+
+    def test_first_update_creates_counter(self):
+        sup.store_update(self.cache, 'ab' * 5, self.now + 1)
+        self.assertEqual(self.cache[sup.counter_key(self.now)], 1)
+        self.assertEqual(
+            sup.read_updates(self.cache, self.now, self.now + 60),
+            [('ab' * 5, self.now + 1)])
+
+    def test_latest_update_wins(self):
+        sup.store_update(self.cache, 'ab' * 5, self.now + 1)
+        sup.store_update(self.cache, 'cd' * 5, self.now + 2)
+        sup.store_update(self.cache, 'ab' * 5, self.now + 3)
+        sup.store_update(self.cache, 'ef' * 5, self.now + 70)
+
+        self.assertEqual(self.cache[sup.counter_key(self.now)], 3)
+        self.assertEqual(
+            sup.read_updates(self.cache, self.now, self.now + 60),
+            [('cd' * 5, self.now + 2), ('ab' * 5, self.now + 3)])
+        self.assertEqual(
+            sup.read_updates(self.cache, self.now, self.now + 120),
+            [('cd' * 5, self.now + 2), ('ab' * 5, self.now + 3),
+             ('ef' * 5, self.now + 70)])
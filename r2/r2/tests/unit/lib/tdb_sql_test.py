@@ -0,0 +1,203 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import datetime
+import threading
+import time
+import unittest
+
+import sqlalchemy as sa
+from sqlalchemy.pool import StaticPool
+
+from r2.lib.db import tdb_sql
+
+
+class FakeDbm(object):
+    def __init__(self):
+        self.dead = []
+
+    def mark_dead(self, engine):
+        self.dead.append(engine)
+
+
+def make_tables():
+    # one connection for every thread, so the prefetch thread sees the same
+    # in-memory database
+    engine = sa.create_engine('sqlite://', poolclass=StaticPool,
+                              connect_args={'check_same_thread': False})
+    metadata = sa.MetaData(engine)
+    thing_table = sa.Table('test_thing', metadata,
+                           sa.Column('thing_id', sa.BigInteger,
+                                     primary_key=True),
+                           sa.Column('ups', sa.Integer),
+                           sa.Column('downs', sa.Integer),
+                           sa.Column('deleted', sa.Boolean),
+                           sa.Column('spam', sa.Boolean),
+                           sa.Column('date', sa.DateTime))
+    data_table = sa.Table('test_data', metadata,
+                          sa.Column('thing_id', sa.BigInteger,
+                                    primary_key=True),
+                          sa.Column('key', sa.String, primary_key=True),
+                          sa.Column('value', sa.String),
+                          sa.Column('kind', sa.String))
+    metadata.create_all()
+    return thing_table, data_table
+
+
+DATE = datetime.datetime(2013, 1, 1)
+
+
+class ScanThingsTest(unittest.TestCase):
+    def setUp(self):
+        self.saved = tdb_sql.get_thing_table, tdb_sql.dbm
+        self.tables = make_tables()
+        tdb_sql.get_thing_table = lambda type_id: self.tables
+        tdb_sql.dbm = FakeDbm()
+
+        thing_table, data_table = self.tables
+        self.things = {}
+        for thing_id in xrange(1, 11):
+            # every third thing is deleted and every fourth spam; thing 5
+            # has no data at all
+            deleted = thing_id % 3 == 0
+            spam = thing_id % 4 == 0
+            data = {}
+            if thing_id != 5:
+                data = dict(name='thing %d' % thing_id, score=thing_id * 10)
+            if thing_id % 2:
+                data['odd'] = None
+            thing_table.insert().execute(thing_id=thing_id, ups=thing_id,
+                                         downs=0, deleted=deleted,
+                                         spam=spam, date=DATE)
+            for key, value in data.iteritems():
+                value, kind = tdb_sql.py2db(value, return_kind=True)
+                data_table.insert().execute(thing_id=thing_id, key=key,
+                                            value=value, kind=kind)
+            self.things[thing_id] = (deleted, spam, data)
+
+    def tearDown(self):
+        tdb_sql.get_thing_table, tdb_sql.dbm = self.saved
+
+    def expected(self, ids, keys=None):
+        ret = []
+        for thing_id in ids:
+            deleted, spam, data = self.things[thing_id]
+            if keys is not None:
+                data = dict((k, v) for k, v in data.iteritems() if k in keys)
+            ret.append(tdb_sql.ThingRecord(thing_id, thing_id, 0, DATE,
+                                           deleted, spam, data))
+        return ret
+
+    def scan(self, **kw):
+        return list(tdb_sql.scan_things(1, **kw))
+
+    def flatten(self, batches):
+        return [record for batch in batches for record in batch]
+
+    def test_merge_join(self):
+        for prefetch in (False, True):
+            batches = self.scan(batch_size=3, prefetch=prefetch)
+            self.assertEquals([3, 3, 3, 1], [len(b) for b in batches])
+            self.assertEquals(self.expected(xrange(1, 11)),
+                              self.flatten(batches))
+
+    def test_exact_batches(self):
+        batches = self.scan(batch_size=5)
+        self.assertEquals([5, 5], [len(b) for b in batches])
+        self.assertEquals(self.expected(xrange(1, 11)),
+                          self.flatten(batches))
+
+    def test_keys(self):
+        records = self.flatten(self.scan(keys=['name', 'odd']))
+        self.assertEquals(self.expected(xrange(1, 11), keys=['name', 'odd']),
+                          records)
+
+    def test_no_keys(self):
+        records = self.flatten(self.scan(keys=[]))
+        self.assertEquals(self.expected(xrange(1, 11), keys=[]), records)
+
+    def test_reverse(self):
+        for prefetch in (False, True):
+            batches = self.scan(batch_size=4, reverse=True,
+                                prefetch=prefetch)
+            self.assertEquals([4, 4, 2], [len(b) for b in batches])
+            self.assertEquals(self.expected(xrange(10, 0, -1)),
+                              self.flatten(batches))
+
+    def test_after(self):
+        self.assertEquals(self.expected(xrange(7, 11)),
+                          self.flatten(self.scan(after=6, batch_size=3)))
+        self.assertEquals(self.expected(xrange(5, 0, -1)),
+                          self.flatten(self.scan(after=6, batch_size=3,
+                                                 reverse=True)))
+
+    def test_filters(self):
+        # the data of the things that are filtered out mustn't end up on the
+        # things next to them
+        records = self.flatten(self.scan(deleted=False, spam=False,
+                                         batch_size=2))
+        self.assertEquals(self.expected([1, 2, 5, 7, 10]), records)
+
+        records = self.flatten(self.scan(deleted=True, reverse=True))
+        self.assertEquals(self.expected([9, 6, 3]), records)
+
+    def test_empty(self):
+        self.assertEquals([], self.scan(after=10))
+        self.assertEquals([], self.scan(after=10, prefetch=False))
+
+    def test_prefetch_error(self):
+        scan_window = tdb_sql._scan_window
+        calls = []
+
+        def failing_scan_window(*a):
+            calls.append(a)
+            if len(calls) == 2:
+                raise ValueError("lost the db")
+            return scan_window(*a)
+
+        tdb_sql._scan_window = failing_scan_window
+        try:
+            batches = tdb_sql.scan_things(1, batch_size=3)
+            self.assertEquals(self.expected([1, 2, 3]), next(batches))
+            self.assertRaises(ValueError, next, batches)
+        finally:
+            tdb_sql._scan_window = scan_window
+
+    def test_db_error(self):
+        thing_table, data_table = self.tables
+        data_table.drop()
+        self.assertRaises(sa.exc.DBAPIError, self.scan, prefetch=False)
+        self.assertEquals([data_table.bind], tdb_sql.dbm.dead)
+
+    def test_stop_early(self):
+        batches = tdb_sql.scan_things(1, batch_size=1)
+        self.assertEquals(self.expected([1]), next(batches))
+        # closing the generator stops the reader rather than leaving it
+        # blocked on the queue
+        batches.close()
+        for i in xrange(50):
+            if not any(t.name == 'scan_things' for t in threading.enumerate()):
+                break
+            time.sleep(.1)
+        else:
+            self.fail("the prefetch thread didn't stop")
@@ -0,0 +1,112 @@
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import datetime
+import unittest
+
+from r2.lib.db import thing
+from r2.lib.db.tdb_sql import ThingRecord
+from r2.models import Link
+
+
+DATE = datetime.datetime(2013, 1, 1)
+
+
+class FakeTdb(object):
+    """Serves scan_things from a list of ThingRecords, remembering how it
+    was called."""
+
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def scan_things(self, type_id, keys=None, after=None, batch_size=1000,
+                    reverse=False, deleted=None, spam=None):
+        self.calls.append(dict(type_id=type_id, keys=keys, after=after,
+                               batch_size=batch_size, reverse=reverse,
+                               deleted=deleted, spam=spam))
+        for i in xrange(0, len(self.records), batch_size):
+            yield self.records[i:i + batch_size]
+
+
+class ThingScanTest(unittest.TestCase):
+    def setUp(self):
+        self.records = [ThingRecord(i, i * 2, i, DATE, False, False,
+                                    dict(title='link %d' % i, url='/%d' % i))
+                        for i in xrange(1, 6)]
+        self.saved = thing.tdb
+        thing.tdb = self.tdb = FakeTdb(self.records)
+
+    def tearDown(self):
+        thing.tdb = self.saved
+
+    def test_build(self):
+        links = list(Link._scan(chunk_size=2))
+
+        self.assertEquals(range(1, 6), [l._id for l in links])
+        for link, record in zip(links, self.records):
+            self.assertTrue(isinstance(link, Link))
+            self.assertEquals(record.ups, link._ups)
+            self.assertEquals(record.downs, link._downs)
+            self.assertEquals(record.date, link._date)
+            self.assertEquals(record.data['title'], link.title)
+            self.assertEquals(record.data['url'], link.url)
+            self.assertTrue(link._loaded)
+            self.assertFalse(link._dirty)
+
+        self.assertEquals([dict(type_id=Link._type_id, keys=None, after=None,
+                                batch_size=2, reverse=False, deleted=False,
+                                spam=False)], self.tdb.calls)
+
+    def test_chunks(self):
+        chunks = list(Link._scan(chunk_size=2, chunks=True))
+        self.assertEquals([[1, 2], [3, 4], [5]],
+                          [[l._id for l in chunk] for chunk in chunks])
+
+    def test_keys(self):
+        links = list(Link._scan(keys=['title']))
+        # only some of the data was read, so they mustn't pass for complete
+        self.assertFalse(any(l._loaded for l in links))
+        self.assertEquals(['title'], self.tdb.calls[0]['keys'])
+
+    def test_arguments(self):
+        after = Link._scan().next()
+        list(Link._scan(after=after, reverse=True, deleted=None, spam=True))
+        call = self.tdb.calls[-1]
+        self.assertEquals((after._id, True, None, True),
+                          (call['after'], call['reverse'], call['deleted'],
+                           call['spam']))
+
+        list(Link._scan(after=3))
+        self.assertEquals(3, self.tdb.calls[-1]['after'])
+
+    def test_errors_reach_caller(self):
+        def failing_scan_things(*a, **kw):
+            yield self.records[:2]
+            raise ValueError("lost the db")
+        self.tdb.scan_things = failing_scan_things
+
+        links = Link._scan()
+        self.assertEquals(1, links.next()._id)
+        self.assertEquals(2, links.next()._id)
+        self.assertRaises(ValueError, links.next)
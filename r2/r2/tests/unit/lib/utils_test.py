@@ -22,6 +22,7 @@
 ###############################################################################
 
 import collections
+import random
 import unittest
 
 from r2.lib import utils
@@ -53,6 +54,73 @@ class UtilsTest(unittest.TestCase):
         expect('z', 5)
         self.assertRaises(ValueError, expect, None, 6)
 
+    # chi-squared critical values at p = 0.001, by degrees of freedom
+    CHI_SQUARED_CRITICAL = {3: 16.27, 4: 18.47, 11: 31.26}
+
+    def assertDistribution(self, counts, probabilities, trials):
+        chi_squared = sum((counts[key] - p * trials) ** 2 / (p * trials)
+                          for key, p in probabilities.iteritems())
+        self.assertEquals(set(counts) - set(probabilities), set())
+        critical = self.CHI_SQUARED_CRITICAL[len(probabilities) - 1]
+        self.assertLess(chi_squared, critical)
+
+    def test_alias_sampler_errors(self):
+        self.assertRaises(ValueError, utils.AliasSampler, {'x': -1, 'y': 1})
+        self.assertRaises(ValueError, utils.AliasSampler({}).draw)
+        self.assertRaises(ValueError, utils.AliasSampler({'x': 0}).draw)
+        self.assertEquals(utils.AliasSampler({'x': 0}).sample(3), [])
+
+    def test_alias_sampler_tables(self):
+        weights = {'a': 1, 'b': 2, 'c': 3.5, 'd': 0.25, 'e': 13, 'f': 0}
+        sampler = utils.AliasSampler(weights)
+        n = len(sampler)
+        self.assertEquals(n, 5)
+
+        # the chance of each key is the share of the columns it was given
+        chances = collections.defaultdict(float)
+        for column, key in enumerate(sampler.keys):
+            probability = sampler.probabilities[column]
+            alias = sampler.keys[sampler.aliases[column]]
+            chances[key] += probability / n
+            chances[alias] += (1 - probability) / n
+
+        total = sum(weights.itervalues())
+        for key, weight in weights.iteritems():
+            self.assertAlmostEqual(chances[key], weight / total)
+
+    def test_alias_sampler_draw(self):
+        weights = {'a': 1, 'b': 2, 'c': 3.5, 'd': 0.25, 'e': 13, 'f': 0}
+        total = sum(weights.itervalues())
+        probabilities = {key: weight / total
+                         for key, weight in weights.iteritems() if weight}
+        sampler = utils.AliasSampler(weights)
+        rand = random.Random(47)
+        trials = 100000
+
+        counts = collections.Counter(sampler.draw(_random=rand.random)
+                                     for i in xrange(trials))
+        self.assertDistribution(counts, probabilities, trials)
+
+    def test_alias_sampler_sample(self):
+        weights = {'a': 1, 'b': 2, 'c': 4, 'd': 8}
+        total = float(sum(weights.itervalues()))
+        sampler = utils.AliasSampler(weights)
+        rand = random.Random(47)
+        trials = 50000
+
+        # ordered pairs come out as often as two lotteries without
+        # replacement would pick them
+        probabilities = {
+            (first, second): (weights[first] / total *
+                              weights[second] / (total - weights[first]))
+            for first in weights for second in weights if first != second}
+        counts = collections.Counter(
+            tuple(sampler.sample(2, _random=rand.random))
+            for i in xrange(trials))
+        self.assertDistribution(counts, probabilities, trials)
+
+        self.assertEquals(sorted(sampler.sample(10)), ['a', 'b', 'c', 'd'])
+
 
 class TestCanonicalizeEmail(unittest.TestCase):
     def test_empty_string(self):
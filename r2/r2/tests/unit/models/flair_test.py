@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# The contents of this file are subject to the Common Public Attribution
+# License Version 1.0. (the "License"); you may not use this file except in
+# compliance with the License. You may obtain a copy of the License at
+# http://code.reddit.com/LICENSE. The License is based on the Mozilla Public
+# License Version 1.1, but Sections 14 and 15 have been added to cover use of
+# software over a computer network and provide for limited attribution for the
+# Original Developer. In addition, Exhibit A has been modified to be consistent
+# with Exhibit B.
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License for
+# the specific language governing rights and limitations under the License.
+#
+# The Original Code is reddit.
+#
+# The Original Developer is the Initial Developer.  The Initial Developer of
+# the Original Code is reddit Inc.
+#
+# All portions of the code written by reddit are Copyright (c) 2006-2013 reddit
+# Inc. All Rights Reserved.
+###############################################################################
+
+
+import unittest
+import uuid
+
+from r2.lib.db.thing import NotFound
+from r2.models.account import Account
+from r2.models.flair import Flair
+from r2.models.subreddit import Subreddit
+
+
+def make_accounts(n):
+    accounts = []
+    for i in xrange(n):
+        a = Account(name='flairtest_%s' % uuid.uuid4().hex[:12])
+        a._commit()
+        accounts.append(a)
+    return accounts
+
+
+def flair_of(sr, accounts):
+    """The flair state of each account: its attributes as reloaded, whether
+    the cache has a flair relation for it in sr and whether the db does."""
+    loaded = Account._byID([a._id for a in accounts], data=True)
+    rels = Flair._fast_query(sr, accounts, 'flair')
+    q = Flair._query(Flair.c._thing1_id == sr._id,
+                     Flair.c._thing2_id == [a._id for a in accounts],
+                     Flair.c._name == 'flair')
+    in_db = set(rel._thing2_id for rel in q)
+    ret = []
+    for a in accounts:
+        a = loaded[a._id]
+        ret.append((getattr(a, 'flair_%s_text' % sr._id, None),
+                    getattr(a, 'flair_%s_css_class' % sr._id, None),
+                    bool(rels.get((sr, a, 'flair'))),
+                    a._id in in_db))
+    return ret
+
+
+class FlairStoreMultiTest(unittest.TestCase):
+    """store_multi should leave things just as setting each account's flair
+    one at a time (the way POST_flaircsv used to) does."""
+
+    flair = [
+        ('text', 'css'),
+        ('text only', ''),
+        ('', 'css-only'),
+        ('', ''),
+    ]
+
+    def setUp(self):
+        self.one_sr = Subreddit()
+        self.one_sr._commit()
+        self.multi_sr = Subreddit()
+        self.multi_sr._commit()
+        self.one_accounts = make_accounts(len(self.flair))
+        self.multi_accounts = make_accounts(len(self.flair))
+
+    def store_one(self, sr, account, text, css_class):
+        if text or css_class:
+            sr.add_flair(account)
+        else:
+            sr.remove_flair(account)
+        setattr(account, 'flair_%s_text' % sr._id, text)
+        setattr(account, 'flair_%s_css_class' % sr._id, css_class)
+        account._commit()
+
+    def store_all(self, flair):
+        for account, (text, css_class) in zip(self.one_accounts, flair):
+            self.store_one(self.one_sr, account, text, css_class)
+        Flair.store_multi(self.multi_sr,
+                          dict(zip(self.multi_accounts, flair)))
+
+    def assertSameFlair(self):
+        one = flair_of(self.one_sr, self.one_accounts)
+        multi = flair_of(self.multi_sr, self.multi_accounts)
+        self.assertEquals(one, multi)
+
+    def test_add(self):
+        self.store_all(self.flair)
+        self.assertSameFlair()
+        self.assertEquals([(True, True)] * 3 + [(False, False)],
+                          [(cached, in_db) for text, css, cached, in_db
+                           in flair_of(self.multi_sr, self.multi_accounts)])
+
+    def test_change_and_remove(self):
+        self.store_all(self.flair)
+        self.store_all(list(reversed(self.flair)))
+        self.assertSameFlair()
+
+    def test_remove_all(self):
+        self.store_all(self.flair)
+        self.store_all([('', '')] * len(self.flair))
+        self.assertSameFlair()
+        self.assertEquals([('', '', False, False)] * len(self.flair),
+                          flair_of(self.multi_sr, self.multi_accounts))
+
+
+class RelationMultiTest(unittest.TestCase):
+    def setUp(self):
+        self.sr = Subreddit()
+        self.sr._commit()
+        self.one_accounts = make_accounts(3)
+        self.multi_accounts = make_accounts(3)
+
+    def test_create_multi(self):
+        for a in self.one_accounts:
+            Flair(self.sr, a, 'flair')._commit()
+        rels = Flair._create_multi([(self.sr, a)
+                                    for a in self.multi_accounts], 'flair')
+
+        self.assertEquals(len(self.multi_accounts), len(rels))
+        for accounts in (self.one_accounts, self.multi_accounts):
+            cached = Flair._fast_query(self.sr, accounts, 'flair')
+            q = Flair._query(Flair.c._thing1_id == self.sr._id,
+                             Flair.c._thing2_id == [a._id for a in accounts])
+            in_db = dict((rel._thing2_id, rel._id) for rel in q)
+            for a in accounts:
+                rel = cached[(self.sr, a, 'flair')]
+                self.assertTrue(rel)
+                self.assertEquals(in_db[a._id], rel._id)
+                self.assertEquals((self.sr._id, a._id, 'flair'),
+                                  (rel._thing1_id, rel._thing2_id, rel._name))
+
+    def test_delete_multi(self):
+        for a in self.one_accounts:
+            Flair(self.sr, a, 'flair')._commit()
+        rels = Flair._create_multi([(self.sr, a)
+                                    for a in self.multi_accounts], 'flair')
+
+        for rel in Flair._fast_query(self.sr, self.one_accounts,
+                                     'flair').itervalues():
+            rel._delete()
+        Flair._delete_multi(rels)
+
+        for accounts in (self.one_accounts, self.multi_accounts):
+            rels = Flair._fast_query(self.sr, accounts, 'flair')
+            self.assertFalse(any(rels.itervalues()))
+            self.assertEquals([], list(Flair._query(
+                Flair.c._thing1_id == self.sr._id,
+                Flair.c._thing2_id == [a._id for a in accounts])))
+
+    def test_commit_multi(self):
+        for i, a in enumerate(self.one_accounts):
+            a.pref_num_comments = 10 + i
+            a.flairtest_new_attr = 'value %d' % i
+            a._commit()
+
+        for i, a in enumerate(self.multi_accounts):
+            a.pref_num_comments = 10 + i
+            a.flairtest_new_attr = 'value %d' % i
+        Account._commit_multi(self.multi_accounts)
+
+        for accounts in (self.one_accounts, self.multi_accounts):
+            self.assertFalse(any(a._dirty for a in accounts))
+            loaded = Account._byID([a._id for a in accounts], data=True)
+            for i, a in enumerate(accounts):
+                self.assertEquals(10 + i, loaded[a._id].pref_num_comments)
+                self.assertEquals('value %d' % i,
+                                  loaded[a._id].flairtest_new_attr)
+
+    def test_commit_multi_base_props(self):
+        a = self.multi_accounts[0]
+        a._ups = 5
+        self.assertRaises(ValueError, Account._commit_multi, [a])
+
+
+class ByNamesTest(unittest.TestCase):
+    def test_by_names(self):
+        accounts = make_accounts(3)
+        names = [a.name for a in accounts]
+        names.append(names[0].upper())
+        names.append('flairtest_missing_%s' % uuid.uuid4().hex[:8])
+
+        by_names = Account._by_names(names)
+        by_name = {}
+        for name in names:
+            try:
+                by_name[name] = Account._by_name(name)
+            except NotFound:
+                pass
+
+        self.assertEquals(set(by_name), set(by_names))
+        for name, account in by_name.iteritems():
+            self.assertEquals(account._id, by_names[name]._id)
+        self.assertEquals(len(names) - 1, len(by_names))
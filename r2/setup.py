@@ -25,22 +25,28 @@ from ez_setup import use_setuptools
 use_setuptools()
 
 from setuptools import find_packages
+from distutils.command.build_ext import build_ext as _build_ext
 from distutils.core import setup, Extension
 import os
 import fnmatch
 
 
-commands = {}
+class build_ext(_build_ext):
+    """build_ext that runs the .pyx extensions through Cython first.
 
+    Cython is imported when the command runs rather than at the top of this
+    file, because setup_requires only installs it once setup() is called.
+
+    """
+    def finalize_options(self):
+        _build_ext.finalize_options(self)
+        from Cython.Build import cythonize
+        self.extensions = cythonize(self.extensions)
 
-try:
-    from Cython.Distutils import build_ext
-except ImportError:
-    pass
-else:
-    commands.update({
-        "build_ext": build_ext
-    })
+
+commands = {
+    "build_ext": build_ext,
+}
 
 
 try:
@@ -71,6 +77,10 @@ discount_path = "r2/lib/contrib/discount"
 setup(
     name="r2",
     version="",
+    # the .pyx extensions below are compiled with Cython by build_ext
+    setup_requires=[
+        "cython>=0.17",
+    ],
     install_requires=[
         "webob==1.0.8",
         "Pylons==0.9.7",
@@ -80,7 +90,7 @@ setup(
         "pytz",
         "pycrypto",
         "Babel>=0.9.1",
-        "cython>=0.14",
+        "cython>=0.17",
         "SQLAlchemy==0.7.4",
         "BeautifulSoup",
         "cssutils==0.9.5.1",
@@ -23,11 +23,18 @@
 
 
 from r2.lib import amqp, emailer
+from r2.lib.exception_aggregator import (
+    DIGEST_INTERVAL,
+    ExceptionAggregator,
+    fingerprint,
+    format_traceback,
+    legacy_fingerprint,
+)
 from pylons import g
 from datetime import datetime
-from md5 import md5
 from random import shuffle, choice
 
+import calendar
 import pickle
 
 try:
@@ -44,13 +51,23 @@ def randword():
         return '???'
 
 q = 'log_q'
+BATCH_SIZE = 500
+# /var/tmp rather than /tmp so that the counts survive a reboot
+STATE_FILE = "/var/tmp/log_q.sqlite"
 
-def run(streamfile=None, verbose=False):
+def run(streamfile=None, verbose=False, state_file=None,
+        digest_interval=DIGEST_INTERVAL):
     if streamfile:
         stream_fp = open(streamfile, "a")
     else:
         stream_fp = None
 
+    if state_file is None:
+        state_file = g.config.get('log_q_state_file') or STATE_FILE
+
+    aggregator = ExceptionAggregator(state_file,
+                                     digest_interval=digest_interval)
+
     def streamlog(msg, important=False):
         if stream_fp:
             stream_fp.write(msg + "\n")
@@ -69,74 +86,53 @@ def run(streamfile=None, verbose=False):
             l.pop(12)
         l.append(item)
 
-    def log_exception(d, daystring):
-        exc_desc = d['exception_desc']
-        exc_type = d['exception_type']
+    def adopt_legacy(key, d, nickname_key, status_key):
+        """Carry the nickname and status of an exception over from the
+        hardcache keys of its fingerprint from before exception_aggregator,
+        so that it isn't announced as new again or forgets it was fixed."""
+        legacy_key = legacy_fingerprint(d['exception_type'],
+                                        d['exception_desc'], d['traceback'])
+        if legacy_key == key:
+            return None
 
-        exc_str = "%s: %s" % (exc_type, exc_desc)
-
-        add_timestamps(d)
-
-        tb = []
-
-        key_material = exc_type
-        pretty_lines = []
-
-        make_lock_seen = False
-        flaky_db_seen = False
-        cassandra_seen = False
-
-        for tpl in d['traceback']:
-            tb.append(tpl)
-            filename, lineno, funcname, text = tpl
-            if text is None:
-                pass
-            elif (text.startswith("with g.make_lock(") or
-                  text.startswith("with make_lock(")):
-                make_lock_seen = True
-            elif (text.startswith("(ProgrammingError) server closed the connection")):
-                flaky_db_seen = True
-            if '/cassandra/' in filename.lower():
-                cassandra_seen = True
-            if '/pycassa/' in filename.lower():
-                cassandra_seen = True
-            key_material += "%s %s " % (filename, funcname)
-            pretty_lines.append ("%s:%s: %s()" % (filename, lineno, funcname))
-            pretty_lines.append ("    %s" % text)
-
-        if exc_desc.startswith("QueuePool limit of size"):
-            fingerprint = "QueuePool_overflow"
-        elif exc_desc.startswith("error 2 from memcached_get: HOSTNAME "):
-            fingerprint = "memcache_suckitude"
-        elif exc_type == "TimeoutExpired" and make_lock_seen:
-            fingerprint = "make_lock_timeout"
-        elif exc_desc.startswith("(OperationalError) FATAL: the database " +
-                                 "system is in recovery mode"):
-            fingerprint = "recovering_db"
-        elif exc_desc.startswith("(OperationalError) could not connect " +
-                                 "to server"):
-            fingerprint = "unconnectable_db"
-        elif exc_desc.startswith("(OperationalError) server closed the " +
-                                 "connection unexpectedly"):
-            fingerprint = "flaky_db_op"
-        elif cassandra_seen:
-            fingerprint = "something's wrong with cassandra"
+        nickname = g.hardcache.get("error_nickname-" + legacy_key)
+        if nickname is None:
+            return None
+
+        g.hardcache.set(nickname_key, nickname, 86400 * 365)
+        status = g.hardcache.get("error_status-" + legacy_key)
+        if status is not None:
+            g.hardcache.set(status_key, status, 86400)
+        return nickname
+
+    def log_exceptions(key, ds, daystring):
+        """Record every occurrence of one fingerprint from a batch."""
+        first = ds[0]
+        exc_str = "%s: %s" % (first['exception_type'],
+                              first['exception_desc'])
+
+        nickname_key = "error_nickname-" + key
+        status_key = "error_status-" + key
+
+        info = aggregator.get(key)
+        if info is None:
+            # the hardcache may know it from before the aggregator did
+            nickname = g.hardcache.get(nickname_key)
+            if nickname is None:
+                nickname = adopt_legacy(key, first, nickname_key, status_key)
         else:
-            fingerprint = md5(key_material).hexdigest()
-
-        nickname_key = "error_nickname-" + fingerprint
-        status_key = "error_status-" + fingerprint
-
-        nickname = g.hardcache.get(nickname_key)
+            nickname = info['nickname']
 
         if nickname is None:
             nickname = '"%s" Exception' % randword().capitalize()
             news = ("A new kind of thing just happened! " +
                     "I'm going to call it a %s\n\n" % nickname)
 
-            news += "Where and when: %s\n\n" % d['occ']
+            news += "Where and when: %s\n\n" % first['occ']
+            if len(ds) > 1:
+                news += "It happened %d times in a row.\n\n" % len(ds)
             news += "Traceback:\n"
-            news += "\n".join(pretty_lines)
+            news += format_traceback(first['traceback']) + "\n"
             news += exc_str
             news += "\n"
 
@@ -151,21 +147,30 @@ def run(streamfile=None, verbose=False):
             news += "But it just occurred, so I'm marking it new again."
             emailer.nerds_email(news, "Exception Watcher")
 
-        err_key = "-".join(["error", daystring, fingerprint])
+        for d in ds:
+            aggregator.record(d['exception_type'], d['exception_desc'],
+                              d['traceback'],
+                              when=calendar.timegm(d['time'].utctimetuple()),
+                              occurrence=d['occ'], nickname=nickname)
+
+        err_key = "-".join(["error", daystring, key])
 
         existing = g.hardcache.get(err_key)
 
         if not existing:
-            existing = dict(exception=exc_str, traceback=tb, occurrences=[])
+            existing = dict(exception=exc_str, traceback=first['traceback'],
+                            occurrences=[])
 
         existing.setdefault('times_seen', 0)
-        existing['times_seen'] += 1
+        existing['times_seen'] += len(ds)
 
-        limited_append(existing['occurrences'], d['occ'])
+        for d in ds:
+            limited_append(existing['occurrences'], d['occ'])
 
         g.hardcache.set(err_key, existing, 7 * 86400)
 
-        streamlog ("%s [X] %-70s" % (d['hms'], nickname), verbose)
+        streamlog ("%s [X] %-70s x%d" % (ds[-1]['hms'], nickname, len(ds)),
+                   verbose)
 
     def log_text(d, daystring):
         add_timestamps(d)
@@ -203,29 +208,47 @@ def run(streamfile=None, verbose=False):
         limited_append(occurrences, d2)
         g.hardcache.set(occ_key, occurrences, 86400 * 7)
 
-    def myfunc(msg):
+    def process_batch(msgs, chan):
         daystring = datetime.now(g.display_tz).strftime("%Y/%m/%d")
+        exceptions = {}
 
-        try:
-            d = pickle.loads(msg.body)
-        except TypeError:
-            streamlog ("wtf is %r" % msg.body, True)
-            return
-
-        if not 'type' in d:
-            streamlog ("wtf is %r" % d, True)
-        elif d['type'] == 'exception':
+        for msg in msgs:
             try:
-                log_exception(d, daystring)
-            except Exception as e:
-                print "Error in log_exception(): %r" % e
-        elif d['type'] == 'text':
+                d = pickle.loads(msg.body)
+            except TypeError:
+                streamlog ("wtf is %r" % msg.body, True)
+                continue
+
+            if not 'type' in d:
+                streamlog ("wtf is %r" % d, True)
+            elif d['type'] == 'exception':
+                try:
+                    add_timestamps(d)
+                    key = fingerprint(d['exception_type'],
+                                      d['exception_desc'], d['traceback'])
+                except Exception as e:
+                    print "Error in fingerprint(): %r" % e
+                else:
+                    exceptions.setdefault(key, []).append(d)
+            elif d['type'] == 'text':
+                try:
+                    log_text(d, daystring)
+                except Exception as e:
+                    print "Error in log_text(): %r" % e
+            else:
+                streamlog ("wtf is %r" % d['type'], True)
+
+        for key, ds in exceptions.iteritems():
             try:
-                log_text(d, daystring)
+                log_exceptions(key, ds, daystring)
             except Exception as e:
-                print "Error in log_text(): %r" % e
-        else:
-            streamlog ("wtf is %r" % d['type'], True)
+                print "Error in log_exceptions(): %r" % e
+
+        aggregator.commit()
 
-    amqp.consume_items(q, myfunc, verbose=verbose)
+        if aggregator.digest_due():
+            digest = aggregator.digest()
+            if digest:
+                emailer.nerds_email(digest, "Exception Watcher")
 
+    amqp.handle_items(q, process_batch, limit=BATCH_SIZE, verbose=verbose)